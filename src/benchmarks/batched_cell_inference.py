@@ -0,0 +1,77 @@
+# coding: utf-8
+import argparse
+import time
+
+import numpy as np
+import torch
+from albumentations import VerticalFlip, HorizontalFlip, Rotate
+
+from src.models.networks_bestfitting.densenet import class_densenet121_large_dropout
+from src.models.encodings_pretrained import BestfittingLogitsEncodingsModel
+from src.data.utils import get_cell_copied
+from src.predict.cell_batching import predict_cells_batched
+
+# Cells/s of predict_cells_from_image_level_densenet with one forward per cell (4 TTA views) and with
+# --cell-batch-size, on random weights and synthetic cells on the CPU:
+# python -m src.benchmarks.batched_cell_inference --img_size 256 --batch-sizes 4 16 32 64 --num-threads 8
+# Batch size 4 is the per-cell mode. Outputs of all batch sizes are compared to it.
+
+parser = argparse.ArgumentParser(description='Per-cell vs. batched TTA inference of the image-level DenseNet')
+parser.add_argument('--img_size', default=256, type=int, help='size of the tiled cell images (1024 in the predictor)')
+parser.add_argument('--in_channels', default=4, type=int)
+parser.add_argument('--num-images', default=4, type=int)
+parser.add_argument('--cells-per-image', default=30, type=int)
+parser.add_argument('--batch-sizes', nargs='+', default=[4, 16, 32, 64], type=int)
+parser.add_argument('--num-threads', default=None, type=int)
+
+
+def make_cells(args):
+    rng = np.random.RandomState(0)
+    augmentations = [VerticalFlip(always_apply=True), HorizontalFlip(always_apply=True),
+                     Rotate(always_apply=True, limit=(89, 91))]
+    images = []
+    for img_i in range(args.num_images):
+        cells = []
+        for _ in range(args.cells_per_image):
+            height, width = rng.randint(args.img_size // 8, args.img_size // 3, size=2)
+            cell_img = rng.randint(0, 256, size=(height, width, args.in_channels)).astype(np.uint8)
+            views = get_cell_copied(cell_img, augmentations=augmentations, height=args.img_size, width=args.img_size)
+            cells.append(torch.from_numpy(np.stack(views).astype(np.float32).transpose((0, 3, 1, 2))))
+        images.append(('image_%d' % img_i, cells))
+    return images
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    model = class_densenet121_large_dropout(num_classes=19, in_channels=args.in_channels, pretrained_file=None)
+    model = BestfittingLogitsEncodingsModel(model)
+    model.eval()
+    images = make_cells(args)
+    num_cells = args.num_images * args.cells_per_image
+
+    def predict_fn(batch):
+        with torch.no_grad():
+            logits, embs = model(batch)
+            return torch.sigmoid(logits).numpy(), embs.numpy()
+
+    # warm-up
+    predict_fn(images[0][1][0])
+
+    print('%-12s %10s %10s %9s %14s' % ('views/batch', 'sec', 'cells/s', 'speedup', 'max abs diff'))
+    reference = None
+    reference_sec = None
+    for batch_size in args.batch_sizes:
+        start = time.time()
+        outputs = dict(predict_cells_batched(iter(images), predict_fn, batch_size, concat=torch.cat))
+        sec = time.time() - start
+        if reference is None:
+            reference, reference_sec = outputs, sec
+        max_diff = max(float(np.abs(outputs[key][0] - reference[key][0]).max()) for key in outputs)
+        print('%-12d %10.1f %10.2f %8.2fx %14.2e' % (batch_size, sec, num_cells / sec, reference_sec / sec, max_diff))
+
+
+if __name__ == '__main__':
+    main()
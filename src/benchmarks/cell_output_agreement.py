@@ -0,0 +1,107 @@
+# coding: utf-8
+import os
+import pickle
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from src.data.utils import get_class_names
+
+# Agreement of the cell outputs of a fast predict_cells_from_image_level_densenet mode (--native-size: suffix
+# _native, --roi-pooling: suffix _roi) with the tiled ones on the held-out images of a fold, e.g. after
+# python -m src.predict.predict_cells_from_image_level_densenet --fold-single 0
+# python -m src.predict.predict_cells_from_image_level_densenet --fold-single 0 --native-size --cell-batch-size 64
+# python -m src.benchmarks.cell_output_agreement --fold 0 --suffix _native
+# The per-class report is written to output/logs/cell_output_agreement/fold<k><suffix>.csv.
+
+parser = argparse.ArgumentParser(description='Agreement of fast cell inference outputs with the tiled ones')
+parser.add_argument('--fold', default=0, type=int)
+parser.add_argument('--suffix', default='_native', type=str, help='output suffix of the compared mode')
+parser.add_argument('--reference-suffix', default='', type=str, help='output suffix of the reference (tiled) mode')
+parser.add_argument('--folds-path', default='input/imagelevel_folds_obvious_staining_5.pkl', type=str)
+parser.add_argument('--output-root', default='output', type=str)
+
+
+def agreement_metrics(ref_preds, ref_embs, preds, embs):
+    """Summary of (num cells, num classes) probabilities and (num cells, dim) embeddings against a reference."""
+    abs_diff = np.abs(preds - ref_preds)
+    centered_ref = ref_embs - ref_embs.mean(axis=1, keepdims=True)
+    centered = embs - embs.mean(axis=1, keepdims=True)
+    emb_corr = (centered_ref * centered).sum(axis=1) / np.maximum(
+        np.linalg.norm(centered_ref, axis=1) * np.linalg.norm(centered, axis=1), 1e-12)
+    return OrderedDict([('num_cells', len(ref_preds)),
+                        ('prob_mean_abs_diff', abs_diff.mean()),
+                        ('prob_max_abs_diff', abs_diff.max()),
+                        ('class_corr', np.nanmean(class_correlations(ref_preds, preds))),
+                        ('top_class_agreement', (preds.argmax(axis=1) == ref_preds.argmax(axis=1)).mean()),
+                        ('positive_agreement', ((preds > 0.5) == (ref_preds > 0.5)).mean()),
+                        ('embedding_corr', emb_corr.mean())])
+
+
+def class_correlations(ref_preds, preds):
+    """Pearson correlation per class over the cells, nan for classes that are constant in either output."""
+    corrs = np.full(ref_preds.shape[1], np.nan)
+    for class_i in range(ref_preds.shape[1]):
+        if ref_preds[:, class_i].std() > 0 and preds[:, class_i].std() > 0:
+            corrs[class_i] = np.corrcoef(ref_preds[:, class_i], preds[:, class_i])[0, 1]
+    return corrs
+
+
+def format_metrics(metrics):
+    return ('%d cells: prob mean abs diff %.4f, max %.4f, per-class corr %.3f, top class agreement %.1f%%, '
+            'positives (> 0.5) agreement %.1f%%, embedding corr per cell %.3f' %
+            (metrics['num_cells'], metrics['prob_mean_abs_diff'], metrics['prob_max_abs_diff'],
+             metrics['class_corr'], 100 * metrics['top_class_agreement'], 100 * metrics['positive_agreement'],
+             metrics['embedding_corr']))
+
+
+def read_outputs(img_ids, pred_dir, embs_dir):
+    preds, embs = [], []
+    for img_id in img_ids:
+        preds.append(np.stack(pd.read_hdf(os.path.join(pred_dir, f'{img_id}.h5'))['image_level_pred'].values))
+        embs.append(np.stack(pd.read_hdf(os.path.join(embs_dir, f'{img_id}.h5'))['image_level_embs'].values))
+    return np.concatenate(preds), np.concatenate(embs)
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.folds_path, 'rb') as f:
+        _, val_img_paths = pickle.load(f)[args.fold]
+
+    dirs = {suffix: (os.path.join(args.output_root, 'densenet121_pred' + suffix),
+                     os.path.join(args.output_root, 'densenet121_embs' + suffix))
+            for suffix in (args.reference_suffix, args.suffix)}
+    img_ids = [os.path.basename(path) for path in val_img_paths]
+    available = [img_id for img_id in img_ids
+                 if all(os.path.exists(os.path.join(pred_dir, f'{img_id}.h5')) for pred_dir, _ in dirs.values())]
+    if not available:
+        raise ValueError(f'no image of fold {args.fold} has outputs in both {dirs[args.reference_suffix][0]} and '
+                         f'{dirs[args.suffix][0]}')
+    print('>> fold %d: %d of %d held-out images have outputs of both modes' % (args.fold, len(available), len(img_ids)))
+
+    ref_preds, ref_embs = read_outputs(available, *dirs[args.reference_suffix])
+    preds, embs = read_outputs(available, *dirs[args.suffix])
+    if ref_preds.shape != preds.shape:
+        raise ValueError(f'cell counts differ: {ref_preds.shape} vs. {preds.shape}')
+    print('>> %s vs. %s: %s' % (args.suffix, args.reference_suffix or 'tiled',
+                                format_metrics(agreement_metrics(ref_preds, ref_embs, preds, embs))))
+
+    report = pd.DataFrame({'class_name': get_class_names(),
+                           'reference_mean': ref_preds.mean(axis=0),
+                           'mean': preds.mean(axis=0),
+                           'mean_abs_diff': np.abs(preds - ref_preds).mean(axis=0),
+                           'corr': class_correlations(ref_preds, preds),
+                           'positive_agreement': ((preds > 0.5) == (ref_preds > 0.5)).mean(axis=0)})
+    print(report.to_string(index=False, float_format=lambda value: '%.4f' % value))
+    log_dir = os.path.join(args.output_root, 'logs', 'cell_output_agreement')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    report_path = os.path.join(log_dir, f'fold{args.fold}{args.suffix}.csv')
+    report.to_csv(report_path, index=False)
+    print(f'>> per-class report written to {report_path}')
+
+
+if __name__ == '__main__':
+    main()
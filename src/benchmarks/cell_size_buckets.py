@@ -0,0 +1,95 @@
+# coding: utf-8
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.sampler import SequentialSampler
+
+from src.commons.config.config_bestfitting import RESULT_DIR
+from src.data.datasets import ProteinDatasetCellSeparateLoading, CellSizeBucketBatchSampler
+from src.models.pruning import count_macs
+from src.train.train_cellwise import get_cell_training_data
+from src.benchmarks.student_speed_vs_map import load_model, evaluate
+
+# FLOPs and mAP of a cell classifier on the validation cells of a fold, every cell resized to --cell-img-size
+# against cells resized to their size bucket:
+# python -m src.benchmarks.cell_size_buckets --checkpoint output/models/densenet121_cellwise/fold0/final.pth \
+#     --size-buckets 256 384 512
+# GMACs are counted per input size with count_macs, mAP is computed against the binarized stored teacher outputs.
+
+parser = argparse.ArgumentParser(description='Fixed-size vs. size-bucketed cell crops')
+parser.add_argument('--checkpoint', required=True, type=str)
+parser.add_argument('--arch', default='class_densenet121_dropout', type=str)
+parser.add_argument('--effnet-encoder', default='efficientnet-b0', type=str)
+parser.add_argument('--num_classes', default=19, type=int)
+parser.add_argument('--in_channels', default=4, type=int)
+parser.add_argument('--fold', default=0, type=int)
+parser.add_argument('--cell-level-labels-path', default='output/densenet121_pred.h5', type=str)
+parser.add_argument('--cell-img-size', default=512, type=int)
+parser.add_argument('--size-buckets', nargs='+', default=[256, 384, 512], type=int)
+parser.add_argument('--target-raw-img-size', default=None, type=int)
+parser.add_argument('--max-cells', default=5000, type=int)
+parser.add_argument('--batch_size', default=64, type=int)
+parser.add_argument('--workers', default=4, type=int)
+parser.add_argument('--device', default='cuda', type=str)
+parser.add_argument('--out-fpath', default=os.path.join(RESULT_DIR, 'logs', 'cell_size_buckets.csv'), type=str)
+
+
+def main():
+    args = parser.parse_args()
+    args.device = torch.device(args.device)
+    args.include_nn_mitotic, args.upsample_minorities, args.ignore_negative = False, False, False
+    _, val_img_paths, basepath_2_ohe_vector, labels_df, _ = get_cell_training_data(args)
+    datasets = {}
+    for name, size_buckets in [('fixed', None), ('bucketed', args.size_buckets)]:
+        datasets[name] = ProteinDatasetCellSeparateLoading(val_img_paths,
+                                                           labels_df=labels_df,
+                                                           in_channels=args.in_channels,
+                                                           basepath_2_ohe=basepath_2_ohe_vector,
+                                                           target_raw_img_size=args.target_raw_img_size,
+                                                           size_buckets=size_buckets)
+        datasets[name].set_img_size(args.cell_img_size)
+    dataset = datasets['bucketed']
+    indices = sorted(np.random.RandomState(0).permutation(len(dataset))[:args.max_cells].tolist())
+    sizes = np.array([dataset.get_cell_img_size(i) for i in indices])
+
+    model = load_model(args.arch, args.cell_img_size, args.checkpoint, args)
+    size_2_gmacs = {int(size): count_macs(model, int(size), args.in_channels) / 1e9
+                    for size in set(sizes.tolist()) | {args.cell_img_size}}
+
+    fixed_loader = DataLoader(Subset(datasets['fixed'], indices), sampler=SequentialSampler(indices),
+                              batch_size=args.batch_size, num_workers=args.workers, pin_memory=True)
+    bucketed_loader = DataLoader(dataset, batch_sampler=CellSizeBucketBatchSampler(
+        dataset.cell_buckets, args.batch_size, base_sampler=indices, shuffle=False),
+        num_workers=args.workers, pin_memory=True)
+
+    rows = []
+    print('%-10s %12s %10s %10s %8s' % ('crops', 'GMACs/cell', 'ms/cell', 'cells/s', 'mAP'))
+    for name, loader, gmacs in [
+        ('fixed', fixed_loader, size_2_gmacs[args.cell_img_size]),
+        ('bucketed', bucketed_loader, float(np.mean([size_2_gmacs[int(size)] for size in sizes]))),
+    ]:
+        # the fixed crops already have cell_img_size, the bucketed ones must not be resized
+        img_size = args.cell_img_size if name == 'fixed' else None
+        evaluate(model, img_size, [next(iter(loader))], args.device)
+        map_score, ms_per_cell, cells_per_sec = evaluate(model, img_size, loader, args.device)
+        print('%-10s %12.2f %10.2f %10.1f %8.4f' % (name, gmacs, ms_per_cell, cells_per_sec, map_score))
+        rows.append({'crops': name, 'gmacs_per_cell': gmacs, 'ms_per_cell': ms_per_cell,
+                     'cells_per_sec': cells_per_sec, 'map': map_score, 'num_cells': len(indices),
+                     'size_buckets': ' '.join(map(str, args.size_buckets))})
+    print('cells per bucket: %s, GMACs saved: %.1f%%' %
+          (', '.join('%dpx: %d' % (size, (sizes == size).sum()) for size in sorted(set(sizes.tolist()))),
+           100 * (1 - rows[1]['gmacs_per_cell'] / rows[0]['gmacs_per_cell'])))
+
+    out_dir = os.path.dirname(args.out_fpath)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    pd.DataFrame(rows).to_csv(args.out_fpath, index=False)
+    print(f'Results written to {args.out_fpath}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# coding: utf-8
+import argparse
+import time
+
+import numpy as np
+import torch
+from albumentations import VerticalFlip, HorizontalFlip, Rotate
+
+from src.data.utils import get_cell_copied
+from src.data.tta import get_cell_views_tensor
+
+# Per-cell latency of building the 4 tiled TTA views of predict_cells_from_image_level_densenet:
+# get_cell_copied in numpy (float64) vs. tensor ops from the uint8 crop, on the CPU and, if available, on the GPU.
+# python -m src.benchmarks.cell_tta_latency --num-cells 50 --num-threads 8
+# The identity and flip views are compared with the numpy ones, the rot90 view replaces Rotate(limit=(89, 91))
+# and is reported separately.
+
+parser = argparse.ArgumentParser(description='numpy vs. tensor TTA view generation per cell')
+parser.add_argument('--img_size', default=1024, type=int)
+parser.add_argument('--in_channels', default=4, type=int)
+parser.add_argument('--num-cells', default=50, type=int)
+parser.add_argument('--num-threads', default=None, type=int)
+
+
+def numpy_views(cell_img, augmentations, img_size):
+    views = np.stack(get_cell_copied(cell_img, augmentations=augmentations, height=img_size, width=img_size))
+    return torch.from_numpy(views.astype(np.float32).transpose((0, 3, 1, 2)))
+
+
+def time_per_cell(make_views, cells, device_is_cuda=False):
+    make_views(cells[0])
+    start = time.time()
+    for cell_img in cells:
+        make_views(cell_img)
+    if device_is_cuda:
+        torch.cuda.synchronize()
+    return 1000 * (time.time() - start) / len(cells)
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    rng = np.random.RandomState(0)
+    cells = [rng.randint(0, 256, size=tuple(rng.randint(60, 300, size=2)) + (args.in_channels,)).astype(np.uint8)
+             for _ in range(args.num_cells)]
+    augmentations = [VerticalFlip(always_apply=True), HorizontalFlip(always_apply=True),
+                     Rotate(always_apply=True, limit=(89, 91))]
+
+    numpy_ms = time_per_cell(lambda cell_img: numpy_views(cell_img, augmentations, args.img_size), cells)
+    print('%-22s %10.2f ms/cell' % ('numpy get_cell_copied', numpy_ms))
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        tensor_ms = time_per_cell(lambda cell_img: get_cell_views_tensor(cell_img, height=args.img_size,
+                                                                         width=args.img_size, device=device),
+                                  cells, device_is_cuda=device == 'cuda')
+        print('%-22s %10.2f ms/cell  %6.2fx' % ('tensor (%s)' % device, tensor_ms, numpy_ms / tensor_ms))
+
+    flip_diff, rot_diff = 0.0, 0.0
+    for cell_img in cells[:10]:
+        expected = numpy_views(cell_img, augmentations, args.img_size)
+        views = get_cell_views_tensor(cell_img, height=args.img_size, width=args.img_size)
+        flip_diff = max(flip_diff, float((views[:3] - expected[:3]).abs().max()))
+        rot_diff = max(rot_diff, float((views[3] - expected[3]).abs().mean()))
+    print('identity/flip views max abs diff: %.2e, rot90 vs Rotate(89-91) mean abs diff: %.4f' % (flip_diff, rot_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# coding: utf-8
+import os
+import json
+import argparse
+
+from src.commons.config.config_bestfitting import RESULT_DIR
+
+# Reads progress.jsonl of several training runs (written next to log.train.txt) and reports the wall-clock time
+# until each run reached the target validation score, e.g. a progressive-resolution run vs. a fixed 1024px run:
+# python -m src.benchmarks.compare_time_to_target --runs densenet121_1024_fixed/fold0 densenet121_prog/fold0 --target 0.45
+
+parser = argparse.ArgumentParser(description='Wall-clock time to a target validation score')
+parser.add_argument('--runs', nargs='+', required=True, help='run directories relative to output/logs')
+parser.add_argument('--metric', default='map', type=str)
+parser.add_argument('--target', required=True, type=float)
+parser.add_argument('--lower-is-better', action='store_true')
+
+
+def read_progress(run_dir):
+    with open(os.path.join(RESULT_DIR, 'logs', run_dir, 'progress.jsonl')) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    args = parser.parse_args()
+    print('%-60s %8s %10s %10s %10s' % ('run', 'epoch', 'hours', args.metric, 'best'))
+    for run_dir in args.runs:
+        records = [r for r in read_progress(run_dir) if r.get('full_val', True)]
+        reached = None
+        for record in records:
+            value = record[args.metric]
+            if (value <= args.target) if args.lower_is_better else (value >= args.target):
+                reached = record
+                break
+        values = [r[args.metric] for r in records]
+        best = (min(values) if args.lower_is_better else max(values)) if values else float('nan')
+        if reached is None:
+            print('%-60s %8s %10s %10s %10.4f' % (run_dir, '-', 'not reached', '-', best))
+        else:
+            print('%-60s %8d %10.2f %10.4f %10.4f' % (run_dir, reached['epoch'], reached['wall_clock_sec'] / 3600,
+                                                      reached[args.metric], best))
+
+
+if __name__ == '__main__':
+    main()
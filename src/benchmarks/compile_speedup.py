@@ -0,0 +1,92 @@
+# coding: utf-8
+import argparse
+import copy
+import time
+
+import torch
+
+from src.models.networks_bestfitting.densenet import class_densenet121_dropout
+from src.models.encodings_pretrained import BestfittingEncodingsModel
+from src.models.layers_bestfitting.loss import FocalLoss
+from src.commons.compilation import compile_model
+
+# End-to-end effect of --compile on the CPU, on random weights and synthetic batches:
+# python -m src.benchmarks.compile_speedup --img_size 256 --batch_size 8 --num-threads 8
+# Inference is timed for DensenetClass and BestfittingEncodingsModel, training for full steps
+# (forward, focal loss, backward, Adam). The first (compiling) call is excluded and reported separately.
+
+parser = argparse.ArgumentParser(description='Eager vs. compiled DensenetClass on the CPU')
+parser.add_argument('--img_size', default=256, type=int)
+parser.add_argument('--batch_size', default=8, type=int)
+parser.add_argument('--in_channels', default=4, type=int)
+parser.add_argument('--num_classes', default=19, type=int)
+parser.add_argument('--iterations', default=10, type=int)
+parser.add_argument('--compile-mode', default=None, type=str)
+parser.add_argument('--num-threads', default=None, type=int)
+parser.add_argument('--skip-train', action='store_true')
+
+
+def time_inference(model, images, iterations):
+    model.eval()
+    with torch.no_grad():
+        model(images)
+        start = time.time()
+        for _ in range(iterations):
+            model(images)
+    return 1000 * (time.time() - start) / iterations
+
+
+def time_train(model, images, labels, iterations):
+    criterion = FocalLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    model.train()
+
+    def step():
+        loss = criterion(model(images), labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    step()
+    start = time.time()
+    for _ in range(iterations):
+        step()
+    return 1000 * (time.time() - start) / iterations
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    images = torch.rand(args.batch_size, args.in_channels, args.img_size, args.img_size)
+    labels = (torch.rand(args.batch_size, args.num_classes) > 0.8).float()
+
+    densenet = class_densenet121_dropout(num_classes=args.num_classes, in_channels=args.in_channels,
+                                         pretrained_file=None)
+    models = [('DensenetClass', densenet), ('BestfittingEncodingsModel', BestfittingEncodingsModel(densenet))]
+
+    print('%-28s %-10s %12s %12s %12s %8s' % ('model', 'pass', 'compile(s)', 'eager ms', 'compiled ms', 'speedup'))
+    for name, model in models:
+        start = time.time()
+        compiled = compile_model(model, images, train=False, mode=args.compile_mode)
+        compile_sec = time.time() - start
+        eager_ms = time_inference(model, images, args.iterations)
+        compiled_ms = time_inference(compiled, images, args.iterations)
+        print('%-28s %-10s %12.1f %12.1f %12.1f %7.2fx' % (name, 'inference', compile_sec, eager_ms, compiled_ms,
+                                                            eager_ms / compiled_ms))
+
+    if not args.skip_train:
+        # separate copies, so that both runs start from the same weights and optimizer state
+        eager_model = copy.deepcopy(densenet)
+        start = time.time()
+        compiled = compile_model(copy.deepcopy(densenet), images, train=True, mode=args.compile_mode)
+        compile_sec = time.time() - start
+        eager_ms = time_train(eager_model, images, labels, args.iterations)
+        compiled_ms = time_train(compiled, images, labels, args.iterations)
+        print('%-28s %-10s %12.1f %12.1f %12.1f %7.2fx' % ('DensenetClass', 'train step', compile_sec, eager_ms,
+                                                            compiled_ms, eager_ms / compiled_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# coding: utf-8
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from src.models.networks_bestfitting.densenet import class_densenet121_large_dropout
+from src.models.encodings_pretrained import BestfittingLogitsEncodingsModel, BestfittingRoiLogitsEncodingsModel
+from src.data.utils import get_cells_from_img, get_img_with_cell_masks
+from src.data.tta import get_cell_views_tensor, get_image_views_tensor, TTA_VIEWS
+from src.predict.cell_batching import predict_cells_batched
+from src.benchmarks.cell_output_agreement import agreement_metrics, format_metrics
+
+# Accuracy vs. speed of the cell inference modes of predict_cells_from_image_level_densenet: a forward over the
+# tiled crop of every cell (4 TTA views, batched) vs. --roi-pooling, one forward per whole image and view with the
+# encoder5 features pooled inside the cell masks. The crop outputs are the reference.
+# On random weights and synthetic images on the CPU:
+# python -m src.benchmarks.roi_cell_inference --img_size 512 --num-images 2 --num-threads 8
+# With a fold model on real images (--img_size 1024 as in the predictor):
+# python -m src.benchmarks.roi_cell_inference --img_size 1024 --checkpoint <model dir>/fold0/final.pth \
+#     --img-paths input/hpa-single-cell-image-classification/train/<img id> ...
+
+parser = argparse.ArgumentParser(description='Crop-based vs. ROI-pooled cell inference of the image-level DenseNet')
+parser.add_argument('--img_size', default=512, type=int, help='image size and size of the tiled cell images')
+parser.add_argument('--in_channels', default=4, type=int)
+parser.add_argument('--num-images', default=2, type=int, help='synthetic images, ignored with --img-paths')
+parser.add_argument('--cells-per-image', default=20, type=int)
+parser.add_argument('--img-paths', nargs='+', default=None, type=str)
+parser.add_argument('--checkpoint', default=None, type=str, help='final.pth of a fold model (default: random weights)')
+parser.add_argument('--cell-batch-size', default=32, type=int)
+parser.add_argument('--roi-views', nargs='+', default=list(TTA_VIEWS), choices=TTA_VIEWS)
+parser.add_argument('--roi-mask-size', default=128, type=int)
+parser.add_argument('--num-threads', default=None, type=int)
+
+
+def make_synthetic_images(args):
+    """(img, cell masks, cell crops) with elliptic cells inside random boxes, the crops masked and cut as in
+    get_cells_from_img."""
+    rng = np.random.RandomState(0)
+    images = []
+    for _ in range(args.num_images):
+        img = cv2.GaussianBlur(rng.randint(0, 256, size=(args.img_size, args.img_size, args.in_channels))
+                               .astype(np.uint8), (9, 9), 0)
+        cell_masks, cells = [], []
+        for _ in range(args.cells_per_image):
+            height, width = rng.randint(args.img_size // 10, args.img_size // 4, size=2)
+            y_min, x_min = rng.randint(0, args.img_size - height), rng.randint(0, args.img_size - width)
+            mask = np.zeros((args.img_size, args.img_size), dtype=np.uint8)
+            cv2.ellipse(mask, (int(x_min + width // 2), int(y_min + height // 2)), (int(width // 2), int(height // 2)),
+                        0, 0, 360, 1, -1)
+            cell = img[y_min:y_min + height, x_min:x_min + width] * mask[y_min:y_min + height, x_min:x_min + width,
+                                                                         None]
+            cells.append(cell)
+            cell_masks.append(cv2.resize(mask.astype(np.float32), (args.roi_mask_size, args.roi_mask_size),
+                                         interpolation=cv2.INTER_AREA))
+        images.append((img, np.stack(cell_masks), cells))
+    return images
+
+
+def load_images(args):
+    images = []
+    for base_path in args.img_paths:
+        img, cell_masks = get_img_with_cell_masks(base_path, target_img_size=args.img_size,
+                                                  mask_size=args.roi_mask_size)
+        cells = list(get_cells_from_img(base_path, return_raw=True, target_img_size=args.img_size))
+        images.append((img, cell_masks, cells))
+    return images
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    model = class_densenet121_large_dropout(num_classes=19, in_channels=args.in_channels, pretrained_file=None)
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu')['state_dict'])
+    model.eval()
+    crop_model = BestfittingLogitsEncodingsModel(model)
+    roi_model = BestfittingRoiLogitsEncodingsModel(model)
+    images = load_images(args) if args.img_paths is not None else make_synthetic_images(args)
+    num_cells = sum(len(cells) for _, _, cells in images)
+
+    def predict_fn(batch):
+        with torch.no_grad():
+            logits, embs = crop_model(batch)
+            return torch.sigmoid(logits).numpy(), embs.numpy()
+
+    def crop_cells():
+        for img_i, (_, _, cells) in enumerate(images):
+            yield img_i, (get_cell_views_tensor(cell, height=args.img_size, width=args.img_size) for cell in cells)
+
+    def roi_predict(img, cell_masks):
+        img_views, mask_views = get_image_views_tensor(img, cell_masks, views=args.roi_views)
+        with torch.no_grad():
+            logits, embs = roi_model(img_views, mask_views)
+            return torch.sigmoid(logits).mean(dim=0).numpy(), embs.mean(dim=0).numpy()
+
+    # warm-up
+    roi_predict(*images[0][:2])
+
+    start = time.time()
+    crop_outputs = dict(predict_cells_batched(crop_cells(), predict_fn, args.cell_batch_size, concat=torch.cat))
+    crop_sec = time.time() - start
+    start = time.time()
+    roi_outputs = {img_i: roi_predict(img, cell_masks) for img_i, (img, cell_masks, _) in enumerate(images)}
+    roi_sec = time.time() - start
+
+    crop_preds = np.concatenate([crop_outputs[img_i][0] for img_i in range(len(images))])
+    crop_embs = np.concatenate([crop_outputs[img_i][1] for img_i in range(len(images))])
+    roi_preds = np.concatenate([roi_outputs[img_i][0] for img_i in range(len(images))])
+    roi_embs = np.concatenate([roi_outputs[img_i][1] for img_i in range(len(images))])
+
+    print('%-26s %10s %10s %9s' % ('mode', 'sec', 'cells/s', 'speedup'))
+    print('%-26s %10.1f %10.2f %8.2fx' % ('crops (4 views)', crop_sec, num_cells / crop_sec, 1.0))
+    print('%-26s %10.1f %10.2f %8.2fx' % ('roi pooling (%d views)' % len(args.roi_views), roi_sec,
+                                          num_cells / roi_sec, crop_sec / roi_sec))
+    print('roi vs. crops, %s' % format_metrics(agreement_metrics(crop_preds, crop_embs, roi_preds, roi_embs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# coding: utf-8
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.sampler import SequentialSampler
+from sklearn.metrics import average_precision_score
+
+from src.commons.config.config_bestfitting import RESULT_DIR
+from src.models.networks_bestfitting.imageclsnet import init_network
+from src.data.datasets import ProteinDatasetCellSeparateLoading
+from src.train.train_cellwise import get_cell_training_data
+
+# Speed/mAP trade-off of cell classifiers on the validation cells of a fold, e.g. the DenseNet teacher
+# against distilled students trained at several input sizes:
+# python -m src.benchmarks.student_speed_vs_map --fold 0 \
+#   --models class_densenet121_dropout:512:output/models/densenet121_cellwise/fold0/final.pth \
+#            class_efficientnet_dropout:224:output/models/efficientnet_b0_distilled_224/fold0/final.pth \
+#            class_efficientnet_dropout:384:output/models/efficientnet_b0_distilled_384/fold0/final.pth \
+#            class_efficientnet_dropout:512:output/models/efficientnet_b0_distilled_512/fold0/final.pth
+# mAP is computed against the binarized stored teacher outputs, as in the validation of train_cellwise.
+
+parser = argparse.ArgumentParser(description='Latency and mAP of cell classifiers')
+parser.add_argument('--models', nargs='+', required=True, help='arch:img_size:checkpoint triples')
+parser.add_argument('--effnet-encoder', default='efficientnet-b0', type=str)
+parser.add_argument('--num_classes', default=19, type=int)
+parser.add_argument('--in_channels', default=4, type=int)
+parser.add_argument('--fold', default=0, type=int)
+parser.add_argument('--cell-level-labels-path', default='output/densenet121_pred.h5', type=str)
+parser.add_argument('--cell-img-size', default=512, type=int, help='size of the loaded cell crops (default: 512)')
+parser.add_argument('--max-cells', default=5000, type=int, help='number of validation cells to score (default: 5000)')
+parser.add_argument('--batch_size', default=64, type=int)
+parser.add_argument('--workers', default=4, type=int)
+parser.add_argument('--device', default='cuda', type=str)
+parser.add_argument('--out-fpath', default=os.path.join(RESULT_DIR, 'logs', 'student_speed_vs_map.csv'), type=str)
+
+
+def load_model(arch, img_size, checkpoint_path, args):
+    model_params = {}
+    model_params['architecture'] = arch
+    model_params['num_classes'] = args.num_classes
+    model_params['in_channels'] = args.in_channels
+    if 'efficientnet' in arch:
+        model_params['image_size'] = img_size
+        model_params['encoder'] = args.effnet_encoder
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model_params['pruned_config'] = checkpoint.get('pruned_config')
+    model = init_network(model_params)
+    model.load_state_dict(checkpoint['state_dict'])
+    model.to(args.device)
+    model.eval()
+    return model
+
+
+def evaluate(model, img_size, loader, device):
+    probs_list, labels_list = [], []
+    forward_sec = 0
+    num_cells = 0
+    with torch.no_grad():
+        for images, labels, _ in loader:
+            images = images.to(device)
+            if img_size is not None and images.shape[-1] != img_size:
+                images = F.interpolate(images, size=(img_size, img_size), mode='bilinear', align_corners=False)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.time()
+            logits = model(images)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            forward_sec += time.time() - start
+            num_cells += len(images)
+            probs_list.append(torch.sigmoid(logits).cpu().numpy())
+            labels_list.append(np.asarray(labels))
+    probs = np.concatenate(probs_list)
+    y_true = np.concatenate(labels_list)
+    map_scores = average_precision_score((y_true > 0.5).astype(np.float32), probs, average=None)
+    return np.nanmean(map_scores), 1000 * forward_sec / num_cells, num_cells / forward_sec
+
+
+def build_valid_cell_loader(args):
+    """A fixed random subset of --max-cells validation cells of the fold, crops of --cell-img-size."""
+    args.include_nn_mitotic, args.upsample_minorities, args.ignore_negative = False, False, False
+    _, val_img_paths, basepath_2_ohe_vector, labels_df, _ = get_cell_training_data(args)
+    valid_dataset = ProteinDatasetCellSeparateLoading(val_img_paths,
+                                                      labels_df=labels_df,
+                                                      in_channels=args.in_channels,
+                                                      basepath_2_ohe=basepath_2_ohe_vector)
+    valid_dataset.set_img_size(args.cell_img_size)
+    indices = np.random.RandomState(0).permutation(len(valid_dataset))[:args.max_cells]
+    valid_dataset = Subset(valid_dataset, sorted(indices))
+    loader = DataLoader(valid_dataset, sampler=SequentialSampler(valid_dataset), batch_size=args.batch_size,
+                        num_workers=args.workers, pin_memory=True)
+    return loader
+
+
+def main():
+    args = parser.parse_args()
+    args.device = torch.device(args.device)
+    loader = build_valid_cell_loader(args)
+
+    rows = []
+    print('%-30s %6s %10s %10s %10s %8s' % ('arch', 'size', 'params(M)', 'ms/cell', 'cells/s', 'mAP'))
+    for spec in args.models:
+        arch, img_size, checkpoint_path = spec.split(':', 2)
+        img_size = int(img_size)
+        model = load_model(arch, img_size, checkpoint_path, args)
+        num_params = sum(p.numel() for p in model.parameters()) / 1e6
+        # one pass to warm up cudnn autotuning and allocations, then the measured pass
+        evaluate(model, img_size, [next(iter(loader))], args.device)
+        map_score, ms_per_cell, cells_per_sec = evaluate(model, img_size, loader, args.device)
+        print('%-30s %6d %10.1f %10.2f %10.1f %8.4f' % (arch, img_size, num_params, ms_per_cell, cells_per_sec,
+                                                        map_score))
+        rows.append({'arch': arch, 'img_size': img_size, 'checkpoint': checkpoint_path, 'params_m': num_params,
+                     'ms_per_cell': ms_per_cell, 'cells_per_sec': cells_per_sec, 'map': map_score,
+                     'device': str(args.device), 'batch_size': args.batch_size})
+        del model
+
+    out_dir = os.path.dirname(args.out_fpath)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    pd.DataFrame(rows).to_csv(args.out_fpath, index=False)
+    print(f'Results written to {args.out_fpath}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# coding: utf-8
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+
+from ..models.networks_bestfitting.densenet import class_densenet121_dropout
+from ..models.layers_bestfitting.scheduler import Adam10
+from ..train.engine import Trainer, AverageMeter
+from src.commons.utils import Logger
+
+# Compares the per-script training loop used before the shared engine with Trainer.train_epoch
+# on synthetic cell crops, so that the numbers do not depend on the disk or on the bbox pickles.
+
+parser = argparse.ArgumentParser(description='Training loop throughput: legacy loop vs. shared engine')
+parser.add_argument('--img_size', default=512, type=int)
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--num-batches', default=50, type=int)
+parser.add_argument('--workers', default=4, type=int)
+parser.add_argument('--gradient-accumulation-steps', default=4, type=int)
+parser.add_argument('--decode-ms', default=0.0, type=float,
+                    help='simulated per-sample decode/augment time in the workers (default: 0)')
+parser.add_argument('--repeats', default=2, type=int)
+
+
+class SyntheticCellDataset(Dataset):
+    def __init__(self, num_samples, img_size, in_channels=4, num_classes=19, decode_ms=0.0):
+        self.num_samples = num_samples
+        self.img_size = img_size
+        self.in_channels = in_channels
+        self.num_classes = num_classes
+        self.decode_ms = decode_ms
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        rng = np.random.RandomState(index)
+        if self.decode_ms > 0:
+            time.sleep(self.decode_ms / 1000)
+        image = rng.randint(0, 255, (self.in_channels, self.img_size, self.img_size), dtype=np.uint8)
+        image = torch.from_numpy(image.astype(np.float32) / 255.)
+        label = torch.from_numpy(rng.rand(self.num_classes).astype(np.float32))
+        return image, label, index
+
+
+def compute_loss(criterion, outputs, labels, epoch):
+    return criterion(outputs, labels)
+
+
+def legacy_train(train_loader, model, criterion, optimizer, agg_steps):
+    # the loop as it was duplicated in the three training scripts
+    losses = AverageMeter()
+    model.train()
+    optimizer.zero_grad()
+    for iter, (images, labels, indices) in enumerate(train_loader, 0):
+        images = images.cuda()
+        labels = labels.cuda()
+        outputs = model(images)
+        loss = criterion(outputs, labels)
+        losses.update(loss.item())
+        loss.backward()
+        if iter % agg_steps == 0:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
+            optimizer.step()
+            optimizer.zero_grad()
+        probs = F.sigmoid(outputs)
+        acc = ((probs > 0.5) == (labels > 0.5)).float().mean()
+        print('\r%5d  %0.4f  %0.4f' % (iter + 1, losses.avg, acc.item()), end='', flush=True)
+    return losses.avg
+
+
+def timed(fn, num_samples):
+    torch.cuda.synchronize()
+    start = time.time()
+    fn()
+    torch.cuda.synchronize()
+    elapsed = time.time() - start
+    return num_samples / elapsed
+
+
+def main():
+    args = parser.parse_args()
+    if not torch.cuda.is_available():
+        raise RuntimeError('the throughput benchmark needs a CUDA device')
+    torch.backends.cudnn.benchmark = True
+
+    model = class_densenet121_dropout(num_classes=19, in_channels=4, pretrained_file=None).cuda()
+    criterion = nn.BCEWithLogitsLoss().cuda()
+    scheduler = Adam10()
+    optimizer = scheduler.schedule(model, 1, 1)[0]
+
+    num_samples = args.batch_size * args.num_batches
+    dataset = SyntheticCellDataset(num_samples, args.img_size, decode_ms=args.decode_ms)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+                        num_workers=args.workers, pin_memory=True)
+
+    log = Logger()
+    trainer = Trainer(model, criterion, optimizer, scheduler, None, log, compute_loss=compute_loss,
+                      agg_steps=args.gradient_accumulation_steps,
+                      batch_metric=lambda probs, labels: ((probs > 0.5) == (labels > 0.5)).float().mean())
+
+    # warm-up, cudnn autotuning and worker start-up are not part of the measurement
+    legacy_train(loader, model, criterion, optimizer, args.gradient_accumulation_steps)
+
+    results = {'legacy loop': [], 'engine': []}
+    for _ in range(args.repeats):
+        results['legacy loop'].append(timed(
+            lambda: legacy_train(loader, model, criterion, optimizer, args.gradient_accumulation_steps), num_samples))
+        results['engine'].append(timed(lambda: trainer.train_epoch(loader, 1, scheduler._lr), num_samples))
+
+    print('\n\nimg_size %d, batch_size %d, %d batches, %d workers, decode %.1f ms/sample' %
+          (args.img_size, args.batch_size, args.num_batches, args.workers, args.decode_ms))
+    baseline = np.median(results['legacy loop'])
+    for name, values in results.items():
+        print('%-12s %8.1f samples/s  (x%.2f)' % (name, np.median(values), np.median(values) / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import os
+import copy
+
+import torch
+
+# --compile support for the trainers and predictors. torch.compile is tried first, compiled kernels are
+# cached under output/compile_cache so later runs skip most of the compilation. Models used for inference
+# fall back to a frozen TorchScript trace, if neither works the eager model is returned unchanged.
+
+COMPILE_CACHE_DIR = 'output/compile_cache'
+
+
+def _write(log, message):
+    if log is not None:
+        log.write(message)
+    else:
+        print(message, end='')
+
+
+def enable_compile_cache(cache_dir=COMPILE_CACHE_DIR):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # read by inductor when its config is imported, i.e. before the first compilation
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+
+
+def _warm_up(model, example_input, train):
+    """Runs one step so that compilation errors surface here and not inside the training loop. Weights and
+    BN statistics are restored afterwards."""
+    state_dict = copy.deepcopy(model.state_dict())
+    was_training = model.training
+    try:
+        if train:
+            model.train()
+            model(example_input.clone()).float().sum().backward()
+        else:
+            model.eval()
+            with torch.no_grad():
+                model(example_input.clone())
+    finally:
+        for param in model.parameters():
+            param.grad = None
+        model.load_state_dict(state_dict)
+        model.train(was_training)
+
+
+def compile_model(model, example_input, train=False, mode=None, cache_dir=COMPILE_CACHE_DIR, log=None):
+    """Returns the compiled model, a frozen TorchScript module (inference only) or the model itself.
+    `example_input` is a batch of the shape the model will see, other shapes trigger a recompilation."""
+    enable_compile_cache(cache_dir)
+    if hasattr(torch, 'compile'):
+        try:
+            compiled = torch.compile(model, mode=mode)
+            _warm_up(compiled, example_input, train)
+            _write(log, '>> Model compiled with torch.compile (mode: %s)\n' % (mode or 'default'))
+            return compiled
+        except Exception as e:
+            _write(log, '>> torch.compile failed, %s: %s\n' % (type(e).__name__, str(e).split('\n')[0]))
+
+    if not train:
+        try:
+            was_training = model.training
+            model.eval()
+            with torch.no_grad():
+                traced = torch.jit.trace(model, example_input.clone())
+                frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+                frozen(example_input.clone())
+            _write(log, '>> Model traced and frozen with TorchScript\n')
+            return frozen
+        except Exception as e:
+            model.train(was_training)
+            _write(log, '>> TorchScript tracing failed, %s: %s\n' % (type(e).__name__, str(e).split('\n')[0]))
+
+    _write(log, '>> Running the model in eager mode\n')
+    return model
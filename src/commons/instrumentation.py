@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import glob
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+# Stage-level timers and counters shared by datasets, DataLoader workers and training/prediction loops.
+# Disabled by default: `timer()` then returns a shared no-op context manager and `count()` returns immediately.
+# Workers inherit the spool directory through the environment and dump their stats to per-process files
+# which the main process merges when an epoch summary is written.
+
+SPOOL_DIR_ENV = 'HPA_INSTRUMENT_SPOOL'
+FLUSH_INTERVAL_SEC = 5.0
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _StageTimer(object):
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageRegistry(object):
+    def __init__(self):
+        self.enabled = False
+        self.spool_dir = None
+        self.is_worker = False
+        self.export_path = None
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self.reset()
+
+    def reset(self):
+        self.timers = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(int)
+
+    def enable(self, export_path, spool_dir=None):
+        self.enabled = True
+        self.export_path = export_path
+        if spool_dir is None:
+            spool_dir = os.path.join(os.path.dirname(export_path), '.instrument_spool')
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        self.spool_dir = spool_dir
+        for path in glob.glob(os.path.join(spool_dir, '*.json')):
+            os.remove(path)
+        os.environ[SPOOL_DIR_ENV] = spool_dir
+
+    def enable_in_worker(self):
+        spool_dir = os.environ.get(SPOOL_DIR_ENV)
+        if spool_dir is None:
+            return
+        # a forked worker inherits the parent's numbers, they must not be reported twice
+        self._lock = threading.Lock()
+        self.reset()
+        self.enabled = True
+        self.is_worker = True
+        self.spool_dir = spool_dir
+        from multiprocessing.util import Finalize
+        Finalize(self, self.flush, exitpriority=10)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            stat = self.timers[name]
+            stat[0] += 1
+            stat[1] += seconds
+        if self.is_worker:
+            self._maybe_flush()
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counters[name] += value
+        if self.is_worker:
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.time() - self._last_flush > FLUSH_INTERVAL_SEC:
+            self.flush()
+
+    def flush(self):
+        if not self.is_worker or self.spool_dir is None:
+            return
+        with self._lock:
+            payload = {'timers': dict(self.timers), 'counters': dict(self.counters)}
+            self.reset()
+            self._last_flush = time.time()
+        if not payload['timers'] and not payload['counters']:
+            return
+        spool_path = os.path.join(self.spool_dir, f'{os.getpid()}_{time.time_ns()}.json')
+        with open(spool_path + '.tmp', 'w') as f:
+            json.dump(payload, f)
+        os.replace(spool_path + '.tmp', spool_path)
+
+    def collect(self):
+        timers = defaultdict(lambda: [0, 0.0])
+        counters = defaultdict(int)
+        with self._lock:
+            for name, (count, total) in self.timers.items():
+                timers[name][0] += count
+                timers[name][1] += total
+            for name, value in self.counters.items():
+                counters[name] += value
+            self.reset()
+        num_worker_files = 0
+        if self.spool_dir is not None:
+            for path in glob.glob(os.path.join(self.spool_dir, '*.json')):
+                try:
+                    with open(path) as f:
+                        payload = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                os.remove(path)
+                num_worker_files += 1
+                for name, (count, total) in payload['timers'].items():
+                    timers[name][0] += count
+                    timers[name][1] += total
+                for name, value in payload['counters'].items():
+                    counters[name] += value
+        return timers, counters, num_worker_files
+
+
+REGISTRY = StageRegistry()
+
+
+def is_enabled():
+    return REGISTRY.enabled
+
+
+def timer(name):
+    if not REGISTRY.enabled:
+        return _NULL_TIMER
+    return _StageTimer(REGISTRY, name)
+
+
+def count(name, value=1):
+    if REGISTRY.enabled:
+        REGISTRY.add_count(name, value)
+
+
+def add_time(name, seconds):
+    if REGISTRY.enabled:
+        REGISTRY.add_time(name, seconds)
+
+
+@contextmanager
+def cuda_synchronized_timer(name, device_is_cuda=True):
+    # forward/backward are asynchronous on GPU, the stage boundary has to wait for the kernels
+    if not REGISTRY.enabled:
+        yield
+        return
+    import torch
+    if device_is_cuda and torch.cuda.is_available():
+        torch.cuda.synchronize()
+    with _StageTimer(REGISTRY, name):
+        yield
+        if device_is_cuda and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+
+def enable(export_path, spool_dir=None):
+    REGISTRY.enable(export_path, spool_dir=spool_dir)
+
+
+def worker_init_fn(worker_id):
+    REGISTRY.enable_in_worker()
+
+
+def write_epoch_summary(epoch, wall_time, num_images=None, num_cells=None, phase='train', extra=None):
+    if not REGISTRY.enabled:
+        return None
+    timers, counters, num_worker_files = REGISTRY.collect()
+    if num_images is None:
+        num_images = counters.get('images', 0)
+    if num_cells is None:
+        num_cells = counters.get('cells', 0)
+    summary = {
+        'epoch': epoch,
+        'phase': phase,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'wall_time_sec': wall_time,
+        'images': num_images,
+        'cells': num_cells,
+        'images_per_sec': num_images / wall_time if wall_time > 0 else None,
+        'cells_per_sec': num_cells / wall_time if wall_time > 0 else None,
+        'worker_spool_files': num_worker_files,
+        'timers': {name: {'count': count_, 'total_sec': total, 'mean_ms': 1000 * total / max(count_, 1)}
+                   for name, (count_, total) in sorted(timers.items())},
+        'counters': dict(sorted(counters.items())),
+    }
+    if extra is not None:
+        summary.update(extra)
+    with open(REGISTRY.export_path, 'a') as f:
+        f.write(json.dumps(summary) + '\n')
+    return summary
+
+
+def format_summary(summary):
+    if summary is None:
+        return ''
+    lines = [f">> stage timings ({summary['phase']}, epoch {summary['epoch']}): "
+             f"{summary['wall_time_sec']:.1f} sec, "
+             f"{summary['images_per_sec'] or 0:.2f} images/s, {summary['cells_per_sec'] or 0:.2f} cells/s\n"]
+    for name, stat in summary['timers'].items():
+        lines.append(f"   {name:<24s} {stat['total_sec']:10.2f} sec  {stat['count']:8d} calls  {stat['mean_ms']:9.2f} ms/call\n")
+    return ''.join(lines)
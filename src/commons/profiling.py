@@ -0,0 +1,101 @@
+import os
+import signal
+import time
+
+
+# On-demand torch.profiler capture for a window of training/inference steps.
+# The window is either given up-front as `start:end` (global step numbers, end exclusive)
+# or armed at runtime by sending SIGUSR1 to the process, e.g. `kill -USR1 <pid>`.
+
+
+def parse_profile_steps(steps):
+    if steps is None:
+        return None
+    try:
+        start, end = [int(x) for x in steps.split(':')]
+    except ValueError:
+        raise ValueError(f"--profile-steps must look like 'start:end', got '{steps}'")
+    if end <= start or start < 0:
+        raise ValueError(f"--profile-steps requires 0 <= start < end, got '{steps}'")
+    return start, end
+
+
+class ProfileWindow(object):
+    def __init__(self, out_dir, steps=None, on_signal=False, signal_steps=20, row_limit=25, log=None):
+        self.out_dir = out_dir
+        self.window = parse_profile_steps(steps)
+        self.signal_steps = signal_steps
+        self.row_limit = row_limit
+        self.log = log
+        self.global_step = 0
+        self.profiler = None
+        self.stop_at_step = None
+        self.signal_armed = False
+        self.enabled = self.window is not None or on_signal
+
+        if on_signal:
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, self._arm_from_signal)
+                self._write(f'>> Profiler: send SIGUSR1 to pid {os.getpid()} to capture {signal_steps} steps\n')
+            else:
+                self._write('>> Profiler: SIGUSR1 is not available on this platform, signal trigger is ignored\n')
+
+    def _write(self, message):
+        if self.log is not None:
+            self.log.write(message)
+        else:
+            print(message, end='')
+
+    def _arm_from_signal(self, signum, frame):
+        # only a flag is set here, the profiler itself is started from the training loop
+        self.signal_armed = True
+
+    def step(self):
+        if not self.enabled:
+            return
+        if self.profiler is not None and self.global_step >= self.stop_at_step:
+            self._stop()
+
+        if self.profiler is None:
+            if self.window is not None and self.global_step == self.window[0]:
+                self._start(self.window[1])
+            elif self.signal_armed:
+                self.signal_armed = False
+                self._start(self.global_step + self.signal_steps)
+        self.global_step += 1
+
+    def _start(self, stop_at_step):
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True)
+        self.profiler.start()
+        self.start_step = self.global_step
+        self.stop_at_step = stop_at_step
+        self._write(f'>> Profiler: capturing steps {self.start_step}:{self.stop_at_step}\n')
+
+    def _stop(self):
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.profiler.stop()
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        trace_path = os.path.join(self.out_dir, f'trace_steps_{self.start_step}_{self.global_step}_'
+                                                f'{time.strftime("%Y%m%d_%H%M%S")}.json')
+        self.profiler.export_chrome_trace(trace_path)
+
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        table = self.profiler.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        self._write(f'>> Profiler: chrome trace stored to {trace_path}\n')
+        self._write(f'>> Profiler: top ops by {sort_by}\n{table}\n')
+        self.profiler = None
+        self.stop_at_step = None
+
+    def close(self):
+        if self.profiler is not None:
+            self._stop()
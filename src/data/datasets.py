@@ -11,7 +11,9 @@ seed(10)
 import numpy as np
 from torch.utils.data.sampler import Sampler
 from random import sample, shuffle
-from .utils import get_cells_from_img, get_cell_img, get_cell_img_with_mask, get_cell_img_mitotic
+from .utils import get_cells_from_img, get_num_cells, get_cell_bboxes, get_cell_native_sizes, get_cell_img, get_cell_img_with_mask, get_cell_img_mitotic, \
+    get_cell_img_with_context, PYRAMID_COMPLETE_MARKER
+from ..commons import instrumentation
 from multiprocessing import Pool, cpu_count
 import pandas as pd
 from sklearn.metrics import normalized_mutual_info_score
@@ -194,6 +196,7 @@ class ProteinDatasetImageLevel(Dataset):
         self.transform = transform
         self.crop_size = crop_size
         self.random_crop = random_crop
+        self.pyramid_dir_exists = {}
 
         self.img_paths = img_paths
         if is_trainset:
@@ -260,7 +263,9 @@ class ProteinDatasetImageLevel(Dataset):
         selected_cells_df = self.cherrypicked_aggresome_df if is_aggresome else self.cherrypicked_mitotic_spindle_df
         indices_of_selected_cells = self.indices_of_aggresome_cells if is_aggresome else self.indices_of_mitotic_cells
 
-        img_rgby_height, img_rgby_width = self.img_size, self.img_size
+        # tiled samples are batched together with the crops when cropping
+        tile_size = self.crop_size if self.crop_size > 0 else self.img_size
+        img_rgby_height, img_rgby_width = tile_size, tile_size
 
         sampling_weights = selected_cells_df['sampling_weight']
         mitotic_cell_idx = choices(indices_of_selected_cells, weights=sampling_weights, k=1)[0]
@@ -287,12 +292,65 @@ class ProteinDatasetImageLevel(Dataset):
         img_path = self.img_paths[index]
 
         img_id = os.path.basename(img_path)
-        img = [cv2.resize(cv2.imread(f'{img_path}_{color}.png', cv2.IMREAD_GRAYSCALE), (self.img_size, self.img_size))
-               for color in colors]
-        img_rgby = np.stack(img, axis=-1)
-        label = self.basepath_2_ohe[img_path]
+        with instrumentation.timer('decode'):
+            if self.crop_size > 0:
+                img = self.read_cell_crop(img_path, colors)
+            else:
+                read_path = self.get_pyramid_path(img_path)
+                img = [cv2.resize(cv2.imread(f'{read_path}_{color}.png', cv2.IMREAD_GRAYSCALE), (self.img_size, self.img_size))
+                       for color in colors]
+            img_rgby = np.stack(img, axis=-1)
+        label = self.get_label(index)
         return img_rgby, label, img_id
 
+    def read_cell_crop(self, img_path, colors):
+        """crop_size x crop_size window of the image at the img_size scale, placed so that it contains at least
+        one whole cell. The window is cut from the raw image, in whose coordinates the cell bboxes are stored,
+        and only the window is resized."""
+        img = [cv2.imread(f'{img_path}_{color}.png', cv2.IMREAD_GRAYSCALE) for color in colors]
+        height, width = img[0].shape
+        window = min(int(round(self.crop_size / self.img_size * max(height, width))), height, width)
+        y0, x0 = self.get_crop_origin(img_path, height, width, window)
+        return [cv2.resize(channel[y0:y0 + window, x0:x0 + window], (self.crop_size, self.crop_size))
+                for channel in img]
+
+    def get_crop_origin(self, img_path, height, width, window):
+        bboxes_df = get_cell_bboxes(img_path)
+        cell_heights = bboxes_df['y_max'].astype(int) - bboxes_df['y_min'].astype(int)
+        cell_widths = bboxes_df['x_max'].astype(int) - bboxes_df['x_min'].astype(int)
+        fitting = bboxes_df[(cell_heights <= window) & (cell_widths <= window)]
+        if len(fitting) == 0:
+            # no cell fits into the window, fall back to the center of the image
+            return (height - window) // 2, (width - window) // 2
+
+        if self.random_crop:
+            cell = fitting.iloc[np.random.randint(len(fitting))]
+        else:
+            cell = fitting.loc[(cell_heights * cell_widths)[fitting.index].idxmax()]
+        y_min, y_max, x_min, x_max = int(cell['y_min']), int(cell['y_max']), int(cell['x_min']), int(cell['x_max'])
+        y_range = max(0, y_max - window), min(y_min, height - window)
+        x_range = max(0, x_max - window), min(x_min, width - window)
+        if self.random_crop:
+            return np.random.randint(y_range[0], y_range[1] + 1), np.random.randint(x_range[0], x_range[1] + 1)
+        return sum(y_range) // 2, sum(x_range) // 2
+
+    def get_label(self, index):
+        return self.basepath_2_ohe[self.img_paths[index]]
+
+    def set_img_size(self, img_size):
+        self.img_size = img_size
+
+    def get_pyramid_path(self, img_path):
+        # images pre-resized by src.preprocessing.build_image_pyramid live in <images dir>_<img_size>
+        img_dir, img_id = os.path.split(img_path)
+        pyramid_dir = f'{img_dir}_{self.img_size}'
+        if pyramid_dir not in self.pyramid_dir_exists:
+            # an interrupted build leaves the directory without the marker, full resolution is read then
+            self.pyramid_dir_exists[pyramid_dir] = os.path.exists(os.path.join(pyramid_dir, PYRAMID_COMPLETE_MARKER))
+        if self.pyramid_dir_exists[pyramid_dir]:
+            return os.path.join(pyramid_dir, img_id)
+        return img_path
+
     def get_rgby(self, index):
         if not self.mitotic_aggresome_balancing:
             return self.read_rgby(index)
@@ -343,12 +401,15 @@ class ProteinDatasetImageLevel(Dataset):
         image, label, img_id = self.get_rgby(index)
 
         if self.transform is not None:
-            image = self.transform(image)
-        image = image / 255.0
-        image = image.astype(np.float32)
-        if len(image.shape) == 3:
-            image = image.transpose((2, 0, 1))
-        image = torch.from_numpy(image)
+            with instrumentation.timer('augment'):
+                image = self.transform(image)
+        with instrumentation.timer('to_tensor'):
+            image = image / 255.0
+            image = image.astype(np.float32)
+            if len(image.shape) == 3:
+                image = image.transpose((2, 0, 1))
+            image = torch.from_numpy(image)
+        instrumentation.count('images')
 
         if self.return_label:
             return image, label, img_id
@@ -394,30 +455,156 @@ class ProteinDatasetCellLevel(Dataset):
         image = torch.from_numpy(image)
         return image
 
+    def cell_counts(self):
+        """Upper bound of the number of cells __getitem__ returns per image, used by PackedCellBatchSampler."""
+        if self.is_trainset:
+            # only labelled cells are returned
+            counts = self.labels_df.groupby(level=0).size()
+            counts = [counts.get(img_path, 0) for img_path in self.img_paths]
+        else:
+            counts = [get_num_cells(img_path) for img_path in self.img_paths]
+        return [min(count, self.batch_size) for count in counts]
+
     def __getitem__(self, index):
         img_basepath = self.img_paths[index]
+        # get_cells_from_img is a generator, it yields (cell, label) pairs when cell labels are given
         if self.is_trainset:
             cell_labels_df = self.labels_df.loc[img_basepath]
-            cell_imgs, cell_labels = get_cells_from_img(img_basepath,
-                                                        cell_img_size=self.img_size, return_raw=False,
-                                                        sample_size=self.batch_size, cell_labels_df=cell_labels_df)
-            cell_labels_np = np.stack(cell_labels)
+            cells = list(get_cells_from_img(img_basepath,
+                                            cell_img_size=self.img_size, return_raw=False,
+                                            sample_size=self.batch_size, cell_labels_df=cell_labels_df))
+            cell_imgs = [img for img, _ in cells]
+            cell_labels = [label for _, label in cells]
         else:
-            cell_imgs = get_cells_from_img(img_basepath,
-                                           cell_img_size=self.img_size, return_raw=False,
-                                           sample_size=self.batch_size)
-
-        cell_imgs = [self.preprocess_image(img) for img in cell_imgs]
-        cell_imgs_np = np.stack(cell_imgs)
+            cell_imgs = list(get_cells_from_img(img_basepath,
+                                                cell_img_size=self.img_size, return_raw=False,
+                                                sample_size=self.batch_size))
+
+        with instrumentation.timer('to_tensor'):
+            cell_imgs = [self.preprocess_image(img) for img in cell_imgs]
+            if len(cell_imgs):
+                cell_imgs = torch.stack(cell_imgs)
+            else:
+                cell_imgs = torch.zeros((0, self.in_channels, self.img_size, self.img_size))
+        instrumentation.count('images')
+        instrumentation.count('cells', len(cell_imgs))
 
         if self.is_trainset:
-            return cell_imgs_np, cell_labels_np, index
-        return cell_imgs_np, index
+            # an empty 1-d label tensor is skipped by torch.cat in PackedCellCollate
+            cell_labels = np.stack(cell_labels) if len(cell_labels) else np.zeros((0,))
+            return cell_imgs, torch.from_numpy(cell_labels.astype(np.float32)), index
+        return cell_imgs, index
 
     def __len__(self):
         return self.num
 
 
+def draw_epoch(sampler):
+    """Indices of one epoch of `sampler`, the balancing samplers draw their subset in __len__."""
+    len(sampler)
+    return [int(idx) for idx in sampler]
+
+
+class EpochPlanSampler(Sampler):
+    """Base of the samplers that fix the order of an epoch up front. build_plan() is called once per epoch,
+    by the first __len__ or __iter__, and again after the plan has been iterated."""
+
+    def __init__(self) -> None:
+        self.plan = None
+        self.iterated = False
+
+    def build_plan(self):
+        raise NotImplementedError
+
+    def plan_epoch(self):
+        self.plan = self.build_plan()
+        self.iterated = False
+
+    def remaining(self):
+        return self.plan
+
+    def __iter__(self):
+        if self.plan is None or self.iterated:
+            self.plan_epoch()
+        self.iterated = True
+        return iter(self.remaining())
+
+    def __len__(self):
+        # the length is fixed when the epoch is planned, e.g. by the subset a balancing base sampler draws
+        if self.plan is None or self.iterated:
+            self.plan_epoch()
+        return len(self.remaining())
+
+
+class PackedCellBatchSampler(EpochPlanSampler):
+    """Batch sampler for ProteinDatasetCellLevel: groups whole images so that the cells of a batch
+    (at most `max_cells`) fill the device, instead of one image with a varying number of cells per step.
+    Used together with PackedCellCollate, which concatenates the cells and records per-image offsets."""
+
+    def __init__(self, cell_counts, max_cells, shuffle=True, drop_empty=True) -> None:
+        super(PackedCellBatchSampler, self).__init__()
+        self.cell_counts = list(cell_counts)
+        self.max_cells = max_cells
+        self.shuffle = shuffle
+        too_large = [count for count in self.cell_counts if count > max_cells]
+        if too_large:
+            raise ValueError(f'{len(too_large)} images have more than max_cells={max_cells} cells, '
+                             f'the dataset batch_size (cells per image) must not exceed max_cells')
+        self.indices = [i for i, count in enumerate(self.cell_counts) if count > 0 or not drop_empty]
+
+    def build_plan(self):
+        indices = list(self.indices)
+        if self.shuffle:
+            shuffle(indices)
+        plan = []
+        batch, batch_cells = [], 0
+        for index in indices:
+            count = self.cell_counts[index]
+            if batch and batch_cells + count > self.max_cells:
+                plan.append(batch)
+                batch, batch_cells = [], 0
+            batch.append(index)
+            batch_cells += count
+        if batch:
+            plan.append(batch)
+        return plan
+
+
+class PackedCellCollate(object):
+    """Collates ProteinDatasetCellLevel items into one cell batch. Returns (cells, labels, offsets, indices),
+    or (cells, offsets, indices) for unlabelled items, the cells of the i-th image are
+    cells[offsets[i]:offsets[i + 1]]. With `pad_to` the batch is padded with zero cells to a fixed size
+    (cudnn autotuning and compiled models see one shape), padded rows start at offsets[-1]."""
+
+    def __init__(self, pad_to=None):
+        self.pad_to = pad_to
+
+    def __call__(self, items):
+        has_labels = len(items[0]) == 3
+        cells = [item[0] for item in items]
+        indices = torch.as_tensor([item[-1] for item in items])
+        counts = torch.as_tensor([len(item_cells) for item_cells in cells])
+        offsets = torch.zeros(len(items) + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(counts, dim=0)
+
+        cells = torch.cat(cells)
+        labels = torch.cat([item[1] for item in items]) if has_labels else None
+        if self.pad_to is not None and len(cells) < self.pad_to:
+            num_pad = self.pad_to - len(cells)
+            cells = torch.cat((cells, cells.new_zeros((num_pad,) + cells.shape[1:])))
+            if labels is not None:
+                labels = torch.cat((labels, labels.new_zeros((num_pad,) + labels.shape[1:])))
+        if has_labels:
+            return cells, labels, offsets, indices
+        return cells, offsets, indices
+
+
+def unpack_cells(values, offsets):
+    """Splits a packed cell batch (e.g. model outputs) into the per-image tensors, padding is dropped."""
+    offsets = offsets.tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 class ProteinDatasetCellSeparateLoading(Dataset):
     def __init__(self,
                  img_paths,
@@ -432,12 +619,15 @@ class ProteinDatasetCellSeparateLoading(Dataset):
                  normalize=False,
                  cells_to_upsample=None,
                  upsampling_factor=10,
-                 target_raw_img_size=None
+                 target_raw_img_size=None,
+                 size_buckets=None
                  ):
         self.img_size = img_size
         self.return_label = return_label
         self.in_channels = in_channels
         self.transform = transform
+        # size of the crops returned by get_cell_img, changed only by set_img_size
+        self.cell_img_size = 512
 
         labeled_id_set = set(labels_df.index.get_level_values(0))
         img_ids = [os.path.basename(img_path) for img_path in img_paths if os.path.basename(img_path) in labeled_id_set]
@@ -461,6 +651,29 @@ class ProteinDatasetCellSeparateLoading(Dataset):
                                                       std=[0.122813, 0.085745, 0.129882, 0.119411])
         self.target_raw_img_size = target_raw_img_size
 
+        # every cell is resized to the smallest bucket size not below its native crop size, not to cell_img_size
+        self.size_buckets = sorted(size_buckets) if size_buckets is not None else None
+        self.cell_buckets = None
+        if self.size_buckets is not None:
+            native_sizes = get_cell_native_sizes({img_id for img_id, _ in self.img_ids_cell},
+                                                 target_raw_img_size=target_raw_img_size)
+            self.native_sizes = np.array([native_sizes[(img_id, int(cell_i))]
+                                          for img_id, cell_i in self.img_ids_cell])
+            self.cell_buckets = np.minimum(np.searchsorted(self.size_buckets, self.native_sizes),
+                                           len(self.size_buckets) - 1)
+
+    def size_bucket_stats(self):
+        """Cells per bucket size and the pixels (~ convolution FLOPs) relative to resizing every cell to cell_img_size."""
+        sizes = np.array([self.get_cell_img_size(i) for i in range(len(self.cell_buckets))])
+        counts = {int(size): int((sizes == size).sum()) for size in np.unique(sizes)}
+        return counts, float((sizes.astype(np.float64) ** 2).sum() / (len(sizes) * self.cell_img_size ** 2))
+
+    def get_cell_img_size(self, index):
+        if self.cell_buckets is None:
+            return self.cell_img_size
+        # set_img_size (e.g. the resolution schedule) caps the bucket sizes
+        return min(self.size_buckets[self.cell_buckets[index]], self.cell_img_size)
+
     def preprocess_image(self, image):
         image = image / 255.0
         if len(image.shape) == 3:
@@ -470,7 +683,7 @@ class ProteinDatasetCellSeparateLoading(Dataset):
             image = self.normalization(image)
         return image
 
-    def __getitem__(self, index):
+    def get_label(self, index):
         img_id, cell_i = self.img_ids_cell[index]
         if self.image_level_labels:
             y = self.img_id_2_ohe_vector[img_id]
@@ -482,10 +695,21 @@ class ProteinDatasetCellSeparateLoading(Dataset):
                 y[random_numbers < y_raw] = 1
             else:
                 y = y_raw
+        return y
+
+    def set_img_size(self, img_size):
+        self.cell_img_size = img_size
+
+    def __getitem__(self, index):
+        img_id, cell_i = self.img_ids_cell[index]
+        y = self.get_label(index)
 
-        cell_img = get_cell_img(img_id, cell_i, aug=self.transform, target_raw_img_size=self.target_raw_img_size)
+        cell_img = get_cell_img(img_id, cell_i, cell_img_size=self.get_cell_img_size(index), aug=self.transform,
+                                target_raw_img_size=self.target_raw_img_size)
 
-        cell_img = self.preprocess_image(cell_img)
+        with instrumentation.timer('to_tensor'):
+            cell_img = self.preprocess_image(cell_img)
+        instrumentation.count('cells')
 
         return cell_img, y, index
 
@@ -493,7 +717,45 @@ class ProteinDatasetCellSeparateLoading(Dataset):
         return self.num
 
 
+class ProteinMultiHeadDatasetCellSeparateLoading(ProteinDatasetCellSeparateLoading):
+    """Cells with the 19 class labels of ProteinDatasetCellSeparateLoading and the mitotic spindle label of
+    ProteinMitoticDatasetCellSeparateLoading in one label vector, the last entry is -1 for cells without a
+    mitotic label. With `context_crop` every item is a (2, C, H, W) stack of the cell crop and the context crop
+    of get_cell_img_mitotic, both cut from one decode of the image."""
+
+    def __init__(self, img_paths, mitotic_id_cell_2_y, context_crop=False, **kwargs):
+        super().__init__(img_paths, **kwargs)
+        self.mitotic_id_cell_2_y = mitotic_id_cell_2_y
+        self.context_crop = context_crop
+        # the context crops are dimmed as in ProteinMitoticDatasetCellSeparateLoading
+        self.integer_intensities = not context_crop
+
+    def get_label(self, index):
+        img_id, cell_i = self.img_ids_cell[index]
+        mitotic_y = self.mitotic_id_cell_2_y.get((str(img_id), int(cell_i)), -1.0)
+        return np.append(np.asarray(super().get_label(index), dtype=np.float32), np.float32(mitotic_y))
+
+    def __getitem__(self, index):
+        if not self.context_crop:
+            return super().__getitem__(index)
+        img_id, cell_i = self.img_ids_cell[index]
+        y = self.get_label(index)
+
+        cell_img, context_img = get_cell_img_with_context(img_id, cell_i, cell_img_size=self.get_cell_img_size(index),
+                                                          aug=self.transform,
+                                                          target_raw_img_size=self.target_raw_img_size)
+
+        with instrumentation.timer('to_tensor'):
+            cell_img = torch.stack((self.preprocess_image(cell_img), self.preprocess_image(context_img)))
+        instrumentation.count('cells')
+
+        return cell_img, y, index
+
+
 class ProteinMitoticDatasetCellSeparateLoading(Dataset):
+    # the surroundings of the cell are divided by 3 in get_cell_img_mitotic, see ValidationStore
+    integer_intensities = False
+
     def __init__(self,
                  img_paths,
                  positive_img_ids_cell,
@@ -530,15 +792,20 @@ class ProteinMitoticDatasetCellSeparateLoading(Dataset):
         image = torch.from_numpy(image.astype(np.float32))
         return image
 
+    def get_label(self, index):
+        img_id, cell_i = self.img_ids_cell[index]
+        return np.array([self.id_cell_2_y[(img_id, cell_i)]], dtype=np.float32)
+
     def __getitem__(self, index):
         img_id, cell_i = self.img_ids_cell[index]
-        y = self.id_cell_2_y[(img_id, cell_i)]
 
         cell_img = get_cell_img_mitotic(img_id, cell_i, aug=self.transform, target_raw_img_size=self.target_raw_img_size)
 
-        cell_img = self.preprocess_image(cell_img)
+        with instrumentation.timer('to_tensor'):
+            cell_img = self.preprocess_image(cell_img)
+        instrumentation.count('cells')
 
-        return cell_img, np.array([y], dtype=np.float32), index
+        return cell_img, self.get_label(index), index
 
     def __len__(self):
         return self.num
@@ -612,3 +879,137 @@ class BalancingSubSampler(Sampler[int]):
     def __len__(self):
         self.prepare_balanced_subset()
         return self.num_samples
+
+
+class CellSizeBucketBatchSampler(EpochPlanSampler):
+    """Batch sampler for datasets with size_buckets: takes the order of `base_sampler` (or the dataset order)
+    and batches cells of the same resolution bucket, so that batches can be stacked and small cells are not
+    upsampled. Batches of the different buckets are interleaved in random order when shuffling."""
+
+    def __init__(self, cell_buckets, batch_size, base_sampler=None, shuffle=True, drop_last=False) -> None:
+        super(CellSizeBucketBatchSampler, self).__init__()
+        self.cell_buckets = np.asarray(cell_buckets)
+        self.batch_size = batch_size
+        self.base_sampler = base_sampler
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def build_plan(self):
+        if self.base_sampler is not None:
+            indices = draw_epoch(self.base_sampler)
+        else:
+            indices = list(range(len(self.cell_buckets)))
+            if self.shuffle:
+                shuffle(indices)
+        pending = {}
+        plan = []
+        for index in indices:
+            bucket = pending.setdefault(self.cell_buckets[index], [])
+            bucket.append(index)
+            if len(bucket) == self.batch_size:
+                plan.append(bucket)
+                pending[self.cell_buckets[index]] = []
+        if not self.drop_last:
+            plan.extend(bucket for bucket in pending.values() if bucket)
+        if self.shuffle:
+            shuffle(plan)
+        return plan
+
+
+class LossAwareSampler(EpochPlanSampler):
+    """Reweights the epoch drawn by a base sampler (RandomSampler or one of the balancing samplers, whose
+    class constraints are kept) with a per-sample loss memory filled from the training outputs:
+    easy samples, i.e. seen samples whose remembered loss is below the `easy_quantile`, are skipped with
+    probability `easy_skip_rate`, and `hard_oversample * len(epoch)` extra draws are taken from the epoch
+    with probabilities proportional to the remembered loss, boosted for rarely seen samples.
+    Samples that have not been seen yet or were skipped `max_skipped_epochs` times in a row are never skipped.
+    The first `warmup_epochs` epochs pass the base sampler through to fill the memory."""
+
+    def __init__(self, base_sampler, num_items, easy_skip_rate=0.5, easy_quantile=0.3, hard_oversample=0.1,
+                 momentum=0.7, under_seen_weight=1.0, warmup_epochs=1, max_skipped_epochs=2) -> None:
+        super(LossAwareSampler, self).__init__()
+        self.base_sampler = base_sampler
+        self.easy_skip_rate = easy_skip_rate
+        self.easy_quantile = easy_quantile
+        self.hard_oversample = hard_oversample
+        self.momentum = momentum
+        self.under_seen_weight = under_seen_weight
+        self.warmup_epochs = warmup_epochs
+        self.max_skipped_epochs = max_skipped_epochs
+
+        self.losses = np.full(num_items, np.nan, dtype=np.float32)
+        self.seen_counts = np.zeros(num_items, dtype=np.int64)
+        self.skipped_epochs = np.zeros(num_items, dtype=np.int64)
+        self.epoch = 0
+        self.last_stats = None
+
+    def update(self, indices, losses):
+        indices = np.asarray(indices, dtype=np.int64)
+        losses = np.asarray(losses, dtype=np.float32)
+        previous = self.losses[indices]
+        self.losses[indices] = np.where(np.isnan(previous), losses,
+                                        self.momentum * previous + (1 - self.momentum) * losses)
+        self.seen_counts[indices] += 1
+
+    def priorities(self, indices):
+        losses = self.losses[indices]
+        seen = ~np.isnan(losses)
+        priorities = np.ones(len(indices), dtype=np.float64)
+        if seen.any():
+            scale = max(float(np.median(losses[seen])), 1e-8)
+            priorities[seen] = losses[seen] / scale
+            # unseen samples get the highest remembered priority
+            priorities[~seen] = priorities[seen].max()
+        return priorities * (1 + self.under_seen_weight / (1 + self.seen_counts[indices]))
+
+    def build_plan(self):
+        self.epoch += 1
+        indices = np.array(draw_epoch(self.base_sampler), dtype=np.int64)
+        if self.epoch <= self.warmup_epochs or len(indices) == 0:
+            self.last_stats = {'base': len(indices), 'skipped': 0, 'oversampled': 0}
+            return indices.tolist()
+
+        losses = self.losses[indices]
+        seen = ~np.isnan(losses)
+        skippable = seen & (self.skipped_epochs[indices] < self.max_skipped_epochs)
+        if seen.any():
+            skippable &= losses <= np.quantile(losses[seen], self.easy_quantile)
+        skip = skippable & (np.random.rand(len(indices)) < self.easy_skip_rate)
+        self.skipped_epochs[indices[skip]] += 1
+        self.skipped_epochs[indices[~skip]] = 0
+        kept = indices[~skip]
+
+        num_extra = int(round(self.hard_oversample * len(indices)))
+        extra = np.zeros(0, dtype=np.int64)
+        if num_extra > 0:
+            priorities = self.priorities(indices)
+            extra = np.random.choice(indices, size=num_extra, replace=True, p=priorities / priorities.sum())
+        plan = np.concatenate((kept, extra))
+        np.random.shuffle(plan)
+        self.last_stats = {'base': len(indices), 'skipped': int(skip.sum()), 'oversampled': num_extra}
+        return plan.tolist()
+
+
+class PlannedSampler(EpochPlanSampler):
+    """Materializes the epoch order of the wrapped sampler so that it can be stored in a step checkpoint
+    and an interrupted epoch can continue from `offset` with exactly the same order."""
+
+    def __init__(self, base_sampler) -> None:
+        super(PlannedSampler, self).__init__()
+        self.base_sampler = base_sampler
+        self.offset = 0
+
+    def build_plan(self):
+        self.offset = 0
+        return draw_epoch(self.base_sampler)
+
+    def state_dict(self):
+        return {'plan': self.plan, 'offset': self.offset}
+
+    def load_state_dict(self, state):
+        self.plan = state['plan']
+        self.offset = state['offset']
+        self.iterated = False
+
+    def remaining(self):
+        return self.plan[self.offset:]
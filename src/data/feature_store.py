@@ -0,0 +1,78 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+# Pooled backbone features of a trained network, computed once per cell and TTA view by
+# src.predict.extract_cell_features. Layout of a store directory:
+#   features.npy  (num cells, num views, num features) memory-mapped array
+#   index.csv     one row per cell: ID, cell_i, is_valid (validation image of the fold)
+#   meta.json     checkpoint, architecture, views and crop settings the features were computed with
+
+FEATURE_STORE_DIR = 'output/feature_store'
+
+
+class FeatureStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.features_fpath = os.path.join(store_dir, 'features.npy')
+        self.index_fpath = os.path.join(store_dir, 'index.csv')
+        self.meta_fpath = os.path.join(store_dir, 'meta.json')
+
+    def is_complete(self):
+        return os.path.exists(self.meta_fpath)
+
+    def create(self, num_cells, num_views, num_features, dtype='float16'):
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        return np.lib.format.open_memmap(self.features_fpath + '.tmp', mode='w+', dtype=dtype,
+                                         shape=(num_cells, num_views, num_features))
+
+    def finalize(self, features_memmap, index_df, meta):
+        features_memmap.flush()
+        os.replace(self.features_fpath + '.tmp', self.features_fpath)
+        index_df.to_csv(self.index_fpath, index=False)
+        # meta.json is written last and marks the store as complete
+        with open(self.meta_fpath, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def load_index(self):
+        return pd.read_csv(self.index_fpath)
+
+    def load_meta(self):
+        with open(self.meta_fpath) as f:
+            return json.load(f)
+
+    def load_features(self):
+        return np.load(self.features_fpath, mmap_mode='r')
+
+
+class CachedFeatureDataset(Dataset):
+    """Serves rows of a feature store with their labels. With view=None a random TTA view is drawn for every
+    sample, which plays the role of the flip/rotation augmentation of image training."""
+
+    def __init__(self, features_fpath, labels, rows, view=None):
+        self.features_fpath = features_fpath
+        self.labels = labels
+        self.rows = rows
+        self.view = view
+        self.features = None
+        self.num = len(rows)
+
+    def __getitem__(self, index):
+        # opened lazily so that every DataLoader worker gets its own memory map
+        if self.features is None:
+            self.features = np.load(self.features_fpath, mmap_mode='r')
+        row = self.rows[index]
+        view = np.random.randint(self.features.shape[1]) if self.view is None else self.view
+        features = np.asarray(self.features[row, view], dtype=np.float32)
+        return torch.from_numpy(features), self.labels[row], index
+
+    def get_label(self, index):
+        return self.labels[self.rows[index]]
+
+    def __len__(self):
+        return self.num
@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import time
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from .utils import get_class_names
+
+# Sparse overrides of the cell-level soft labels (the image_level_pred column of the labels hdf): every patch is
+# a table of (ID, cell_i, class_name, value) rows, cell_i 0-based. Patches are applied in the given order, later
+# rows win, and all of them together in a single scatter into the (num cells, num classes) label matrix.
+# Patches are stored versioned, a new version never overwrites an older one:
+#   input/label_patches/<name>/v<version>.csv   the patch rows
+#   input/label_patches/<name>/v<version>.json  source and settings the patch was built from
+# Build one, e.g. from a denoising run:
+#   python -m src.data.label_overrides --name denoising_fold0 --from-denoising output/denoising_0_20210501_120000 \
+#       --labels-path output/densenet121_pred.h5 --min-change 0.3
+
+LABEL_PATCHES_DIR = 'input/label_patches'
+PATCH_COLUMNS = ['ID', 'cell_i', 'class_name', 'value']
+
+
+def patch_from_cell_list(csv_fpath, class_name, value, one_based=False):
+    """Sets `class_name` to `value` for the cells listed in a csv with ID and cell_i columns,
+    e.g. input/mitotic_pos_nn_added.csv. input/mitotic_cells_selection.csv counts cells from 1."""
+    cells = pd.read_csv(csv_fpath)[['ID', 'cell_i']].drop_duplicates()
+    return pd.DataFrame({'ID': cells['ID'].values,
+                         'cell_i': cells['cell_i'].values - (1 if one_based else 0),
+                         'class_name': class_name,
+                         'value': float(value)})[PATCH_COLUMNS]
+
+
+def patch_from_denoising(output_path, labels_df=None, min_change=0.0, class_names=None):
+    """Patch with the labels of src.denoising.graph_denoising (final_labels.pkl, img_id_mask_i.pkl of `output_path`).
+    With `labels_df` only the entries that differ from its labels by more than `min_change` are kept."""
+    class_names = class_names if class_names is not None else get_class_names()
+    with open(os.path.join(output_path, 'final_labels.pkl'), 'rb') as f:
+        # the last column is the 'nothing there' probability added by the denoising
+        denoised = np.asarray(pickle.load(f))[:, :len(class_names)]
+    with open(os.path.join(output_path, 'img_id_mask_i.pkl'), 'rb') as f:
+        img_ids, cell_indices = map(np.asarray, zip(*pickle.load(f)))
+
+    keep = np.ones(denoised.shape, dtype=bool)
+    if labels_df is not None:
+        rows = labels_df.index.get_indexer(pd.MultiIndex.from_arrays([img_ids, cell_indices]))
+        current = label_matrix(labels_df)[np.maximum(rows, 0)]
+        keep = (rows[:, None] >= 0) & (np.abs(denoised - current) > min_change)
+    cell_rows, class_indices = np.nonzero(keep)
+    return pd.DataFrame({'ID': img_ids[cell_rows],
+                         'cell_i': cell_indices[cell_rows].astype(int),
+                         'class_name': np.asarray(class_names)[class_indices],
+                         'value': denoised[cell_rows, class_indices].astype(float)})[PATCH_COLUMNS]
+
+
+def _versions(name, patches_dir):
+    patch_dir = os.path.join(patches_dir, name)
+    if not os.path.exists(patch_dir):
+        return []
+    return sorted(int(match.group(1)) for match in
+                  (re.match(r'v(\d+)\.csv$', fname) for fname in os.listdir(patch_dir)) if match)
+
+
+def save_patch(patch_df, name, meta=None, patches_dir=LABEL_PATCHES_DIR):
+    """Stores the patch as the next version of `name`, returns the version."""
+    patch_dir = os.path.join(patches_dir, name)
+    if not os.path.exists(patch_dir):
+        os.makedirs(patch_dir)
+    versions = _versions(name, patches_dir)
+    version = versions[-1] + 1 if versions else 1
+    patch_df[PATCH_COLUMNS].to_csv(os.path.join(patch_dir, 'v%d.csv' % version), index=False)
+    meta = dict(meta or {}, name=name, version=version, num_rows=len(patch_df),
+                created=time.strftime('%Y-%m-%d %H:%M:%S'))
+    with open(os.path.join(patch_dir, 'v%d.json' % version), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return version
+
+
+def load_patch(spec, patches_dir=LABEL_PATCHES_DIR):
+    """`spec` is 'name' for the latest version or 'name:version'."""
+    name, _, version = spec.partition(':')
+    versions = _versions(name, patches_dir)
+    if not versions:
+        raise ValueError(f"no label patch '{name}' in {patches_dir}")
+    version = int(version) if version else versions[-1]
+    if version not in versions:
+        raise ValueError(f"label patch '{name}' has no version {version}, available: {versions}")
+    return pd.read_csv(os.path.join(patches_dir, name, 'v%d.csv' % version))
+
+
+def label_matrix(labels_df, column='image_level_pred'):
+    return np.stack(labels_df[column].values)
+
+
+def apply_label_patches(labels_df, patches, column='image_level_pred', class_names=None, log=None):
+    """Returns a copy of labels_df with the patches written into `column` by one vectorized scatter.
+    Rows of cells that are not in labels_df are ignored."""
+    if not patches:
+        return labels_df
+    class_names = class_names if class_names is not None else get_class_names()
+    patch = pd.concat(patches, ignore_index=True)
+    rows = labels_df.index.get_indexer(pd.MultiIndex.from_arrays([patch['ID'].values,
+                                                                  patch['cell_i'].values.astype(int)]))
+    class_indices = pd.Index(class_names).get_indexer(patch['class_name'].values)
+    if (class_indices < 0).any():
+        raise ValueError('unknown classes in label patches: %s' %
+                         ', '.join(sorted(set(patch['class_name'].values[class_indices < 0]))))
+    targets = pd.DataFrame({'row': rows, 'class_i': class_indices, 'value': patch['value'].values})
+    # the order of duplicate indices in a numpy scatter is not defined, the last patch row wins explicitly
+    targets = targets[targets['row'] >= 0].drop_duplicates(['row', 'class_i'], keep='last')
+
+    labels = label_matrix(labels_df, column)
+    labels[targets['row'].values, targets['class_i'].values] = targets['value'].values
+    if log is not None:
+        log.write('>> label patches: %d of %d rows matched, %d labels of %d cells overridden\n' %
+                  ((rows >= 0).sum(), len(patch), len(targets), targets['row'].nunique()))
+
+    labels_df = labels_df.copy()
+    # rows of one matrix instead of separately allocated object arrays
+    labels_df[column] = pd.Series(list(labels), index=labels_df.index, dtype=object)
+    return labels_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a versioned cell label patch')
+    parser.add_argument('--name', required=True, type=str, help=f'patch name, stored under {LABEL_PATCHES_DIR}/<name>')
+    parser.add_argument('--from-cell-list', default=None, type=str, help='csv with ID and cell_i columns')
+    parser.add_argument('--class-name', default='Mitotic spindle', type=str)
+    parser.add_argument('--value', default=1.0, type=float)
+    parser.add_argument('--one-based', action='store_true', help='cell_i of the cell list counts from 1')
+    parser.add_argument('--from-denoising', default=None, type=str, help='output directory of graph_denoising')
+    parser.add_argument('--labels-path', default=None, type=str,
+                        help='labels hdf, keep only denoised labels that differ from it (default: None, keep all)')
+    parser.add_argument('--min-change', default=0.0, type=float)
+    args = parser.parse_args()
+
+    if (args.from_cell_list is None) == (args.from_denoising is None):
+        raise ValueError('exactly one of --from-cell-list and --from-denoising is required')
+    if args.from_cell_list is not None:
+        patch_df = patch_from_cell_list(args.from_cell_list, args.class_name, args.value, one_based=args.one_based)
+        meta = {'source': args.from_cell_list, 'class_name': args.class_name, 'value': args.value,
+                'one_based': args.one_based}
+    else:
+        labels_df = pd.read_hdf(args.labels_path) if args.labels_path is not None else None
+        patch_df = patch_from_denoising(args.from_denoising, labels_df=labels_df, min_change=args.min_change)
+        meta = {'source': args.from_denoising, 'labels_path': args.labels_path, 'min_change': args.min_change}
+    version = save_patch(patch_df, args.name, meta=meta)
+    print(f'>> stored {len(patch_df)} label overrides as {args.name}:{version}')
+
+
+if __name__ == '__main__':
+    main()
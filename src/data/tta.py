@@ -0,0 +1,67 @@
+import numpy as np
+import torch
+
+# Tensor version of get_cell_copied + the TTA stacking of the image-level cell predictor: the uint8 cell crop is
+# moved to the target device once, scaled in float64 as x / 255. and cast to float32 (bitwise the values of the
+# numpy path), and the views are flipped and tiled as tensor ops directly into the (num views, C, H, W) batch.
+# The flip views equal those of VerticalFlip/HorizontalFlip, the 'rot90' view is an exact 90 degree rotation,
+# in contrast to Rotate(limit=(89, 91)) that rotates by a random angle in that range inside the unrotated frame.
+
+TTA_VIEWS = ('identity', 'vflip', 'hflip', 'rot90')
+# side multiple of the native-size cell inputs, the stride of the DenseNet feature map
+NATIVE_SIZE_MULTIPLE = 32
+
+
+def _view(x, view, dims=(0, 1)):
+    """`view` of x along its (rows, cols) `dims`."""
+    if view == 'identity':
+        return x
+    if view == 'vflip':
+        return torch.flip(x, dims=(dims[0],))
+    if view == 'hflip':
+        return torch.flip(x, dims=(dims[1],))
+    if view == 'rot90':
+        # counter-clockwise as the positive angles of albumentations Rotate
+        return torch.rot90(x, k=1, dims=dims)
+    raise ValueError(f'unknown TTA view {view}')
+
+
+def get_cell_views_tensor(cell_img, views=TTA_VIEWS, height=1024, width=1024, device='cpu'):
+    """(len(views), C, height, width) float32 tensor of the cell tiled over the image, one per TTA view."""
+    cell = torch.from_numpy(np.ascontiguousarray(cell_img)).to(device)
+    cell = (cell.double() / 255.).float()
+    out = torch.empty((len(views), cell.shape[2], height, width), dtype=torch.float32, device=device)
+    for i, view in enumerate(views):
+        view_cell = _view(cell, view)
+        cell_height, cell_width = view_cell.shape[:2]
+        tiled = view_cell.repeat(height // cell_height + 1, width // cell_width + 1, 1)[:height, :width]
+        out[i].copy_(tiled.permute(2, 0, 1))
+    return out
+
+
+def native_input_size(cell_shape, multiple=NATIVE_SIZE_MULTIPLE):
+    """Side of the square a cell of `cell_shape` (height, width, ...) is padded to by get_cell_views_native."""
+    return max(-(-max(cell_shape[:2]) // multiple) * multiple, multiple)
+
+
+def get_cell_views_native(cell_img, views=TTA_VIEWS, multiple=NATIVE_SIZE_MULTIPLE, device='cpu'):
+    """(len(views), C, S, S) float32 tensor of the cell at its native size, centered on a zero background of side
+    S = native_input_size(cell_img.shape), instead of tiled over a 1024px image. The square keeps the shape of the
+    rot90 view."""
+    cell = torch.from_numpy(np.ascontiguousarray(cell_img)).to(device)
+    cell = (cell.double() / 255.).float().permute(2, 0, 1)
+    side = native_input_size(cell_img.shape, multiple)
+    top, left = (side - cell.shape[1]) // 2, (side - cell.shape[2]) // 2
+    padded = torch.zeros((cell.shape[0], side, side), dtype=torch.float32, device=device)
+    padded[:, top:top + cell.shape[1], left:left + cell.shape[2]] = cell
+    return torch.stack([_view(padded, view, dims=(1, 2)) for view in views])
+
+
+def get_image_views_tensor(img, cell_masks, views=TTA_VIEWS, device='cpu'):
+    """TTA views of a whole image for ROI pooling: (len(views), C, H, W) float32 of the uint8 HWC image, scaled as
+    in get_cell_views_tensor, and (len(views), num cells, h, w) of the cell masks transformed the same way."""
+    img = torch.from_numpy(np.ascontiguousarray(img)).to(device)
+    img = (img.double() / 255.).float().permute(2, 0, 1)
+    cell_masks = torch.from_numpy(np.ascontiguousarray(cell_masks)).to(device)
+    return (torch.stack([_view(img, view, dims=(1, 2)) for view in views]),
+            torch.stack([_view(cell_masks, view, dims=(1, 2)) for view in views]))
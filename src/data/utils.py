@@ -4,6 +4,11 @@ import cv2
 import numpy as np
 import pandas as pd
 
+from ..commons import instrumentation
+
+# written into <images dir>_<size> by src.preprocessing.build_image_pyramid once every png of the size is stored
+PYRAMID_COMPLETE_MARKER = '_complete'
+
 SPECIFIED_CLASS_NAMES = """0. Nucleoplasm
     1. Nuclear membrane
     2. Nucleoli
@@ -131,6 +136,20 @@ def get_masks_precomputed(img_paths, masks_root):
     # return cell_masks
 
 
+def get_cell_bboxes(img_base_path, trn_cell_boxes_path='input/cell_bboxes_train',
+                    public_cell_boxes_path='input/cell_bboxes_public'):
+    """Cell bboxes of an image in the coordinates of the raw image, as used by get_cells_from_img."""
+    cell_boxes_path = trn_cell_boxes_path if 'train' in img_base_path else public_cell_boxes_path
+    img_id = os.path.basename(img_base_path)
+    return pd.read_pickle(os.path.join(cell_boxes_path, f'{img_id}.pkl'))
+
+
+def get_num_cells(img_base_path, trn_cell_boxes_path='input/cell_bboxes_train',
+                  public_cell_boxes_path='input/cell_bboxes_public'):
+    """Number of segmented cells of an image, read from the same bbox pickle as get_cells_from_img."""
+    return len(get_cell_bboxes(img_base_path, trn_cell_boxes_path, public_cell_boxes_path))
+
+
 def get_cells_from_img(img_base_path, base_trn_path='input/hpa-single-cell-image-classification/train',
                        base_public_path='input/publichpa_1024',
                        trn_cell_boxes_path='input/cell_bboxes_train',
@@ -205,36 +224,76 @@ def get_cells_from_img(img_base_path, base_trn_path='input/hpa-single-cell-image
     # return cell_imgs, cell_labels
 
 
-# TODO: refactor get_cell_img, get_cells_from_img, get_cell_img_with_mask
-def get_cell_img(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-image-classification/train',
-                 base_public_path='input/publichpa_1024',
-                 trn_cell_boxes_path='input/cell_bboxes_train',
-                 public_cell_boxes_path='input/cell_bboxes_public',
-                 cell_img_size=512, aug=None, target_raw_img_size=None):
-    " cell_i must be 0-based "
+def get_img_with_cell_masks(img_base_path, base_trn_path='input/hpa-single-cell-image-classification/train',
+                            base_public_path='input/publichpa_1024',
+                            trn_cell_boxes_path='input/cell_bboxes_train',
+                            public_cell_boxes_path='input/cell_bboxes_public',
+                            target_img_size=1024, mask_size=128):
+    """The whole image resized to target_img_size (uint8, HWC) and the masks of its cells as area-resized
+    (num cells, mask_size, mask_size) float32 coverage maps, cells in the order of get_cells_from_img."""
+    is_from_train = 'train' in img_base_path
+    cell_boxes_path = trn_cell_boxes_path if is_from_train else public_cell_boxes_path
+    img_id = os.path.basename(img_base_path)
+    bboxes_df = pd.read_pickle(os.path.join(cell_boxes_path, f'{img_id}.pkl'))
+
+    img_rgby = open_rgby(img_id, folder_root=base_trn_path if is_from_train else base_public_path)
+    cell_masks = np.zeros((len(bboxes_df), mask_size, mask_size), dtype=np.float32)
+    # one raw-size buffer, every cell is written into it, resized and cleared again
+    mask = np.zeros(img_rgby.shape[:2], dtype=np.float32)
+    for mask_i, (_, row) in enumerate(bboxes_df.iterrows()):
+        cell_mask = mask[row['y_min']:row['y_max'], row['x_min']:row['x_max']]
+        cell_mask[:] = 1
+        cell_mask[row['cell_rows_del'], row['cell_cols_del']] = 0
+        cell_masks[mask_i] = cv2.resize(mask, (mask_size, mask_size), interpolation=cv2.INTER_AREA)
+        cell_mask[:] = 0
+
+    if img_rgby.shape[0] != target_img_size or img_rgby.shape[1] != target_img_size:
+        img_rgby = cv2.resize(img_rgby, (target_img_size, target_img_size))
+    return img_rgby, cell_masks
+
+
+def get_cell_native_sizes(img_ids, base_trn_path='input/hpa-single-cell-image-classification/train',
+                          base_public_path='input/publichpa_1024',
+                          trn_cell_boxes_path='input/cell_bboxes_train',
+                          public_cell_boxes_path='input/cell_bboxes_public',
+                          target_raw_img_size=None):
+    """Side of the square crop get_cell_img produces for every cell before its final resize,
+    {(img_id, cell_i): side} with 0-based cell_i. With target_raw_img_size the side is given at that image
+    scale, the raw image size is then read from the png header."""
+    from PIL import Image
+
+    native_sizes = {}
+    for img_id in img_ids:
+        is_from_train = len(img_id) > 15
+        cell_boxes_path = trn_cell_boxes_path if is_from_train else public_cell_boxes_path
+        bboxes_df = pd.read_pickle(os.path.join(cell_boxes_path, f'{img_id}.pkl'))
+        sides = np.maximum(bboxes_df['y_max'].values.astype(int) - bboxes_df['y_min'].values.astype(int),
+                           bboxes_df['x_max'].values.astype(int) - bboxes_df['x_min'].values.astype(int))
+        if target_raw_img_size is not None:
+            folder_root = base_trn_path if is_from_train else base_public_path
+            with Image.open(f'{folder_root}/{img_id}_red.png') as img:
+                raw_height = img.size[1]
+            sides = sides * target_raw_img_size / raw_height
+        for cell_i, side in zip(bboxes_df.index.values, sides):
+            native_sizes[(img_id, int(cell_i) - 1)] = int(side)
+    return native_sizes
+
 
+# TODO: refactor get_cell_img, get_cells_from_img, get_cell_img_with_mask
+def _read_cell_source(img_base_path, base_trn_path, base_public_path, trn_cell_boxes_path, public_cell_boxes_path):
     img_id = os.path.basename(img_base_path)
     is_from_train = len(img_id) > 15
     cell_boxes_path = trn_cell_boxes_path if is_from_train else public_cell_boxes_path
     bboxes_path = os.path.join(cell_boxes_path, f'{img_id}.pkl')
-    bboxes_df = pd.read_pickle(bboxes_path)
-
-    img_rgby = open_rgby(img_id, folder_root=base_trn_path if is_from_train else base_public_path)
+    with instrumentation.timer('read_bboxes'):
+        bboxes_df = pd.read_pickle(bboxes_path)
 
-    row = bboxes_df.loc[cell_i + 1]
-    img_cell = img_rgby[row['y_min']:row['y_max'], row['x_min']:row['x_max'], :].copy()
-    img_cell[row['cell_rows_del'], row['cell_cols_del'], :] = 0
-
-    if aug is not None:
-        img_cell = aug(img_cell)
-    height, width = img_cell.shape[:2]
+    with instrumentation.timer('decode'):
+        img_rgby = open_rgby(img_id, folder_root=base_trn_path if is_from_train else base_public_path)
+    return img_rgby, bboxes_df
 
-    if min(height, width) < 0.5 * max(height, width):
-        if height < width:
-            img_cell = np.tile(img_cell, [2, 1, 1, ])
-        else:
-            img_cell = np.tile(img_cell, [1, 2, 1])
 
+def _pad_and_resize_cell(img_cell, raw_img_height, cell_img_size, target_raw_img_size):
     if img_cell.shape[0] > img_cell.shape[1]:
         diff = img_cell.shape[0] - img_cell.shape[1]
         left = diff // 2
@@ -247,7 +306,7 @@ def get_cell_img(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-ima
         img_cell = cv2.copyMakeBorder(img_cell, up, down, 0, 0, cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
 
     if target_raw_img_size is not None:
-        prescale_factor = target_raw_img_size / img_rgby.shape[0]
+        prescale_factor = target_raw_img_size / raw_img_height
         if prescale_factor != 1:
             current_shape = img_cell.shape[:2]
             target_raw_size = int(prescale_factor*current_shape[0])
@@ -264,22 +323,29 @@ def get_cell_img(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-ima
     return img_cell
 
 
-def get_cell_img_mitotic(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-image-classification/train',
-                 base_public_path='input/publichpa_1024',
-                 trn_cell_boxes_path='input/cell_bboxes_train',
-                 public_cell_boxes_path='input/cell_bboxes_public',
-                 cell_img_size=224, aug=None, target_raw_img_size=None):
-    " cell_i must be 0-based "
+def crop_cell(img_rgby, row, cell_img_size=512, aug=None, target_raw_img_size=None):
+    """The cell crop of get_cell_img from an already decoded image, `row` is the bbox row of the cell."""
+    with instrumentation.timer('crop'):
+        img_cell = img_rgby[row['y_min']:row['y_max'], row['x_min']:row['x_max'], :].copy()
+        img_cell[row['cell_rows_del'], row['cell_cols_del'], :] = 0
 
-    img_id = os.path.basename(img_base_path)
-    is_from_train = len(img_id) > 15
-    cell_boxes_path = trn_cell_boxes_path if is_from_train else public_cell_boxes_path
-    bboxes_path = os.path.join(cell_boxes_path, f'{img_id}.pkl')
-    bboxes_df = pd.read_pickle(bboxes_path)
+    if aug is not None:
+        with instrumentation.timer('augment'):
+            img_cell = aug(img_cell)
+    height, width = img_cell.shape[:2]
 
-    img_rgby = open_rgby(img_id, folder_root=base_trn_path if is_from_train else base_public_path)
+    if min(height, width) < 0.5 * max(height, width):
+        if height < width:
+            img_cell = np.tile(img_cell, [2, 1, 1, ])
+        else:
+            img_cell = np.tile(img_cell, [1, 2, 1])
 
-    row = bboxes_df.loc[cell_i + 1]
+    return _pad_and_resize_cell(img_cell, img_rgby.shape[0], cell_img_size, target_raw_img_size)
+
+
+def crop_cell_with_context(img_rgby, row, cell_img_size=224, aug=None, target_raw_img_size=None):
+    """The crop of get_cell_img_mitotic from an already decoded image: the bbox grown by half its size on every
+    side, pixels outside of the cell mask are dimmed to a third."""
     y_min = row['y_min']
     y_max = row['y_max']
     x_min = row['x_min']
@@ -300,35 +366,49 @@ def get_cell_img_mitotic(img_base_path, cell_i, base_trn_path='input/hpa-single-
                                img_rgby[y_max: Y_max, X_min:X_max]/3), axis=0)
 
     if aug is not None:
-        img_cell = aug(img_cell)
+        with instrumentation.timer('augment'):
+            img_cell = aug(img_cell)
 
-    if img_cell.shape[0] > img_cell.shape[1]:
-        diff = img_cell.shape[0] - img_cell.shape[1]
-        left = diff // 2
-        right = diff - left
-        img_cell = cv2.copyMakeBorder(img_cell, 0, 0, left, right, cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
-    else:
-        diff = img_cell.shape[1] - img_cell.shape[0]
-        up = diff // 2
-        down = diff - up
-        img_cell = cv2.copyMakeBorder(img_cell, up, down, 0, 0, cv2.BORDER_CONSTANT, value=[0, 0, 0, 0])
+    return _pad_and_resize_cell(img_cell, img_rgby.shape[0], cell_img_size, target_raw_img_size)
 
-    if target_raw_img_size is not None:
-        prescale_factor = target_raw_img_size / img_rgby.shape[0]
-        if prescale_factor != 1:
-            current_shape = img_cell.shape[:2]
-            target_raw_size = int(prescale_factor*current_shape[0])
-            img_cell = cv2.resize(img_cell, (target_raw_size, target_raw_size))
-            if cell_img_size is not None:
-                img_cell = cv2.resize(img_cell, (cell_img_size, cell_img_size))
-            else:
-                img_cell = cv2.resize(img_cell, current_shape)
-        elif cell_img_size is not None:
-            img_cell = cv2.resize(img_cell, (cell_img_size, cell_img_size))
 
-    elif cell_img_size is not None:
-        img_cell = cv2.resize(img_cell, (cell_img_size, cell_img_size))
-    return img_cell
+def get_cell_img(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-image-classification/train',
+                 base_public_path='input/publichpa_1024',
+                 trn_cell_boxes_path='input/cell_bboxes_train',
+                 public_cell_boxes_path='input/cell_bboxes_public',
+                 cell_img_size=512, aug=None, target_raw_img_size=None):
+    " cell_i must be 0-based "
+    img_rgby, bboxes_df = _read_cell_source(img_base_path, base_trn_path, base_public_path,
+                                            trn_cell_boxes_path, public_cell_boxes_path)
+    return crop_cell(img_rgby, bboxes_df.loc[cell_i + 1], cell_img_size=cell_img_size, aug=aug,
+                     target_raw_img_size=target_raw_img_size)
+
+
+def get_cell_img_mitotic(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-image-classification/train',
+                 base_public_path='input/publichpa_1024',
+                 trn_cell_boxes_path='input/cell_bboxes_train',
+                 public_cell_boxes_path='input/cell_bboxes_public',
+                 cell_img_size=224, aug=None, target_raw_img_size=None):
+    " cell_i must be 0-based "
+    img_rgby, bboxes_df = _read_cell_source(img_base_path, base_trn_path, base_public_path,
+                                            trn_cell_boxes_path, public_cell_boxes_path)
+    return crop_cell_with_context(img_rgby, bboxes_df.loc[cell_i + 1], cell_img_size=cell_img_size, aug=aug,
+                                  target_raw_img_size=target_raw_img_size)
+
+
+def get_cell_img_with_context(img_base_path, cell_i, base_trn_path='input/hpa-single-cell-image-classification/train',
+                              base_public_path='input/publichpa_1024',
+                              trn_cell_boxes_path='input/cell_bboxes_train',
+                              public_cell_boxes_path='input/cell_bboxes_public',
+                              cell_img_size=512, aug=None, target_raw_img_size=None):
+    """The crops of get_cell_img and get_cell_img_mitotic from a single decode of the image, both resized
+    to cell_img_size and augmented independently. cell_i must be 0-based."""
+    img_rgby, bboxes_df = _read_cell_source(img_base_path, base_trn_path, base_public_path,
+                                            trn_cell_boxes_path, public_cell_boxes_path)
+    row = bboxes_df.loc[cell_i + 1]
+    return (crop_cell(img_rgby, row, cell_img_size=cell_img_size, aug=aug, target_raw_img_size=target_raw_img_size),
+            crop_cell_with_context(img_rgby, row, cell_img_size=cell_img_size, aug=aug,
+                                   target_raw_img_size=target_raw_img_size))
 
 
 def get_cell_copied(cell_img, augmentations=[], height=1024, width=1024):
@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Subset
+from torch.utils.data.sampler import SequentialSampler
+
+from ..commons import instrumentation
+from .datasets import CellSizeBucketBatchSampler
+
+# Validation inputs are decoded, cropped and converted once and stored as a memory-mapped array under
+# output/val_cache/<fingerprint>. The fingerprint covers the sample identifiers and the preprocessing
+# settings of the dataset, labels are not cached and always come from dataset.get_label().
+
+VAL_CACHE_DIR = 'output/val_cache'
+# part of the fingerprint, bumped when the stored format changes
+STORE_VERSION = 1
+
+
+def dataset_fingerprint(dataset):
+    if hasattr(dataset, 'img_ids_cell'):
+        identifiers = [tuple(x) if not isinstance(x, str) else x for x in dataset.img_ids_cell]
+    else:
+        identifiers = list(dataset.img_paths)
+    settings = {
+        'class': type(dataset).__name__,
+        'img_size': getattr(dataset, 'img_size', None),
+        'cell_img_size': getattr(dataset, 'cell_img_size', None),
+        'in_channels': getattr(dataset, 'in_channels', None),
+        'normalize': getattr(dataset, 'normalize', False),
+        'target_raw_img_size': getattr(dataset, 'target_raw_img_size', None),
+        'integer_intensities': getattr(dataset, 'integer_intensities', True),
+        'store_version': STORE_VERSION,
+    }
+    digest = hashlib.sha1()
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    digest.update(repr(identifiers).encode())
+    return digest.hexdigest()[:16]
+
+
+class ValidationStore(object):
+    def __init__(self, dataset, cache_dir=VAL_CACHE_DIR, dtype=None):
+        if getattr(dataset, 'transform', None) is not None:
+            raise ValueError('validation inputs can only be cached without random augmentations')
+        self.dataset = dataset
+        self.fingerprint = dataset_fingerprint(dataset)
+        self.store_dir = os.path.join(cache_dir, self.fingerprint)
+        self.images_fpath = os.path.join(self.store_dir, 'images.npy')
+        self.meta_fpath = os.path.join(self.store_dir, 'meta.json')
+        if dtype is None:
+            # normalized inputs leave [0, 1] and datasets with integer_intensities = False, e.g. the dimmed
+            # surroundings of the mitotic context crops, are not multiples of 1 / 255: neither fits 8-bit intensities
+            integer_intensities = getattr(dataset, 'integer_intensities', True)
+            dtype = 'float16' if getattr(dataset, 'normalize', False) or not integer_intensities else 'uint8'
+        self.dtype = dtype
+
+    def is_complete(self):
+        return os.path.exists(self.meta_fpath)
+
+    def build(self, batch_size=32, num_workers=0, log=None):
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+        loader = DataLoader(self.dataset, sampler=SequentialSampler(self.dataset), batch_size=batch_size,
+                            drop_last=False, num_workers=num_workers, worker_init_fn=instrumentation.worker_init_fn)
+        images_memmap = None
+        start = 0
+        for it, iter_data in enumerate(loader, 0):
+            images = iter_data[0].numpy()
+            if images_memmap is None:
+                images_memmap = np.lib.format.open_memmap(self.images_fpath + '.tmp', mode='w+', dtype=self.dtype,
+                                                          shape=(len(self.dataset),) + images.shape[1:])
+            if self.dtype == 'uint8':
+                images = images * 255.0
+                if np.abs(images - np.rint(images)).max() > 1e-3:
+                    raise ValueError('%s returns inputs that are not whole 8-bit intensities, set its '
+                                     'integer_intensities to False to cache them as float16'
+                                     % type(self.dataset).__name__)
+                images = np.rint(images)
+            images_memmap[start:start + len(images)] = images.astype(self.dtype)
+            start += len(images)
+            print('\r>> caching validation inputs: %d / %d' % (start, len(self.dataset)), end='', flush=True)
+        print('\r', end='', flush=True)
+        images_memmap.flush()
+        del images_memmap
+        os.replace(self.images_fpath + '.tmp', self.images_fpath)
+        with open(self.meta_fpath, 'w') as f:
+            json.dump({'num': len(self.dataset), 'dtype': self.dtype}, f)
+        if log is not None:
+            log.write(">> Validation inputs cached to '{}' as {}\n".format(self.store_dir, self.dtype))
+
+    def get_dataset(self, batch_size=32, num_workers=0, log=None):
+        if not self.is_complete():
+            self.build(batch_size=batch_size, num_workers=num_workers, log=log)
+        elif log is not None:
+            log.write(">> Using cached validation inputs from '{}'\n".format(self.store_dir))
+        return CachedValidationDataset(self.images_fpath, self.dataset)
+
+
+class CachedValidationDataset(Dataset):
+    def __init__(self, images_fpath, dataset):
+        self.images_fpath = images_fpath
+        self.dataset = dataset
+        self.images = None
+        self.num = len(dataset)
+
+    def __getitem__(self, index):
+        # opened lazily so that every DataLoader worker gets its own memory map
+        if self.images is None:
+            self.images = np.load(self.images_fpath, mmap_mode='r')
+        image = np.asarray(self.images[index], dtype=np.float32)
+        if self.images.dtype == np.uint8:
+            image = image / 255.0
+        instrumentation.count('cells' if hasattr(self.dataset, 'img_ids_cell') else 'images')
+        return torch.from_numpy(image), self.dataset.get_label(index), index
+
+    def get_label(self, index):
+        return self.dataset.get_label(index)
+
+    def __len__(self):
+        return self.num
+
+
+def stratified_subset_indices(dataset, fraction, seed=0):
+    """Groups samples by their rarest positive class (samples without positives form their own group) and
+    keeps `fraction` of every group, at least one sample per group."""
+    labels = np.stack([np.asarray(dataset.get_label(i), dtype=np.float32).reshape(-1) for i in range(len(dataset))])
+    positives = labels > 0.5
+    class_counts = positives.sum(axis=0)
+    group_2_indices = defaultdict(list)
+    for i, sample_positives in enumerate(positives):
+        if sample_positives.any():
+            present = np.where(sample_positives)[0]
+            group = int(present[np.argmin(class_counts[present])])
+        else:
+            group = -1
+        group_2_indices[group].append(i)
+
+    rng = np.random.RandomState(seed)
+    selected = []
+    for group in sorted(group_2_indices):
+        indices = group_2_indices[group]
+        num_selected = max(1, int(round(fraction * len(indices))))
+        selected.extend(rng.choice(indices, num_selected, replace=False).tolist())
+    return sorted(selected)
+
+
+def build_valid_loaders(args, valid_dataset, log):
+    """Returns the full validation loader and, with --fast-val-fraction, a loader over a fixed stratified subset.
+    Datasets with size buckets are batched per bucket."""
+    bucketed = getattr(valid_dataset, 'cell_buckets', None) is not None
+    if args.val_cache:
+        if bucketed:
+            raise ValueError('the validation cache stores fixed-size crops, it cannot be used with size buckets')
+        store = ValidationStore(valid_dataset)
+        valid_dataset = store.get_dataset(batch_size=args.batch_size, num_workers=args.workers, log=log)
+
+    def make_loader(dataset, indices=None):
+        if bucketed:
+            batch_sampler = CellSizeBucketBatchSampler(dataset.cell_buckets, args.batch_size, base_sampler=indices,
+                                                       shuffle=False)
+            return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args.workers, pin_memory=True,
+                              worker_init_fn=instrumentation.worker_init_fn)
+        if indices is not None:
+            dataset = Subset(dataset, indices)
+        return DataLoader(
+            dataset,
+            sampler=SequentialSampler(dataset),
+            batch_size=args.batch_size,
+            drop_last=False,
+            num_workers=args.workers,
+            pin_memory=True,
+            worker_init_fn=instrumentation.worker_init_fn,
+        )
+
+    valid_loader = make_loader(valid_dataset)
+    fast_valid_loader = None
+    if args.fast_val_fraction is not None:
+        subset_indices = stratified_subset_indices(valid_dataset, args.fast_val_fraction)
+        log.write('>> Fast validation on %d of %d samples, full validation every %d epochs\n' %
+                  (len(subset_indices), len(valid_dataset), args.full_val_every))
+        fast_valid_loader = make_loader(valid_dataset, subset_indices)
+    return valid_loader, fast_valid_loader
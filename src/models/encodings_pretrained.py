@@ -1,6 +1,4 @@
-import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
 
 class BestfittingEncodingsModel(nn.Module):
@@ -9,25 +7,31 @@ class BestfittingEncodingsModel(nn.Module):
         self.densenet121_model = densenet121_model
 
     def forward(self, x):
-        mean = [0.074598, 0.050630, 0.050891, 0.076287]  # rgby
-        std = [0.122813, 0.085745, 0.129882, 0.119411]
-        for i in range(self.densenet121_model.in_channels):
-            x[:, i, :, :] = (x[:, i, :, :] - mean[i]) / std[i]
-
-        x = self.densenet121_model.conv1(x)
-        if self.densenet121_model.large:
-            x = self.densenet121_model.maxpool(x)
-        e2 = self.densenet121_model.encoder2(x)
-        e3 = self.densenet121_model.encoder3(e2)
-        e4 = self.densenet121_model.encoder4(e3)
-        e5 = self.densenet121_model.encoder5(e4)
-        e5 = F.relu(e5, inplace=True)
-        if self.densenet121_model.dropout:
-            x = torch.cat((nn.AdaptiveAvgPool2d(1)(e5), nn.AdaptiveMaxPool2d(1)(e5)), dim=1)
-            x = x.view(x.size(0), -1)
-            x = self.densenet121_model.bn1(x)
-            x = F.dropout(x, p=0.5, training=self.densenet121_model.training)
-            x = self.densenet121_model.fc1(x)
-            return x
-        else:
-            raise NotImplementedError()
\ No newline at end of file
+        return self.densenet121_model.forward_embedding_head(self.densenet121_model.forward_features(x))
+
+
+class BestfittingLogitsEncodingsModel(nn.Module):
+    """(logits, embeddings) of a DensenetClass and BestfittingEncodingsModel from one backbone pass."""
+
+    def __init__(self, densenet121_model):
+        super(BestfittingLogitsEncodingsModel, self).__init__()
+        self.densenet121_model = densenet121_model
+
+    def forward(self, x):
+        return self.densenet121_model.forward_with_embeddings(x)
+
+
+class BestfittingRoiLogitsEncodingsModel(nn.Module):
+    """(logits, embeddings) per cell from one DensenetClass pass over whole images, the encoder5 features pooled
+    inside the cell masks. x is (N, C, H, W), cell_masks (N, num_cells, h, w) with the same cells in every image,
+    e.g. the TTA views of one image. Returns (N, num_cells, num_classes) logits and (N, num_cells, 1024) embeddings."""
+
+    def __init__(self, densenet121_model):
+        super(BestfittingRoiLogitsEncodingsModel, self).__init__()
+        self.densenet121_model = densenet121_model
+
+    def forward(self, x, cell_masks):
+        features = self.densenet121_model.forward_roi_features(x, cell_masks)
+        num_images, num_cells = features.shape[:2]
+        logits, embeddings = self.densenet121_model.forward_head_with_embeddings(features.flatten(0, 1))
+        return logits.view(num_images, num_cells, -1), embeddings.view(num_images, num_cells, -1)
@@ -5,21 +5,32 @@ from ..layers_bestfitting.loss import *
 import torch
 from ...data.utils import get_new_class_name_indices_in_prev_comp_data
 from copy import deepcopy
+from ..pruning import apply_pruned_config
 
 
 ## networks  ######################################################################
 class DensenetClass(nn.Module):
+    FEATURE_BLOCKS = ('conv1', 'encoder2', 'encoder3', 'encoder4', 'encoder5')
+    ROI_MAX_CHUNK = 16
 
     def __init__(self,feature_net='densenet121', num_classes=19,
                  in_channels=3,
                  pretrained_file=None,
                  dropout=False,
                  large=False,
+                 pruned_config=None,
                  ):
         super().__init__()
         self.dropout = dropout
         self.in_channels = in_channels
         self.large = large
+        self.num_frozen_blocks = 0
+        # rgby statistics as buffers: the normalization runs out of place and without a Python loop,
+        # which keeps forward traceable for torch.compile/TorchScript
+        self.register_buffer('input_mean', torch.tensor([0.074598, 0.050630, 0.050891, 0.076287])[:in_channels]
+                             .view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('input_std', torch.tensor([0.122813, 0.085745, 0.129882, 0.119411])[:in_channels]
+                             .view(1, -1, 1, 1), persistent=False)
 
         if feature_net=='densenet121':
             self.backbone = densenet121()
@@ -79,36 +90,165 @@ class DensenetClass(nn.Module):
             self.load_state_dict(state_dict)
             print('Loaded densenet bestfitting model')
 
-    def forward(self, x):
-        mean = [0.074598, 0.050630, 0.050891, 0.076287]#rgby
-        std =  [0.122813, 0.085745, 0.129882, 0.119411]
-        for i in range(self.in_channels):
-            x[:,i,:,:] = (x[:,i,:,:] - mean[i]) / std[i]
-
-        x = self.conv1(x)
-        if self.large:
-            x = self.maxpool(x)
-        e2 = self.encoder2(x)
-        e3 = self.encoder3(e2)
-        e4 = self.encoder4(e3)
-        e5 = self.encoder5(e4)
-        # print(e2.shape, e3.shape, e4.shape, e5.shape)
-        e5 = F.relu(e5,inplace=True)
+        # bottleneck widths of a pruned checkpoint, see src/models/pruning.py
+        self.pruned_config = None
+        if pruned_config is not None:
+            apply_pruned_config(self, pruned_config)
+
+    def forward_features(self, x):
+        """Backbone part of forward(): the pooled encoder5 features that enter the head,
+        (N, 2 * num_features) for the dropout variants and (N, num_features) otherwise."""
+        e5 = self.forward_feature_map(x)
+        if self.dropout:
+            x = torch.cat((F.adaptive_avg_pool2d(e5, 1), F.adaptive_max_pool2d(e5, 1)), dim=1)
+        else:
+            x = self.avgpool(e5)
+        return x.view(x.size(0), -1)
+
+    def forward_feature_map(self, x):
+        """Unpooled encoder5 features after the relu, (N, num_features, H / 32, W / 32)."""
+        x = (x - self.input_mean) / self.input_std
+
+        # leading blocks frozen by a freeze schedule run without autograd, see src/train/freeze_schedule.py
+        if self.num_frozen_blocks > 0:
+            with torch.no_grad():
+                x = self._forward_blocks(x, 0, self.num_frozen_blocks)
+        e5 = self._forward_blocks(x, self.num_frozen_blocks, len(self.FEATURE_BLOCKS))
+        return F.relu(e5,inplace=True)
+
+    def forward_roi_features(self, x, cell_masks):
+        """Per-cell head input of the dropout variants from one pass over whole images: the encoder5 features of
+        x (N, C, H, W) pooled inside the masks (N, num_cells, h, w), (N, num_cells, 2 * num_features).
+        The masks are area-resized to the feature map, the average is weighted by the cell coverage of every
+        feature map position and the max runs over all positions the cell touches, as the avg/max concat of
+        forward_features() over a whole cell image."""
+        if not self.dropout:
+            raise NotImplementedError()
+        e5 = self.forward_feature_map(x)
+        weights = F.adaptive_avg_pool2d(cell_masks.to(e5.dtype), e5.shape[2:])
+        avg = torch.einsum('nchw,nkhw->nkc', e5, weights) / weights.sum(dim=(2, 3)).clamp(min=1e-6)[..., None]
+        # the features are >= 0 after the relu, positions outside the cell are zeroed instead of set to -inf;
+        # in chunks of cells, the masked copy of the feature map is num_cells times its size
+        inside = (weights > 0).to(e5.dtype)
+        max_ = torch.cat([(e5[:, None] * inside[:, start:start + self.ROI_MAX_CHUNK, None]).amax(dim=(3, 4))
+                          for start in range(0, inside.shape[1], self.ROI_MAX_CHUNK)], dim=1)
+        return torch.cat((avg, max_), dim=2)
+
+    def _forward_blocks(self, x, start, end):
+        for name in self.FEATURE_BLOCKS[start:end]:
+            x = getattr(self, name)(x)
+            if name == 'conv1' and self.large:
+                x = self.maxpool(x)
+        return x
+
+    def forward_head(self, x):
         if self.dropout:
-            x = torch.cat((nn.AdaptiveAvgPool2d(1)(e5), nn.AdaptiveMaxPool2d(1)(e5)), dim=1)
-            x = x.view(x.size(0), -1)
             x = self.bn1(x)
             x = F.dropout(x, p=0.5, training=self.training)
             x = self.fc1(x)
             x = self.relu(x)
             x = self.bn2(x)
             x = F.dropout(x, p=0.5, training=self.training)
-        else:
-            x = self.avgpool(e5)
-        x = x.view(x.size(0), -1)
         x = self.logit(x)
         return x
 
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
+
+    def forward_embedding_head(self, x):
+        """fc1 output of the head of the dropout variants, the cell embedding of BestfittingEncodingsModel."""
+        if not self.dropout:
+            raise NotImplementedError()
+        x = self.bn1(x)
+        x = F.dropout(x, p=0.5, training=self.training)
+        return self.fc1(x)
+
+    def forward_with_embeddings(self, x):
+        """(logits, embeddings) of forward() and BestfittingEncodingsModel from a single backbone pass."""
+        return self.forward_head_with_embeddings(self.forward_features(x))
+
+    def forward_head_with_embeddings(self, x):
+        """(logits, embeddings) of the head for pooled features, e.g. of forward_roi_features()."""
+        embeddings = self.forward_embedding_head(x)
+        # out of place, the embeddings are returned as well
+        x = self.bn2(F.relu(embeddings))
+        x = F.dropout(x, p=0.5, training=self.training)
+        return self.logit(x), embeddings
+
+
+class DensenetHead(nn.Module):
+    """The head of DensenetClass on its own, applied to features from DensenetClass.forward_features.
+    Parameter names match DensenetClass, so its state_dict can be merged into a full checkpoint."""
+
+    def __init__(self, num_features=1024, num_classes=19, dropout=True):
+        super().__init__()
+        self.dropout = dropout
+        self.logit = nn.Linear(num_features, num_classes)
+        self.logit.bias.data.fill_(0.0)
+        if self.dropout:
+            self.bn1 = nn.BatchNorm1d(num_features*2)
+            self.fc1 = nn.Linear(num_features*2, num_features)
+            self.bn2 = nn.BatchNorm1d(num_features)
+            self.relu = nn.ReLU(inplace=True)
+
+    def forward(self, x):
+        return DensenetClass.forward_head(self, x)
+
+    def load_from_network_state_dict(self, state_dict, skip_logit=False):
+        """Copies the head weights out of a DensenetClass state_dict, the logit layer is kept freshly
+        initialized with skip_logit=True (e.g. for a new binary head)."""
+        own_keys = set(self.state_dict().keys())
+        head_state_dict = {key: value for key, value in state_dict.items()
+                           if key in own_keys and not (skip_logit and key.startswith('logit.'))}
+        self.load_state_dict(head_state_dict, strict=not skip_logit)
+
+
+class DensenetMultiHead(nn.Module):
+    """DensenetClass with an additional binary mitotic spindle head on the same pooled features, so that
+    one backbone forward serves both tasks. Inputs of shape (N, 2, C, H, W) carry the context crop of every
+    cell in [:, 1]: both crops run through the backbone as one batch of 2N and the mitotic head gets the
+    features of the context crops. Returns (N, num_classes + 1) logits, the last column is the mitotic one."""
+
+    MITOTIC_PREFIX = 'mitotic_head.'
+    # parameters of DensenetClass.forward_head
+    HEAD_PREFIXES = ('logit.', 'bn1.', 'fc1.', 'bn2.')
+
+    def __init__(self, densenet):
+        super().__init__()
+        self.densenet = densenet
+        self.mitotic_head = DensenetHead(num_features=densenet.logit.in_features, num_classes=1,
+                                         dropout=densenet.dropout)
+
+    @property
+    def pruned_config(self):
+        return self.densenet.pruned_config
+
+    def forward(self, x):
+        if x.dim() == 5:
+            features = self.densenet.forward_features(x.flatten(0, 1)).view(x.size(0), x.size(1), -1)
+            cell_features, context_features = features[:, 0], features[:, 1]
+        else:
+            cell_features = context_features = self.densenet.forward_features(x)
+        return torch.cat((self.densenet.forward_head(cell_features), self.mitotic_head(context_features)), dim=1)
+
+    def load_single_task_state_dict(self, state_dict):
+        """Initializes backbone and class head from a DensenetClass state_dict, e.g. of the image-level model.
+        The mitotic head starts from its hidden layers and a fresh logit layer."""
+        self.densenet.load_state_dict(state_dict)
+        self.mitotic_head.load_from_network_state_dict(state_dict, skip_logit=True)
+
+    @classmethod
+    def split_state_dict(cls, state_dict):
+        """DensenetClass state_dicts of the 19 class model and of the mitotic one (num_classes=1),
+        loadable by the separate prediction scripts."""
+        class_state_dict = {key[len('densenet.'):]: value for key, value in state_dict.items()
+                            if key.startswith('densenet.')}
+        mitotic_state_dict = {key: value for key, value in class_state_dict.items()
+                              if not key.startswith(cls.HEAD_PREFIXES)}
+        mitotic_state_dict.update({key[len(cls.MITOTIC_PREFIX):]: value for key, value in state_dict.items()
+                                   if key.startswith(cls.MITOTIC_PREFIX)})
+        return class_state_dict, mitotic_state_dict
+
 
 class BestfittingEncodingsModel(nn.Module):
     def __init__(self, densenet121_model):
@@ -116,36 +256,15 @@ class BestfittingEncodingsModel(nn.Module):
         self.densenet121_model = densenet121_model
 
     def forward(self, x):
-        mean = [0.074598, 0.050630, 0.050891, 0.076287]  # rgby
-        std = [0.122813, 0.085745, 0.129882, 0.119411]
-        for i in range(self.densenet121_model.in_channels):
-            x[:, i, :, :] = (x[:, i, :, :] - mean[i]) / std[i]
-
-        x = self.densenet121_model.conv1(x)
-        if self.densenet121_model.large:
-            x = self.densenet121_model.maxpool(x)
-        e2 = self.densenet121_model.encoder2(x)
-        e3 = self.densenet121_model.encoder3(e2)
-        e4 = self.densenet121_model.encoder4(e3)
-        e5 = self.densenet121_model.encoder5(e4)
-        # print(e2.shape, e3.shape, e4.shape, e5.shape)
-        e5 = F.relu(e5, inplace=True)
-        if self.densenet121_model.dropout:
-            x = torch.cat((nn.AdaptiveAvgPool2d(1)(e5), nn.AdaptiveMaxPool2d(1)(e5)), dim=1)
-            x = x.view(x.size(0), -1)
-            x = self.densenet121_model.bn1(x)
-            x = F.dropout(x, p=0.5, training=self.densenet121_model.training)
-            x = self.densenet121_model.fc1(x)
-            return x
-        else:
-            raise NotImplementedError()
+        return self.densenet121_model.forward_embedding_head(self.densenet121_model.forward_features(x))
 
 def class_densenet121_dropout(**kwargs):
     num_classes = kwargs['num_classes']
     in_channels = kwargs['in_channels']
     pretrained_file = kwargs['pretrained_file']
     model = DensenetClass(feature_net='densenet121', num_classes=num_classes,
-                        in_channels=in_channels, pretrained_file=pretrained_file, dropout=True)
+                        in_channels=in_channels, pretrained_file=pretrained_file, dropout=True,
+                        pruned_config=kwargs.get('pruned_config'))
     return model
 
 def class_densenet121_large_dropout(**kwargs):
@@ -153,5 +272,6 @@ def class_densenet121_large_dropout(**kwargs):
     in_channels = kwargs['in_channels']
     pretrained_file = kwargs['pretrained_file']
     model = DensenetClass(feature_net='densenet121', num_classes=num_classes,
-                        in_channels=in_channels, pretrained_file=pretrained_file, dropout=True, large=True)
+                        in_channels=in_channels, pretrained_file=pretrained_file, dropout=True, large=True,
+                        pruned_config=kwargs.get('pruned_config'))
     return model
@@ -45,9 +45,14 @@ class Efficient(nn.Module):
                     return x
 
             w = self.net._conv_stem.weight
-            self.net._conv_stem = Conv2dStaticSamePadding(4, 40, kernel_size=(3, 3), stride=(2, 2), bias=False, image_size=image_size)
+            self.net._conv_stem = Conv2dStaticSamePadding(4, w.shape[0], kernel_size=(3, 3), stride=(2, 2), bias=False, image_size=image_size)
             self.net._conv_stem.weight = torch.nn.Parameter(torch.cat((w, w[:, :1, :, :]), dim=1))
 
+        # imagenet statistics (the blue ones for yellow) as buffers, normalization runs out of place
+        self.register_buffer('input_mean', torch.tensor([0.485, 0.456, 0.406, 0.406]).view(1, -1, 1, 1),
+                             persistent=False)
+        self.register_buffer('input_std', torch.tensor([0.229, 0.224, 0.225, 0.225]).view(1, -1, 1, 1),
+                             persistent=False)
         self.avg_pool = nn.AdaptiveAvgPool2d(1)
         self.logit = nn.Linear(n_channels_dict[encoder], num_classes)
         self.dropout = dropout
@@ -60,13 +65,10 @@ class Efficient(nn.Module):
             self.relu = nn.ReLU(inplace=True)
 
     def forward(self, x):
-        mean = [0.485, 0.456, 0.406, 0.406]  # rgby
-        std = [0.229, 0.224, 0.225, 0.225]
-        for i in range(4):
-            x[:, i, :, :] = (x[:, i, :, :] - mean[i]) / std[i]
+        x = (x - self.input_mean) / self.input_std
         x = self.net.extract_features(x)
         if self.dropout:
-            x = torch.cat((nn.AdaptiveAvgPool2d(1)(x), nn.AdaptiveMaxPool2d(1)(x)), dim=1)
+            x = torch.cat((F.adaptive_avg_pool2d(x, 1), F.adaptive_max_pool2d(x, 1)), dim=1)
             x = x.view(x.size(0), -1)
             x = self.bn1(x)
             x = F.dropout(x, p=0.5, training=self.training)
@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .layers_bestfitting.backbone.densenet import _DenseLayer
+
+# Structured pruning of the DenseNet bottlenecks. Inside every dense layer the channels between conv1 (1x1)
+# and conv2 (3x3) can be removed without touching the concatenated feature maps of the block, so pruned
+# layers are physically smaller: conv1 loses output filters, norm2 its channels and conv2 input channels.
+# The kept channel counts form the pruned_config ({'denseblock1.denselayer1': 64, ...}) which is stored in
+# the checkpoint and passed to init_network to rebuild the pruned network before loading its weights.
+
+
+def dense_layers(densenet_model):
+    """(name, layer) of all dense layers of a DensenetClass, named relative to backbone.features."""
+    return [(name, module) for name, module in densenet_model.backbone.features.named_modules()
+            if isinstance(module, _DenseLayer)]
+
+
+def resize_dense_layer(layer, num_channels):
+    layer.conv1 = nn.Conv2d(layer.conv1.in_channels, num_channels, kernel_size=1, stride=1, bias=False)
+    layer.norm2 = nn.BatchNorm2d(num_channels)
+    layer.conv2 = nn.Conv2d(num_channels, layer.conv2.out_channels, kernel_size=3, stride=1, padding=1, bias=False)
+
+
+def apply_pruned_config(densenet_model, pruned_config):
+    """Shapes the dense layers of a freshly built DensenetClass like a pruned checkpoint, weights are
+    expected to be loaded afterwards."""
+    for name, layer in dense_layers(densenet_model):
+        if name in pruned_config and pruned_config[name] != layer.norm2.num_features:
+            resize_dense_layer(layer, pruned_config[name])
+    densenet_model.pruned_config = dict(pruned_config)
+
+
+def prune_dense_layer(layer, keep_indices):
+    keep_indices = torch.as_tensor(sorted(keep_indices), dtype=torch.long, device=layer.conv1.weight.device)
+    conv1, norm2, conv2 = layer.conv1, layer.norm2, layer.conv2
+    resize_dense_layer(layer, len(keep_indices))
+    layer.to(conv1.weight.device)
+    with torch.no_grad():
+        layer.conv1.weight.copy_(conv1.weight[keep_indices])
+        layer.norm2.weight.copy_(norm2.weight[keep_indices])
+        layer.norm2.bias.copy_(norm2.bias[keep_indices])
+        layer.norm2.running_mean.copy_(norm2.running_mean[keep_indices])
+        layer.norm2.running_var.copy_(norm2.running_var[keep_indices])
+        layer.norm2.num_batches_tracked.copy_(norm2.num_batches_tracked)
+        layer.conv2.weight.copy_(conv2.weight[:, keep_indices])
+
+
+def bn_gamma_importance(densenet_model):
+    return {name: layer.norm2.weight.detach().abs().cpu().numpy() for name, layer in dense_layers(densenet_model)}
+
+
+def taylor_importance(densenet_model, batches, compute_loss):
+    """First-order Taylor estimate of the loss change when a bottleneck channel is removed, from the
+    gradients of its norm2 scale and shift (Molchanov et al., 2019), summed over the given batches."""
+    layers = dense_layers(densenet_model)
+    importance = {name: np.zeros(layer.norm2.num_features) for name, layer in layers}
+    densenet_model.eval()
+    for images, labels in batches:
+        densenet_model.zero_grad()
+        loss = compute_loss(densenet_model(images), labels)
+        loss.backward()
+        for name, layer in layers:
+            norm2 = layer.norm2
+            contribution = norm2.weight * norm2.weight.grad + norm2.bias * norm2.bias.grad
+            importance[name] += (contribution.detach() ** 2).cpu().numpy()
+    densenet_model.zero_grad()
+    return importance
+
+
+def prune_densenet(densenet_model, importance, ratio, min_channels=8, multiple_of=8):
+    """Removes the `ratio` least important bottleneck channels of every dense layer in place and returns the
+    pruned_config. Kept channel counts are rounded up to a multiple of `multiple_of` for efficient kernels."""
+    pruned_config = {}
+    for name, layer in dense_layers(densenet_model):
+        num_channels = layer.norm2.num_features
+        num_keep = int(np.ceil(num_channels * (1 - ratio) / multiple_of) * multiple_of)
+        num_keep = min(num_channels, max(min_channels, num_keep))
+        if num_keep < num_channels:
+            keep_indices = np.argsort(-importance[name])[:num_keep]
+            prune_dense_layer(layer, keep_indices.tolist())
+        pruned_config[name] = num_keep
+    densenet_model.pruned_config = pruned_config
+    return pruned_config
+
+
+def count_macs(model, input_size, in_channels=4):
+    """Multiply-accumulates of the convolutions and linear layers for one input of input_size x input_size."""
+    macs = []
+
+    def conv_hook(module, inputs, output):
+        kernel_macs = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        macs.append(output.numel() // output.shape[0] * kernel_macs)
+
+    def linear_hook(module, inputs, output):
+        macs.append(module.in_features * module.out_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.rand(1, in_channels, input_size, input_size, device=device))
+    model.train(was_training)
+    for handle in handles:
+        handle.remove()
+    return sum(macs)
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Batched multi-cell inference: the TTA views of consecutive cells, also across images, are concatenated into
+# forward batches of up to `batch_size` views instead of one forward per cell. The outputs are averaged over the
+# views of every cell and scattered back to the images they came from.
+# With a `bucket_fn` cells of different input shapes are batched separately, one pending batch per bucket.
+
+
+def predict_cells_batched(image_cells, predict_fn, batch_size, num_views=4, concat=np.concatenate, bucket_fn=None,
+                          max_open_images=32):
+    """`image_cells` yields (key, cells), cells being an iterable of (num_views, C, H, W) arrays, one per cell.
+    `predict_fn` maps a (num views, C, H, W) batch to a tuple of arrays with one row per view.
+    Yields (key, outputs) in input order as soon as all cells of an image are predicted, outputs is a tuple of
+    (num cells, ...) arrays of TTA means or None for images without cells. The views of a cell are never split
+    over two batches, i.e. a batch holds at least one cell. Cells given as tensors need concat=torch.cat.
+    `bucket_fn` maps the views of a cell to its bucket, e.g. the input size; when more than `max_open_images` images
+    wait for cells in partially filled buckets, the buckets holding cells of the oldest image are run."""
+    # per bucket: [(key, cell index, views)]
+    pending = OrderedDict()
+    # per image in input order: [outputs per cell, number of predicted cells, all cells read]
+    images = OrderedDict()
+
+    def run_pending(bucket):
+        cells = pending.pop(bucket)
+        batch = concat([views for _, _, views in cells]) if len(cells) > 1 else cells[0][2]
+        outputs = predict_fn(batch)
+        cell_outputs = [output.reshape((len(cells), num_views) + output.shape[1:]).mean(axis=1)
+                        for output in outputs]
+        for batch_i, (key, cell_i, _) in enumerate(cells):
+            images[key][0][cell_i] = tuple(output[batch_i] for output in cell_outputs)
+            images[key][1] += 1
+
+    def pop_completed():
+        while images:
+            key, (cell_outputs, num_predicted, all_read) = next(iter(images.items()))
+            if not all_read or num_predicted < len(cell_outputs):
+                return
+            del images[key]
+            yield key, (tuple(np.stack(output) for output in zip(*cell_outputs)) if cell_outputs else None)
+
+    for key, cells in image_cells:
+        images[key] = [[], 0, False]
+        for views in cells:
+            bucket = bucket_fn(views) if bucket_fn is not None else None
+            if bucket in pending and (len(pending[bucket]) + 1) * num_views > batch_size:
+                run_pending(bucket)
+                yield from pop_completed()
+            images[key][0].append(None)
+            pending.setdefault(bucket, []).append((key, len(images[key][0]) - 1, views))
+        images[key][2] = True
+        yield from pop_completed()
+        while len(images) > max_open_images:
+            oldest = next(iter(images))
+            for bucket in [bucket for bucket, cells in pending.items() if any(key == oldest for key, _, _ in cells)]:
+                run_pending(bucket)
+            yield from pop_completed()
+
+    for bucket in list(pending):
+        run_pending(bucket)
+    yield from pop_completed()
@@ -0,0 +1,147 @@
+import sys
+sys.path.insert(0, '..')
+import argparse
+import pickle
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import SequentialSampler
+from torch.backends import cudnn
+
+from ..models.layers_bestfitting.loss import *
+from tqdm.auto import tqdm
+from ..models.networks_bestfitting.imageclsnet import init_network
+from ..data.datasets import ProteinDatasetCellSeparateLoading
+from ..data.feature_store import FeatureStore, FEATURE_STORE_DIR
+from ..data.utils import get_train_df_ohe, get_public_df_ohe
+from ..commons import instrumentation
+import multiprocessing
+import time
+
+# Runs the frozen backbone of a fold model once over all labelled cells of the fold and stores the pooled
+# encoder5 features for every TTA view, src.train.train_head_from_features trains heads on them:
+# python -m src.predict.extract_cell_features --fold 0 --views none vflip hflip rot90
+
+parser = argparse.ArgumentParser(description='Extract pooled backbone features per cell and TTA view')
+parser.add_argument('--model-folds-dir', default='output/models/densenet121_1024_all_data__obvious_neg__gradaccum_20__start_lr_3e6', type=str)
+parser.add_argument('--checkpoint', default=None, type=str,
+                    help='checkpoint to extract with (default: <model-folds-dir>/fold<fold>/final.pth)')
+parser.add_argument('--gpu-id', default='0', type=str, help='gpu id used for extraction (default: 0)')
+parser.add_argument('--arch', default='class_densenet121_large_dropout', type=str,
+                    help='model architecture (default: class_densenet121_large_dropout)')
+parser.add_argument('--num_classes', default=19, type=int, help='number of classes (default: 19)')
+parser.add_argument('--in_channels', default=4, type=int, help='in channels (default: 4)')
+parser.add_argument('--cell-img-size', default=512, type=int, help='size of the cell crops (default: 512)')
+parser.add_argument('--target-raw-img-size', default=None, type=int)
+parser.add_argument('--fold', default=0, type=int, help='index of fold (default: 0)')
+parser.add_argument('--cell-level-labels-path', default='output/densenet121_pred.h5', type=str)
+parser.add_argument('--views', nargs='+', default=['none', 'vflip', 'hflip', 'rot90'],
+                    choices=['none', 'vflip', 'hflip', 'rot90'])
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--workers', default=multiprocessing.cpu_count() - 1, type=int)
+parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+parser.add_argument('--out-dir', default=None, type=str,
+                    help='feature store directory (default: output/feature_store/<model dir name>/fold<fold>)')
+
+
+def apply_view(images, view):
+    if view == 'vflip':
+        return torch.flip(images, dims=[2])
+    if view == 'hflip':
+        return torch.flip(images, dims=[3])
+    if view == 'rot90':
+        return torch.rot90(images, 1, dims=[2, 3])
+    return images
+
+
+def main():
+    args = parser.parse_args()
+
+    # set cuda visible device
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+    cudnn.benchmark = True
+
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(args.model_folds_dir, f'fold{args.fold}', 'final.pth')
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = os.path.join(FEATURE_STORE_DIR, os.path.basename(args.model_folds_dir.rstrip('/')),
+                               f'fold{args.fold}')
+    store = FeatureStore(out_dir)
+    if store.is_complete():
+        print(f'Feature store {out_dir} already exists')
+        return
+
+    model_params = {}
+    model_params['architecture'] = args.arch
+    model_params['num_classes'] = args.num_classes
+    model_params['in_channels'] = args.in_channels
+    if 'densenet' not in args.arch:
+        raise ValueError('feature extraction needs DensenetClass.forward_features')
+    checkpoint = torch.load(checkpoint_path)
+    model_params['pruned_config'] = checkpoint.get('pruned_config')
+    model = init_network(model_params)
+    model.load_state_dict(checkpoint['state_dict'])
+    model.cuda()
+    model.eval()
+
+    with open('input/imagelevel_folds_obvious_staining_5.pkl', 'rb') as f:
+        folds = pickle.load(f)
+    trn_img_paths, val_img_paths = folds[args.fold]
+
+    train_df = get_train_df_ohe(clean_from_duplicates=True)
+    public_df = get_public_df_ohe(clean_from_duplicates=True)
+    available_paths = set(np.concatenate((train_df['img_base_path'].values, public_df['img_base_path'].values)))
+    fold_img_paths = [path for path in list(trn_img_paths) + list(val_img_paths) if path in available_paths]
+    val_img_ids = {os.path.basename(path) for path in val_img_paths}
+
+    labels_df = pd.read_hdf(args.cell_level_labels_path)
+    dataset = ProteinDatasetCellSeparateLoading(fold_img_paths,
+                                                labels_df=labels_df,
+                                                in_channels=args.in_channels,
+                                                basepath_2_ohe={},
+                                                target_raw_img_size=args.target_raw_img_size)
+    dataset.set_img_size(args.cell_img_size)
+    loader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=args.batch_size,
+                        drop_last=False, num_workers=args.workers, pin_memory=True,
+                        worker_init_fn=instrumentation.worker_init_fn)
+
+    features_memmap = None
+    start = 0
+    extract_start = time.time()
+    with torch.no_grad():
+        for images, _, indices in tqdm(loader, desc=f'Extracting fold {args.fold}'):
+            images = images.cuda(non_blocking=True)
+            views_features = [model.forward_features(apply_view(images, view)) for view in args.views]
+            views_features = torch.stack(views_features, dim=1).cpu().numpy()
+            if features_memmap is None:
+                features_memmap = store.create(len(dataset), len(args.views), views_features.shape[2],
+                                               dtype=args.dtype)
+            features_memmap[start:start + len(views_features)] = views_features.astype(args.dtype)
+            start += len(views_features)
+
+    img_ids, cell_indices = zip(*[tuple(x) for x in dataset.img_ids_cell])
+    index_df = pd.DataFrame({'ID': img_ids, 'cell_i': cell_indices})
+    index_df['is_valid'] = index_df['ID'].isin(val_img_ids)
+    meta = {
+        'checkpoint': checkpoint_path,
+        'arch': args.arch,
+        'num_classes': args.num_classes,
+        'in_channels': args.in_channels,
+        'fold': args.fold,
+        'views': args.views,
+        'cell_img_size': args.cell_img_size,
+        'target_raw_img_size': args.target_raw_img_size,
+        'cell_level_labels_path': args.cell_level_labels_path,
+        'num_features': int(features_memmap.shape[2]),
+    }
+    store.finalize(features_memmap, index_df, meta)
+    print(f'Stored features of {len(dataset)} cells x {len(args.views)} views in {out_dir} '
+          f'({(time.time() - extract_start) / 60:.1f} min)')
+
+
+if __name__ == '__main__':
+    print('%s: calling main function ... \n' % os.path.basename(__file__))
+    main()
+    print('\nsuccess!')
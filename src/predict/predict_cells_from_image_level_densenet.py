@@ -1,6 +1,6 @@
 import sys
 
-from src.models.encodings_pretrained import BestfittingEncodingsModel
+from src.models.encodings_pretrained import BestfittingLogitsEncodingsModel, BestfittingRoiLogitsEncodingsModel
 
 sys.path.insert(0, '..')
 import argparse
@@ -9,14 +9,21 @@ import pandas as pd
 import torch
 import torch.optim
 from torch.backends import cudnn
-import torch.nn.functional as F
 from albumentations import Compose, VerticalFlip, HorizontalFlip, Rotate
 
 from ..models.layers_bestfitting.loss import *
 from tqdm.auto import tqdm
 from ..models.networks_bestfitting.imageclsnet import init_network
-from ..data.utils import get_train_df_ohe, get_public_df_ohe, get_cells_from_img, get_cell_copied
+from ..data.utils import get_train_df_ohe, get_public_df_ohe, get_cells_from_img, get_cell_copied, \
+    get_img_with_cell_masks
+from ..commons import instrumentation
+from ..commons.profiling import ProfileWindow
+from ..commons.compilation import compile_model
+from .cell_batching import predict_cells_batched
+from ..data.tta import get_cell_views_tensor, get_image_views_tensor, get_cell_views_native, TTA_VIEWS
 import multiprocessing
+import time
+from collections import Counter
 
 
 parser = argparse.ArgumentParser(description='PyTorch Protein Classification')
@@ -30,6 +37,34 @@ parser.add_argument('--img_size', default=1024, type=int, help='image size (defa
 parser.add_argument('--num-folds', default=5, type=int)
 parser.add_argument('--fold-single', default=None, type=int)
 parser.add_argument('--fold-one-fifth-number', default=None, type=int)
+parser.add_argument('--instrument', action='store_true',
+                    help='record stage timings and throughput to output/logs/predict_cells_from_image_level_densenet')
+parser.add_argument('--profile-steps', default=None, type=str,
+                    help='capture a torch.profiler trace for cell forward passes start:end (default: None)')
+parser.add_argument('--profile-on-signal', action='store_true',
+                    help='capture a torch.profiler trace after SIGUSR1 is received')
+parser.add_argument('--profile-signal-steps', default=20, type=int)
+parser.add_argument('--compile', action='store_true',
+                    help='run the model through torch.compile (frozen TorchScript/eager fallback), kernels are cached in output/compile_cache')
+parser.add_argument('--compile-mode', default=None, type=str, help="torch.compile mode, e.g. 'max-autotune' (default: None)")
+parser.add_argument('--cell-batch-size', default=None, type=int,
+                    help='run the TTA views of many cells and images in batches of up to this many views, '
+                         'e.g. 64 (default: None, one forward per cell)')
+parser.add_argument('--tta-device', default=None, choices=['cpu', 'cuda'], type=str,
+                    help='tile the cells and build the TTA views as tensor ops from the uint8 crop on this device, '
+                         'with an exact 90 degree rotation view (default: None, get_cell_copied in numpy)')
+parser.add_argument('--roi-pooling', action='store_true',
+                    help='run the model once per whole image (and TTA view) and pool the encoder5 features inside '
+                         'every cell mask instead of a forward over the tiled crop of every cell')
+parser.add_argument('--roi-views', nargs='+', default=list(TTA_VIEWS), choices=TTA_VIEWS,
+                    help='whole-image TTA views with --roi-pooling (default: %s)' % ' '.join(TTA_VIEWS))
+parser.add_argument('--roi-mask-size', default=128, type=int,
+                    help='side of the cell masks before they are area-resized to the feature map (default: 128)')
+parser.add_argument('--native-size', action='store_true',
+                    help='feed every masked cell at its native size, zero-padded to a square with a side that is a '
+                         'multiple of 32, instead of tiled to 1024x1024; cells are batched per padded size')
+
+NUM_TTA_VIEWS = 4
 
 
 def main():
@@ -40,6 +75,14 @@ def main():
 
     fold_single = args.fold_single
 
+    log_out_dir = os.path.join(RESULT_DIR, 'logs', 'predict_cells_from_image_level_densenet')
+    if args.instrument:
+        if not os.path.exists(log_out_dir):
+            os.makedirs(log_out_dir)
+        instrumentation.enable(os.path.join(log_out_dir, 'stages.jsonl'))
+    profile_window = ProfileWindow(log_out_dir, steps=args.profile_steps, on_signal=args.profile_on_signal,
+                                   signal_steps=args.profile_signal_steps)
+
     # set cuda visible device
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
     cudnn.benchmark = True
@@ -58,26 +101,38 @@ def main():
         model_params['image_size'] = args.img_size
         model_params['encoder'] = args.effnet_encoder
 
+    if args.roi_pooling and (args.compile or args.cell_batch_size is not None or args.native_size):
+        raise ValueError('--roi-pooling is not combined with --compile, --cell-batch-size or --native-size')
+    if args.native_size and args.compile:
+        raise ValueError('--native-size is not combined with --compile, the input sizes vary')
+
     models = []
-    models_features = []
     if fold_single is not None:
         for _ in range(fold_single):
             models.append('a')
-            models_features.append('a')
 
     folds_list = [fold_single] if fold_single is not None else list(range(num_folds))
     for fold in folds_list:
         path = os.path.join(f'{model_dir}', f'fold{fold}', 'final.pth')
         final_checkpoint = torch.load(path)
+        model_params['pruned_config'] = final_checkpoint.get('pruned_config')
         model_ = init_network(model_params)
         model_.load_state_dict(final_checkpoint['state_dict'])
         model_.cuda()
         model_.eval()
+        if args.roi_pooling:
+            models.append(BestfittingRoiLogitsEncodingsModel(model_))
+            continue
+        # logits and embeddings from one backbone pass
+        model_ = BestfittingLogitsEncodingsModel(model_)
+        if args.compile:
+            # one cell with its three TTA copies or a full batch of cells
+            num_views = max(args.cell_batch_size // NUM_TTA_VIEWS, 1) * NUM_TTA_VIEWS if args.cell_batch_size \
+                else NUM_TTA_VIEWS
+            example_input = torch.rand(num_views, args.in_channels, 1024, 1024).cuda()
+            model_ = compile_model(model_, example_input, mode=args.compile_mode)
         models.append(model_)
 
-        embs_extractor = BestfittingEncodingsModel(model_)
-        models_features.append(embs_extractor)
-
     with open('input/imagelevel_folds_obvious_staining_5.pkl', 'rb') as f:
         folds = pickle.load(f)
 
@@ -85,11 +140,13 @@ def main():
     hor_flip = HorizontalFlip(always_apply=True)
     rot = Rotate(always_apply=True, limit=(89, 91))
 
-    embs_output = 'output/densenet121_embs'
+    # the fast modes write next to the tiled outputs, e.g. for src.benchmarks.cell_output_agreement
+    output_suffix = '_roi' if args.roi_pooling else '_native' if args.native_size else ''
+    embs_output = 'output/densenet121_embs' + output_suffix
     if not os.path.exists(embs_output):
         os.makedirs(embs_output)
 
-    pred_output = 'output/densenet121_pred'
+    pred_output = 'output/densenet121_pred' + output_suffix
     if not os.path.exists(pred_output):
         os.makedirs(pred_output)
     for fold in folds_list:
@@ -116,47 +173,173 @@ def main():
         available_paths = set(np.concatenate((train_df['img_base_path'].values, public_df['img_base_path'].values)))
         fold_img_paths = [path for path in val_img_paths if path in available_paths]
 
-        for base_path in tqdm(fold_img_paths[::-1], desc=f'Processing fold {fold}'):
-            cell_2_predictions_list = []
-            cell_2_embs_list = []
-
-            for cell_img in get_cells_from_img(base_path, return_raw=True, target_img_size=1024):
-                classifier_batch_next = get_cell_copied(cell_img, augmentations=[vert_flip, hor_flip, rot])
-                images_batch_torch_np = np.stack(classifier_batch_next).astype(np.float32)
-                images_batch_torch_np = images_batch_torch_np.transpose((0, 3, 1, 2))
-                with torch.no_grad():
-                    cell_predictions_batch = F.sigmoid(models[fold](torch.from_numpy(images_batch_torch_np).cuda())).detach().cpu().numpy()
-
-                cell_predictions_batch_per_cell = np.empty(
-                    (cell_predictions_batch.shape[0] // 4, cell_predictions_batch.shape[1]))
-                for row_i in range(cell_predictions_batch_per_cell.shape[0]):
-                    cell_predictions_batch_per_cell[row_i] = cell_predictions_batch[row_i * 4: (row_i + 1) * 4].mean(
-                        axis=0)
-                cell_2_predictions_list.append(cell_predictions_batch_per_cell)
-
-                with torch.no_grad():
-                    cell_embs_batch = models_features[fold](torch.from_numpy(images_batch_torch_np).cuda()).detach().cpu().numpy()
-                cell_embs_batch_per_cell = np.empty(
-                    (cell_embs_batch.shape[0] // 4, cell_embs_batch.shape[1]))
-                for row_i in range(cell_embs_batch_per_cell.shape[0]):
-                    cell_embs_batch_per_cell[row_i] = cell_embs_batch[row_i * 4: (row_i + 1) * 4].mean(
-                        axis=0)
-                cell_2_embs_list.append(cell_embs_batch_per_cell)
-
-            if len(cell_2_embs_list) == 0: continue
-            cell_2_embs_np = np.concatenate(cell_2_embs_list) if len(cell_2_embs_list) > 1 else cell_2_embs_list[0]
-            cell_2_predictions_np = np.concatenate(cell_2_predictions_list) if len(cell_2_predictions_list) > 1 else cell_2_predictions_list[0]
-
-            img_cell_num_list = list(range(len(cell_2_predictions_np)))
-
-            image_level_labels_df = pd.DataFrame({'img_cell_number': img_cell_num_list,
-                                                  'image_level_pred': [pred_vec for pred_vec in cell_2_predictions_np]})
-            image_level_labels_df.to_hdf(os.path.join(pred_output, f'{os.path.basename(base_path)}.h5'), key='data')
-
-            image_level_embs_df = pd.DataFrame({'img_cell_number': img_cell_num_list,
-                                                'image_level_embs': [embs_vec for embs_vec in cell_2_embs_np]})
-            image_level_embs_df.to_hdf(os.path.join(embs_output, f'{os.path.basename(base_path)}.h5'),
-                                         key='data')
+        fold_start = time.time()
+        if args.roi_pooling:
+            num_cells = predict_fold_roi(fold_img_paths[::-1], models[fold], args.roi_views, args.roi_mask_size,
+                                         profile_window, pred_output, embs_output, desc=f'Processing fold {fold}')
+            fold_sec = time.time() - fold_start
+            print('>> fold %d: %d cells in %.1f sec, %.2f cells/s (ROI pooling, %d views per image)' %
+                  (fold, num_cells, fold_sec, num_cells / max(fold_sec, 1e-6), len(args.roi_views)))
+        elif args.cell_batch_size is not None or args.native_size:
+            # native-size cells without --cell-batch-size run one cell per forward as the tiled ones
+            cell_batch_size = args.cell_batch_size if args.cell_batch_size is not None else NUM_TTA_VIEWS
+            bucket_sizes = Counter() if args.native_size else None
+            num_cells = predict_fold_batched(fold_img_paths[::-1], models[fold], [vert_flip, hor_flip, rot],
+                                             args.tta_device, cell_batch_size, profile_window,
+                                             pred_output, embs_output, desc=f'Processing fold {fold}',
+                                             bucket_sizes=bucket_sizes)
+            fold_sec = time.time() - fold_start
+            print('>> fold %d: %d cells in %.1f sec, %.2f cells/s (batches of up to %d views)' %
+                  (fold, num_cells, fold_sec, num_cells / max(fold_sec, 1e-6), cell_batch_size))
+            if bucket_sizes is not None:
+                print('>> cells per native input size: %s' %
+                      ', '.join('%d: %d' % (side, count) for side, count in sorted(bucket_sizes.items())))
+        else:
+            for base_path in tqdm(fold_img_paths[::-1], desc=f'Processing fold {fold}'):
+                cell_2_predictions_list = []
+                cell_2_embs_list = []
+                instrumentation.count('images')
+
+                cell_start = time.time()
+                for cell_img in get_cells_from_img(base_path, return_raw=True, target_img_size=1024):
+                    profile_window.step()
+                    instrumentation.add_time('cell_crop', time.time() - cell_start)
+                    instrumentation.count('cells')
+                    with instrumentation.timer('tta_prep'):
+                        cell_views = make_cell_views(cell_img, [vert_flip, hor_flip, rot], args.tta_device)
+                    with torch.no_grad(), instrumentation.cuda_synchronized_timer('forward'):
+                        cell_logits_batch, cell_embs_batch = models[fold](cell_views.cuda())
+                        cell_predictions_batch = torch.sigmoid(cell_logits_batch).cpu().numpy()
+                        cell_embs_batch = cell_embs_batch.cpu().numpy()
+
+                    cell_predictions_batch_per_cell = np.empty(
+                        (cell_predictions_batch.shape[0] // 4, cell_predictions_batch.shape[1]))
+                    for row_i in range(cell_predictions_batch_per_cell.shape[0]):
+                        cell_predictions_batch_per_cell[row_i] = cell_predictions_batch[row_i * 4: (row_i + 1) * 4].mean(
+                            axis=0)
+                    cell_2_predictions_list.append(cell_predictions_batch_per_cell)
+
+                    cell_embs_batch_per_cell = np.empty(
+                        (cell_embs_batch.shape[0] // 4, cell_embs_batch.shape[1]))
+                    for row_i in range(cell_embs_batch_per_cell.shape[0]):
+                        cell_embs_batch_per_cell[row_i] = cell_embs_batch[row_i * 4: (row_i + 1) * 4].mean(
+                            axis=0)
+                    cell_2_embs_list.append(cell_embs_batch_per_cell)
+                    cell_start = time.time()
+
+                if len(cell_2_embs_list) == 0: continue
+                cell_2_embs_np = np.concatenate(cell_2_embs_list) if len(cell_2_embs_list) > 1 else cell_2_embs_list[0]
+                cell_2_predictions_np = np.concatenate(cell_2_predictions_list) if len(cell_2_predictions_list) > 1 else cell_2_predictions_list[0]
+
+                write_cell_outputs(base_path, cell_2_predictions_np, cell_2_embs_np, pred_output, embs_output)
+
+        print(instrumentation.format_summary(instrumentation.write_epoch_summary(
+            fold, time.time() - fold_start, phase=f'predict_fold{fold}')), end='')
+
+    profile_window.close()
+
+
+def write_cell_outputs(base_path, cell_2_predictions_np, cell_2_embs_np, pred_output, embs_output):
+    img_cell_num_list = list(range(len(cell_2_predictions_np)))
+
+    with instrumentation.timer('write'):
+        image_level_labels_df = pd.DataFrame({'img_cell_number': img_cell_num_list,
+                                              'image_level_pred': [pred_vec for pred_vec in cell_2_predictions_np]})
+        image_level_labels_df.to_hdf(os.path.join(pred_output, f'{os.path.basename(base_path)}.h5'), key='data')
+
+        image_level_embs_df = pd.DataFrame({'img_cell_number': img_cell_num_list,
+                                            'image_level_embs': [embs_vec for embs_vec in cell_2_embs_np]})
+        image_level_embs_df.to_hdf(os.path.join(embs_output, f'{os.path.basename(base_path)}.h5'),
+                                   key='data')
+
+
+def make_cell_views(cell_img, augmentations, tta_device=None, native_size=False):
+    """(4, C, 1024, 1024) float32 tensor of the tiled cell and its TTA copies, built with get_cell_copied in numpy
+    or, with `tta_device`, as tensor ops on that device. With `native_size` the views are (4, C, S, S) of the
+    zero-padded cell, see get_cell_views_native."""
+    if native_size:
+        return get_cell_views_native(cell_img, device=tta_device or 'cpu')
+    if tta_device is not None:
+        return get_cell_views_tensor(cell_img, device=tta_device)
+    views = np.stack(get_cell_copied(cell_img, augmentations=augmentations)).astype(np.float32)
+    return torch.from_numpy(views.transpose((0, 3, 1, 2)))
+
+
+def get_cell_views(base_path, augmentations, tta_device=None, native_size=False):
+    """The cells of an image, each as the output of make_cell_views."""
+    cell_start = time.time()
+    for cell_img in get_cells_from_img(base_path, return_raw=True, target_img_size=1024):
+        instrumentation.add_time('cell_crop', time.time() - cell_start)
+        instrumentation.count('cells')
+        with instrumentation.timer('tta_prep'):
+            views = make_cell_views(cell_img, augmentations, tta_device, native_size)
+        yield views
+        cell_start = time.time()
+
+
+def predict_fold_batched(img_paths, model, augmentations, tta_device, cell_batch_size, profile_window,
+                         pred_output, embs_output, desc=None, bucket_sizes=None):
+    """Same outputs as the per-cell loop of main, with the TTA views of many cells and images per forward.
+    With a Counter as `bucket_sizes` the cells are fed at their native size, batched per padded size, and
+    counted per size. Returns the number of predicted cells."""
+    native_size = bucket_sizes is not None
+
+    def image_cells():
+        for base_path in tqdm(img_paths, desc=desc):
+            instrumentation.count('images')
+            yield base_path, get_cell_views(base_path, augmentations, tta_device, native_size)
+
+    def bucket_fn(views):
+        bucket_sizes[views.shape[-1]] += 1
+        return views.shape[-1]
+
+    def predict_fn(batch):
+        profile_window.step()
+        with torch.no_grad(), instrumentation.cuda_synchronized_timer('forward'):
+            logits, embs = model(batch.cuda())
+            return torch.sigmoid(logits).cpu().numpy(), embs.cpu().numpy()
+
+    num_cells = 0
+    for base_path, outputs in predict_cells_batched(image_cells(), predict_fn, cell_batch_size,
+                                                    num_views=NUM_TTA_VIEWS, concat=torch.cat,
+                                                    bucket_fn=bucket_fn if native_size else None):
+        if outputs is None:
+            continue
+        cell_2_predictions_np, cell_2_embs_np = outputs
+        write_cell_outputs(base_path, cell_2_predictions_np, cell_2_embs_np, pred_output, embs_output)
+        num_cells += len(cell_2_predictions_np)
+    return num_cells
+
+
+def predict_image_roi(base_path, model, views, mask_size):
+    """(num cells, num classes) TTA mean of the cell probabilities and (num cells, 1024) of the embeddings from
+    whole-image forwards with ROI pooling, None for images without cells."""
+    with instrumentation.timer('decode'):
+        img, cell_masks = get_img_with_cell_masks(base_path, target_img_size=1024, mask_size=mask_size)
+    if len(cell_masks) == 0:
+        return None
+    instrumentation.count('cells', len(cell_masks))
+    with instrumentation.timer('tta_prep'):
+        img_views, mask_views = get_image_views_tensor(img, cell_masks, views=views, device='cuda')
+    with torch.no_grad(), instrumentation.cuda_synchronized_timer('forward'):
+        logits, embs = model(img_views, mask_views)
+        return torch.sigmoid(logits).mean(dim=0).cpu().numpy(), embs.mean(dim=0).cpu().numpy()
+
+
+def predict_fold_roi(img_paths, model, views, mask_size, profile_window, pred_output, embs_output, desc=None):
+    """Outputs of main from one forward per image and view with the cells ROI-pooled from the feature map,
+    written in the same format. Returns the number of predicted cells."""
+    num_cells = 0
+    for base_path in tqdm(img_paths, desc=desc):
+        profile_window.step()
+        instrumentation.count('images')
+        outputs = predict_image_roi(base_path, model, views, mask_size)
+        if outputs is None:
+            continue
+        cell_2_predictions_np, cell_2_embs_np = outputs
+        write_cell_outputs(base_path, cell_2_predictions_np, cell_2_embs_np, pred_output, embs_output)
+        num_cells += len(cell_2_predictions_np)
+    return num_cells
 
 
 if __name__ == '__main__':
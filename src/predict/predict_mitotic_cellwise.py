@@ -20,9 +20,11 @@ from ..data.augment_util_bestfitting import train_multi_augment2
 from ..models.layers_bestfitting.loss import *
 from ..models.layers_bestfitting.scheduler import *
 from ..models.networks_bestfitting.imageclsnet import init_network
-from ..data.datasets import ProteinDatasetCellSeparateLoading #ProteinDatasetCellLevel
+from ..data.datasets import ProteinDatasetCellSeparateLoading, CellSizeBucketBatchSampler #ProteinDatasetCellLevel
 from ..data.utils import get_train_df_ohe, get_public_df_ohe, get_class_names
 from src.commons.utils import Logger
+from src.commons import instrumentation
+from src.data.label_overrides import patch_from_cell_list, apply_label_patches
 import multiprocessing
 import time
 
@@ -60,6 +62,10 @@ parser.add_argument('--target-raw-img-size', default=None, type=int)
 parser.add_argument('--include-nn-mitotic', action='store_true')
 parser.add_argument('--upsample-minorities', action='store_true')
 parser.add_argument('--all-gpus', action='store_true')
+parser.add_argument('--instrument', action='store_true',
+                    help='record stage timings and throughput to stages.jsonl in the log directory')
+parser.add_argument('--size-buckets', nargs='+', default=None, type=int,
+                    help='resize cells to the smallest of these sizes not below their native size and batch per size')
 
 def main():
     args = parser.parse_args()
@@ -69,6 +75,8 @@ def main():
         os.makedirs(log_out_dir)
     log = Logger()
     log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+    if args.instrument:
+        instrumentation.enable(os.path.join(log_out_dir, 'stages.jsonl'))
 
     model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % args.fold)
     log.write(">> Creating directory if it does not exist:\n>> '{}'\n".format(model_out_dir))
@@ -186,14 +194,10 @@ def main():
     print('len cherrypicked_mitotic_spindle_img_cell', len(cherrypicked_mitotic_spindle_img_cell))
     mitotic_bool_idx = labels_df.index.isin(cherrypicked_mitotic_spindle_img_cell)
 
-    def modify_label(labels, idx, val):
-        labels[idx] = val
-        return labels
-
-    labels_df.loc[mitotic_bool_idx, 'image_level_pred'] = labels_df.loc[
-        mitotic_bool_idx, 'image_level_pred'].map(lambda x: modify_label(x, mitotic_spindle_class_i, 1))
-
     labels_df = labels_df.loc[mitotic_bool_idx]
+    labels_df = apply_label_patches(labels_df, [
+        patch_from_cell_list('input/mitotic_cells_selection.csv', 'Mitotic spindle', 1, one_based=True),
+        patch_from_cell_list('input/mitotic_pos_nn_added.csv', 'Mitotic spindle', 1)], class_names=class_names)
 
     valid_dataset = ProteinDatasetCellSeparateLoading(val_img_paths,
                                             labels_df=labels_df,
@@ -201,15 +205,30 @@ def main():
                                             in_channels=args.in_channels,
                                                       basepath_2_ohe=basepath_2_ohe_vector,
                                                       normalize=args.normalize,
-                                                      target_raw_img_size=args.target_raw_img_size)
-    valid_loader = DataLoader(
-        valid_dataset,
-        sampler=SequentialSampler(valid_dataset),
-        batch_size=args.batch_size,
-        drop_last=False,
-        num_workers=args.workers,
-        pin_memory=True
-    )
+                                                      target_raw_img_size=args.target_raw_img_size,
+                                                      size_buckets=args.size_buckets)
+    if args.size_buckets is not None:
+        counts, pixel_ratio = valid_dataset.size_bucket_stats()
+        log.write('>> cells per size bucket: %s, %.1f%% of the convolution FLOPs of fixed %dpx crops\n' %
+                  (', '.join('%dpx: %d' % item for item in counts.items()), 100 * pixel_ratio,
+                   valid_dataset.cell_img_size))
+        valid_loader = DataLoader(
+            valid_dataset,
+            batch_sampler=CellSizeBucketBatchSampler(valid_dataset.cell_buckets, args.batch_size, shuffle=False),
+            num_workers=args.workers,
+            pin_memory=True,
+            worker_init_fn=instrumentation.worker_init_fn,
+        )
+    else:
+        valid_loader = DataLoader(
+            valid_dataset,
+            sampler=SequentialSampler(valid_dataset),
+            batch_size=args.batch_size,
+            drop_last=False,
+            num_workers=args.workers,
+            pin_memory=True,
+            worker_init_fn=instrumentation.worker_init_fn,
+        )
 
     predict_and_store(valid_loader, model, valid_dataset.img_ids_cell, mitotic_idx=mitotic_spindle_class_i,
                       ouput_path=f'output/mitotic_pred_fold_{args.fold}.csv')
@@ -221,13 +240,18 @@ def predict_and_store(valid_loader, model, img_ids_cell, mitotic_idx, ouput_path
 
     probs_list = []
     labels_list = []
+    indices_list = []
 
+    predict_start = time.time()
+    end = time.time()
     for it, iter_data in enumerate(valid_loader, 0):
+        instrumentation.add_time('data_wait', time.time() - end)
         images, labels, indices = iter_data
         images = Variable(images.cuda())
         labels = Variable(labels.cuda())
 
-        outputs = model(images)
+        with instrumentation.cuda_synchronized_timer('forward'):
+            outputs = model(images)
 
         logits = outputs
         probs = F.sigmoid(logits)
@@ -235,8 +259,14 @@ def predict_and_store(valid_loader, model, img_ids_cell, mitotic_idx, ouput_path
 
         probs_list.append(probs.cpu().detach().numpy())
         labels_list.append(labels.cpu().detach().numpy())
+        indices_list.append(np.asarray(indices))
+        end = time.time()
+
+    print(instrumentation.format_summary(instrumentation.write_epoch_summary(
+        0, time.time() - predict_start, phase='predict')), end='')
 
-    probs = np.vstack(probs_list)
+    # size-bucketed loaders do not return the cells in dataset order
+    probs = np.vstack(probs_list)[np.argsort(np.concatenate(indices_list))]
 
     results_df = pd.DataFrame({'ID': [x[0] for x in img_ids_cell], 'cell_i': [x[1] for x in img_ids_cell],
                                'pred': [prob[mitotic_idx] for prob in probs]})
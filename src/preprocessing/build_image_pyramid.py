@@ -0,0 +1,49 @@
+import os
+import glob
+import argparse
+import multiprocessing
+from functools import partial
+
+import cv2
+from tqdm.auto import tqdm
+
+from ..data.utils import PYRAMID_COMPLETE_MARKER
+
+# Stores down-scaled copies of the channel pngs in <images dir>_<size>, ProteinDatasetImageLevel reads them
+# instead of resizing the full-resolution images when training at that size (see --img-size-schedule).
+# A directory is only used once PYRAMID_COMPLETE_MARKER is written, after all pngs of its size; an interrupted
+# run is continued by running the script again.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--img-dirs', nargs='+',
+                    default=['input/hpa-single-cell-image-classification/train', 'input/publichpa_1024'])
+parser.add_argument('--sizes', nargs='+', type=int, default=[512, 768])
+parser.add_argument('--num-workers', default=multiprocessing.cpu_count(), type=int)
+
+
+def resize_png(png_path, out_dir, size):
+    out_path = os.path.join(out_dir, os.path.basename(png_path))
+    if os.path.exists(out_path):
+        return
+    img = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
+    # a run killed while writing must not leave a truncated png, existing files are skipped above
+    tmp_path = out_path[:-len('.png')] + '.tmp.png'
+    # same interpolation as the resize in ProteinDatasetImageLevel.read_rgby
+    cv2.imwrite(tmp_path, cv2.resize(img, (size, size)))
+    os.replace(tmp_path, out_path)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for img_dir in args.img_dirs:
+        png_paths = glob.glob(os.path.join(img_dir, '*.png'))
+        for size in args.sizes:
+            out_dir = f'{img_dir.rstrip("/")}_{size}'
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            with multiprocessing.Pool(args.num_workers) as pool:
+                for _ in tqdm(pool.imap_unordered(partial(resize_png, out_dir=out_dir, size=size), png_paths,
+                                                  chunksize=64),
+                              total=len(png_paths), desc=f'{img_dir} -> {size}'):
+                    pass
+            open(os.path.join(out_dir, PYRAMID_COMPLETE_MARKER), 'w').close()
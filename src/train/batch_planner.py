@@ -0,0 +1,167 @@
+import copy
+import math
+import resource
+import time
+
+import numpy as np
+import torch
+
+# Finds the largest micro-batch that fits the device memory (or a CPU RAM budget) for the model and input size
+# at hand and derives the gradient accumulation steps for a target effective batch size.
+
+
+def _is_oom(e):
+    return isinstance(e, MemoryError) or 'out of memory' in str(e)
+
+
+def _make_batch(sample, batch_size, device):
+    image, label = sample[0], sample[1]
+    image = torch.as_tensor(image).unsqueeze(0).repeat(batch_size, *([1] * np.ndim(image)))
+    label = torch.as_tensor(np.asarray(label)).unsqueeze(0).repeat(batch_size, *([1] * np.ndim(label)))
+    return image.to(device), label.to(device)
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class BatchPlanner(object):
+    def __init__(self, model, criterion, compute_loss, sample, device='cuda', memory_budget_gb=None,
+                 safety_fraction=0.9, max_batch_size=256, log=None):
+        self.model = model
+        self.criterion = criterion
+        self.compute_loss = compute_loss
+        self.sample = sample
+        self.device = torch.device(device)
+        self.memory_budget_gb = memory_budget_gb
+        self.safety_fraction = safety_fraction
+        self.max_batch_size = max_batch_size
+        self.log = log
+        self.rss_per_sample = None
+        self.rss_base = None
+
+    def _write(self, message):
+        if self.log is not None:
+            self.log.write(message)
+        else:
+            print(message, end='')
+
+    def _capacity_bytes(self):
+        if self.memory_budget_gb is not None:
+            return self.memory_budget_gb * 1024 ** 3
+        if self.device.type == 'cuda':
+            return torch.cuda.get_device_properties(self.device).total_memory
+        raise ValueError('--memory-budget-gb is required to plan batches on the CPU')
+
+    def _trial(self, batch_size):
+        """Runs forward/backward for one micro-batch, returns (fits, seconds)."""
+        images, labels = None, None
+        try:
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(self.device)
+            images, labels = _make_batch(self.sample, batch_size, self.device)
+            start = time.time()
+            outputs = self.model(images)
+            loss = self.compute_loss(self.criterion, outputs, labels, 1)
+            loss.backward()
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+                peak = torch.cuda.max_memory_allocated(self.device)
+            else:
+                peak = self._estimate_cpu_peak(batch_size)
+            seconds = time.time() - start
+            fits = peak <= self.safety_fraction * self._capacity_bytes()
+        except (RuntimeError, MemoryError) as e:
+            if not _is_oom(e):
+                raise
+            fits, seconds = False, None
+        finally:
+            del images, labels
+            for param in self.model.parameters():
+                param.grad = None
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+        return fits, seconds
+
+    def _estimate_cpu_peak(self, batch_size):
+        # the process peak RSS only grows, memory per sample is extrapolated from the growth between trials
+        peak = _peak_rss_bytes()
+        if self.rss_base is None:
+            self.rss_base = (batch_size, peak)
+            return peak
+        prev_batch_size, prev_peak = self.rss_base
+        if batch_size > prev_batch_size and peak > prev_peak:
+            self.rss_per_sample = (peak - prev_peak) / (batch_size - prev_batch_size)
+            self.rss_base = (batch_size, peak)
+        if self.rss_per_sample is None:
+            return peak
+        return prev_peak + self.rss_per_sample * (batch_size - prev_batch_size)
+
+    def find_max_micro_batch(self):
+        # BN layers and in-place statistics must not be changed by the probe
+        state_dict = copy.deepcopy(self.model.state_dict())
+        self.model.train()
+
+        # BatchNorm1d in the head needs at least two samples per batch
+        last_fit, first_fail = None, None
+        batch_size = 2
+        while batch_size <= self.max_batch_size:
+            fits, seconds = self._trial(batch_size)
+            if not fits:
+                first_fail = batch_size
+                break
+            last_fit = batch_size
+            batch_size *= 2
+        if last_fit is None:
+            self.model.load_state_dict(state_dict)
+            raise RuntimeError('a micro-batch of 2 samples does not fit into the memory budget')
+
+        if first_fail is None:
+            first_fail = min(batch_size, self.max_batch_size + 1)
+        while first_fail - last_fit > 1:
+            middle = (last_fit + first_fail) // 2
+            fits, _ = self._trial(middle)
+            if fits:
+                last_fit = middle
+            else:
+                first_fail = middle
+
+        self.model.load_state_dict(state_dict)
+        return last_fit
+
+    def measure_throughput(self, batch_size, num_iters=3):
+        state_dict = copy.deepcopy(self.model.state_dict())
+        self.model.train()
+        self._trial(batch_size)
+        seconds = [self._trial(batch_size)[1] for _ in range(num_iters)]
+        self.model.load_state_dict(state_dict)
+        seconds = [s for s in seconds if s is not None]
+        return batch_size / np.median(seconds) if seconds else None
+
+    def plan(self, target_effective_batch):
+        max_micro_batch = self.find_max_micro_batch()
+        agg_steps = max(1, int(math.ceil(target_effective_batch / max_micro_batch)))
+        # spread the target evenly over the accumulation steps instead of a full batch plus a remainder
+        micro_batch = int(math.ceil(target_effective_batch / agg_steps))
+        samples_per_sec = self.measure_throughput(micro_batch)
+        self._write('>> Batch planner: max micro-batch %d, using micro-batch %d x %d accumulation steps '
+                    '(effective %d, target %d), %.1f samples/s forward+backward\n' %
+                    (max_micro_batch, micro_batch, agg_steps, micro_batch * agg_steps, target_effective_batch,
+                     samples_per_sec or 0))
+        return micro_batch, agg_steps
+
+
+def plan_batches(args, model, criterion, compute_loss, dataset, log, device='cuda'):
+    """Probes the model with the first training sample on `device`, the device of the Trainer, and updates
+    args.batch_size and args.gradient_accumulation_steps in place. On the CPU args.memory_budget_gb is the RAM
+    budget."""
+    target = args.target_effective_batch
+    if target is None:
+        target = args.batch_size * args.gradient_accumulation_steps
+    sample = dataset[0]
+    planner = BatchPlanner(model, criterion, compute_loss, sample, device=device,
+                           memory_budget_gb=args.memory_budget_gb, max_batch_size=args.max_micro_batch, log=log)
+    args.batch_size, args.gradient_accumulation_steps = planner.plan(target)
+    return args.batch_size, args.gradient_accumulation_steps
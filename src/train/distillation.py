@@ -0,0 +1,59 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Knowledge distillation of the DenseNet cell classifiers into a smaller student. The stored teacher outputs
+# (image_level_pred) are the training labels of the student in any case, an OnlineTeacher additionally
+# provides teacher logits for the very crops and augmentations the student sees.
+
+
+class DistillationLoss(nn.Module):
+    def __init__(self, base_loss, alpha=0.5, temperature=2.0):
+        super().__init__()
+        self.base_loss = base_loss
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, logit, labels, teacher_logit=None, epoch=0):
+        loss = self.base_loss(logit, labels, epoch=epoch)
+        if teacher_logit is None or self.alpha == 0:
+            return loss
+        t = self.temperature
+        # multi-label outputs: every class is a binary distribution softened by the temperature
+        soft_targets = torch.sigmoid(teacher_logit.float() / t)
+        kd_loss = F.binary_cross_entropy_with_logits(logit / t, soft_targets, reduction='none')
+        kd_loss = kd_loss.sum(dim=1).mean() * t * t
+        return (1 - self.alpha) * loss + self.alpha * kd_loss
+
+
+class OnlineTeacher(object):
+    """Registered as a forward pre-hook on the student: runs the frozen teacher on the training batch and
+    keeps its logits for the loss, then resizes the batch to the input size of the student."""
+
+    def __init__(self, teacher=None, student_img_size=None):
+        self.teacher = teacher
+        self.student_img_size = student_img_size
+        self.logits = None
+        if self.teacher is not None:
+            self.teacher.eval()
+            for param in self.teacher.parameters():
+                param.requires_grad = False
+
+    def attach(self, student):
+        return student.register_forward_pre_hook(self._pre_forward)
+
+    def _pre_forward(self, module, inputs):
+        images = inputs[0]
+        self.logits = None
+        if module.training and self.teacher is not None:
+            with torch.no_grad():
+                self.logits = self.teacher(images)
+        if self.student_img_size is not None and images.shape[-1] != self.student_img_size:
+            images = F.interpolate(images, size=(self.student_img_size, self.student_img_size), mode='bilinear',
+                                   align_corners=False)
+            return (images,) + tuple(inputs[1:])
+        return None
+
+    def compute_loss(self, criterion, outputs, labels, epoch):
+        # validation batches have no teacher logits and are scored against the stored soft labels only
+        return criterion(outputs, labels, teacher_logit=self.logits, epoch=epoch)
@@ -0,0 +1,534 @@
+import os
+import json
+import time
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.nn import DataParallel
+
+from src.commons import instrumentation
+
+
+# Training/validation loop shared by train_bestfitting, train_cellwise and train_cellwise_mitotic_bin.
+# The scripts keep their own data preparation and model construction and configure the Trainer with
+# a loss function, batch/epoch metrics and optional hooks.
+
+
+class AverageMeter(object):
+    """Computes and stores the average and current value"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0.
+        self.avg = 0.
+        self.sum = 0.
+        self.count = 0
+
+    def update(self, val, n=1):
+        self.val = val
+        self.sum += val * n
+        self.count += n
+        self.avg = self.sum / self.count
+
+    def state_dict(self):
+        return {'sum': self.sum, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.sum = state['sum']
+        self.count = state['count']
+        self.avg = self.sum / self.count if self.count > 0 else 0.
+
+
+def unwrap_model(model):
+    # torch.compile keeps the original module in _orig_mod, it may wrap a DataParallel model or be wrapped by one
+    model = getattr(model, '_orig_mod', model)
+    if isinstance(model, DataParallel):
+        model = model.module
+    return getattr(model, '_orig_mod', model)
+
+
+def _drain(meter, pending):
+    # batch values stay on the device until they are printed, which avoids a host sync per step
+    if not pending:
+        return
+    if torch.is_tensor(pending[0]):
+        values = torch.stack([value.detach().float() for value in pending]).cpu().tolist()
+    else:
+        values = [float(value) for value in pending]
+    for value in values:
+        meter.update(value)
+    del pending[:]
+
+
+_END = object()
+
+
+class _ProducerError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class BatchPrefetcher(object):
+    """Iterates over a DataLoader in a background thread and copies the first `num_device_fields`
+    elements of each batch to the device while the previous batches are being processed.
+    Host tensors are pinned (unless the DataLoader did it already) and copied with non_blocking=True
+    on a side CUDA stream, `depth` batches are kept in flight."""
+
+    def __init__(self, loader, device, num_device_fields=2, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_device_fields = num_device_fields
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _move(self, batch):
+        batch = list(batch)
+        for i in range(min(self.num_device_fields, len(batch))):
+            value = batch[i]
+            if torch.is_tensor(value):
+                if self.device.type == 'cuda' and not value.is_pinned():
+                    value = value.pin_memory()
+                batch[i] = value.to(self.device, non_blocking=True)
+        return batch
+
+    def _put(self, out_queue, stop_event, item):
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, out_queue, stop_event):
+        stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                if stop_event.is_set():
+                    return
+                event = None
+                with instrumentation.timer('host_to_device'):
+                    if stream is not None:
+                        with torch.cuda.stream(stream):
+                            batch = self._move(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    else:
+                        batch = self._move(batch)
+                if not self._put(out_queue, stop_event, (batch, event)):
+                    return
+        except Exception as e:
+            self._put(out_queue, stop_event, _ProducerError(e))
+        finally:
+            self._put(out_queue, stop_event, _END)
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=self.depth)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out_queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, _ProducerError):
+                    raise item.exception
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # the tensors were allocated on the side stream, keep the allocator from reusing them early
+                    for value in batch[:self.num_device_fields]:
+                        if torch.is_tensor(value):
+                            value.record_stream(current_stream)
+                yield batch
+        finally:
+            stop_event.set()
+            thread.join()
+
+
+class TrainHooks(object):
+    """Callbacks invoked by the Trainer, subclasses override the ones they need."""
+
+    def on_epoch_start(self, trainer, epoch):
+        pass
+
+    def on_train_start(self, trainer, epoch):
+        pass
+
+    def on_first_batch(self, trainer, epoch):
+        pass
+
+    def after_optimizer_step(self, trainer, epoch, iter):
+        pass
+
+    def on_batch_end(self, trainer, epoch, iter, indices, outputs, labels, loss):
+        pass
+
+    def on_epoch_end(self, trainer, epoch, is_best):
+        pass
+
+
+class ProgressLogger(TrainHooks):
+    """Appends wall-clock time and validation metrics of every epoch to a jsonl file,
+    used to compare time-to-target-score between runs."""
+
+    def __init__(self, out_fpath, img_size=None):
+        self.out_fpath = out_fpath
+        self.img_size = img_size
+        self.start = time.time()
+
+    def on_epoch_end(self, trainer, epoch, is_best):
+        record = {
+            'epoch': epoch,
+            'wall_clock_sec': time.time() - self.start,
+            'img_size': trainer.train_img_size if trainer.train_img_size is not None else self.img_size,
+            'full_val': trainer.last_full_val,
+            'samples_per_sec': trainer.last_samples_per_sec,
+        }
+        record.update({name: float(value) for name, value in trainer.last_metrics.items()})
+        with open(self.out_fpath, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def default_compute_loss(criterion, outputs, labels, epoch):
+    return criterion(outputs, labels, epoch=epoch)
+
+
+class Trainer(object):
+    def __init__(self, model, criterion, optimizer, scheduler, model_out_dir, log, device='cuda', clipnorm=1,
+                 agg_steps=1, compute_loss=default_compute_loss, batch_metric=None, epoch_metrics=None,
+                 score_name='map', greater_is_better=True, best_score_key='best_score', hooks=None,
+                 profile_window=None, prefetch=True, print_freq=10, print_end=''):
+        self.model = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.model_out_dir = model_out_dir
+        self.log = log
+        self.device = torch.device(device)
+        self.clipnorm = clipnorm
+        self.agg_steps = agg_steps
+        self.compute_loss = compute_loss
+        self.batch_metric = batch_metric
+        self.epoch_metrics = epoch_metrics
+        self.score_name = score_name
+        self.greater_is_better = greater_is_better
+        self.best_score_key = best_score_key
+        self.hooks = list(hooks) if hooks is not None else []
+        self.profile_window = profile_window
+        self.prefetch = prefetch
+        self.print_freq = print_freq
+        self.print_end = print_end
+
+        self.start_epoch = 0
+        self.best_epoch = 0
+        self.best_score = float('-inf') if greater_is_better else float('inf')
+        # set by a hook when an interrupted epoch is continued from a step checkpoint
+        self.resume_iter = 0
+        self.resume_meters = None
+        self.train_meters = None
+        self.last_samples_per_sec = None
+        self.last_metrics = None
+        self.last_full_val = True
+        # set by the resolution schedule
+        self.train_img_size = None
+        # set by add_grad_sanitizer, replaces loss.backward() and clip_grad_norm_
+        self.grad_sanitizer = None
+
+    def _call_hooks(self, name, *args):
+        for hook in self.hooks:
+            getattr(hook, name)(self, *args)
+
+    def _iterate(self, loader):
+        if self.prefetch:
+            return BatchPrefetcher(loader, self.device)
+        return loader
+
+    def _to_device(self, value):
+        if self.prefetch or not torch.is_tensor(value):
+            return value
+        return value.to(self.device, non_blocking=True)
+
+    def is_better(self, score):
+        if self.greater_is_better:
+            return score > self.best_score
+        return score < self.best_score
+
+    def backward(self, loss):
+        if self.grad_sanitizer is not None:
+            self.grad_sanitizer.backward(loss)
+        else:
+            loss.backward()
+
+    def clip_grad_norm(self):
+        if self.grad_sanitizer is not None:
+            self.grad_sanitizer.clip_grad_norm_(self.clipnorm)
+        else:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clipnorm)
+
+    def train_meter_state(self):
+        losses, pending_losses, accuracy, pending_accuracy = self.train_meters
+        _drain(losses, pending_losses)
+        _drain(accuracy, pending_accuracy)
+        return {'losses': losses.state_dict(), 'accuracy': accuracy.state_dict()}
+
+    def train_epoch(self, train_loader, epoch, lr, start_iter=0, meter_state=None):
+        batch_time = AverageMeter()
+        data_time = AverageMeter()
+        losses = AverageMeter()
+        accuracy = AverageMeter()
+        if meter_state is not None:
+            losses.load_state_dict(meter_state['losses'])
+            accuracy.load_state_dict(meter_state['accuracy'])
+        pending_losses = []
+        pending_accuracy = []
+        self.train_meters = (losses, pending_losses, accuracy, pending_accuracy)
+
+        # switch to train mode
+        self.model.train()
+        self._call_hooks('on_train_start', epoch)
+
+        num_its = start_iter + len(train_loader)
+        epoch_start = time.time()
+        end = time.time()
+        iter = start_iter
+        num_samples = 0
+        self.optimizer.zero_grad(set_to_none=True)
+        for iter, iter_data in enumerate(self._iterate(train_loader), start_iter):
+            if iter == start_iter:
+                # the loader iterator exists now, creating it drew a base seed from the global RNG
+                self._call_hooks('on_first_batch', epoch)
+            if self.profile_window is not None:
+                self.profile_window.step()
+            # measure data loading time
+            data_time.update(time.time() - end)
+            instrumentation.add_time('data_wait', data_time.val)
+
+            images, labels, indices = iter_data
+            images = self._to_device(images)
+            labels = self._to_device(labels)
+            num_samples += images.size(0)
+
+            with instrumentation.cuda_synchronized_timer('forward'):
+                outputs = self.model(images)
+                loss = self.compute_loss(self.criterion, outputs, labels, epoch)
+
+            with instrumentation.cuda_synchronized_timer('backward'):
+                self.backward(loss)
+
+            # the first batch triggers a step as well, as in the original training scripts
+            if iter % self.agg_steps == 0:
+                with instrumentation.cuda_synchronized_timer('optimizer'):
+                    self.clip_grad_norm()
+                    self.optimizer.step()
+                    # zero out gradients so we can accumulate new ones over batches
+                    self.optimizer.zero_grad(set_to_none=True)
+                self._call_hooks('after_optimizer_step', epoch, iter)
+
+            pending_losses.append(loss.detach())
+            if self.batch_metric is not None:
+                with torch.no_grad():
+                    pending_accuracy.append(self.batch_metric(torch.sigmoid(outputs.detach()), labels))
+            self._call_hooks('on_batch_end', epoch, iter, indices, outputs, labels, loss)
+
+            # measure elapsed time
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if (iter + 1) % self.print_freq == 0 or iter == 0 or (iter + 1) == num_its:
+                _drain(losses, pending_losses)
+                _drain(accuracy, pending_accuracy)
+                print('\r%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  | ... ' % \
+                      (epoch - 1 + (iter + 1) / num_its, iter + 1, lr, losses.avg, accuracy.avg),
+                      end=self.print_end, flush=True)
+
+        _drain(losses, pending_losses)
+        _drain(accuracy, pending_accuracy)
+        self.last_samples_per_sec = num_samples / max(time.time() - epoch_start, 1e-6)
+        print(instrumentation.format_summary(instrumentation.write_epoch_summary(
+            epoch, time.time() - epoch_start, phase='train',
+            extra={'data_time_avg_sec': data_time.avg, 'batch_time_avg_sec': batch_time.avg})), end='')
+
+        return iter, losses.avg, accuracy.avg
+
+    def validate(self, valid_loader, epoch):
+        batch_time = AverageMeter()
+        losses = AverageMeter()
+        accuracy = AverageMeter()
+        pending_losses = []
+        pending_accuracy = []
+
+        # switch to evaluate mode
+        self.model.eval()
+
+        probs_list = []
+        labels_list = []
+        logits_list = []
+
+        valid_start = time.time()
+        end = time.time()
+        with torch.no_grad():
+            for it, iter_data in enumerate(self._iterate(valid_loader), 0):
+                instrumentation.add_time('data_wait', time.time() - end)
+                images, labels, indices = iter_data
+                images = self._to_device(images)
+                labels = self._to_device(labels)
+
+                with instrumentation.cuda_synchronized_timer('forward'):
+                    logits = self.model(images)
+                    loss = self.compute_loss(self.criterion, logits, labels, epoch)
+                probs = torch.sigmoid(logits)
+
+                probs_list.append(probs)
+                labels_list.append(labels)
+                logits_list.append(logits)
+                pending_losses.append(loss)
+                if self.batch_metric is not None:
+                    pending_accuracy.append(self.batch_metric(probs, labels))
+
+                # measure elapsed time
+                batch_time.update(time.time() - end)
+                end = time.time()
+
+        _drain(losses, pending_losses)
+        _drain(accuracy, pending_accuracy)
+        print(instrumentation.format_summary(instrumentation.write_epoch_summary(
+            epoch, time.time() - valid_start, phase='valid',
+            extra={'batch_time_avg_sec': batch_time.avg})), end='')
+
+        probs = torch.cat(probs_list).cpu().numpy()
+        y_true = torch.cat(labels_list).cpu().numpy()
+        logits = torch.cat(logits_list).cpu().numpy()
+        metrics = self.epoch_metrics(probs, y_true, logits) if self.epoch_metrics is not None else OrderedDict()
+
+        return losses.avg, accuracy.avg, metrics
+
+    def _log_header(self, metric_names):
+        self.log.write('** start training here! **\n')
+        self.log.write('\n')
+        self.log.write('epoch    iter      rate     |  train_loss/acc  |    valid_loss/acc/%s     |best_epoch/best_%s|  min \n' %
+                       ('/'.join(metric_names), self.score_name))
+        self.log.write('-----------------------------------------------------------------------------------------------------------------\n')
+
+    def _log_row(self, epoch, iter, lr, train_loss, train_acc, valid_loss, valid_acc, metrics, minutes):
+        print('\r', end='', flush=True)
+        metric_values = ' '.join('%6.4f' % value for value in metrics.values())
+        self.log.write('%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %s    |  %6.1f    %6.4f   | %3.1f min \n' % \
+                       (epoch, iter, lr, train_loss, train_acc, valid_loss, valid_acc, metric_values,
+                        self.best_epoch, self.best_score, minutes))
+
+    def fit(self, train_loader, valid_loader, epochs, eval_at_start=False, metric_names=('map',),
+            fast_valid_loader=None, full_val_every=1):
+        self._log_header(metric_names)
+
+        if eval_at_start:
+            valid_loss, valid_acc, metrics = self.validate(valid_loader, -1)
+            self._log_row(-1, -1, -1, -1, -1, valid_loss, valid_acc, metrics, -1)
+
+        for epoch in range(self.start_epoch + 1, epochs + 1):
+            end = time.time()
+
+            # set manual seeds per epoch
+            np.random.seed(epoch)
+            torch.manual_seed(epoch)
+            torch.cuda.manual_seed_all(epoch)
+            self._call_hooks('on_epoch_start', epoch)
+
+            # adjust learning rate for each epoch
+            lr_list = self.scheduler.step(self.model, epoch, epochs)
+            lr = lr_list[0]
+
+            # train for one epoch on train set
+            iter, train_loss, train_acc = self.train_epoch(train_loader, epoch, lr, start_iter=self.resume_iter,
+                                                           meter_state=self.resume_meters)
+            self.resume_iter = 0
+            self.resume_meters = None
+            self.end_epoch(epoch, epochs, iter, lr, train_loss, train_acc, valid_loader, end,
+                           fast_valid_loader=fast_valid_loader, full_val_every=full_val_every)
+
+        if self.profile_window is not None:
+            self.profile_window.close()
+
+    def end_epoch(self, epoch, epochs, iter, lr, train_loss, train_acc, valid_loader, epoch_start_time,
+                  fast_valid_loader=None, full_val_every=1):
+        """Validation, best score bookkeeping and checkpointing after the train part of an epoch."""
+        if np.isnan(train_loss):
+            self.log.write('>> NaN train loss in epoch %d\n' % epoch)
+        print('\r', end='', flush=True)
+        self.log.write('>> epoch %d: %.1f train samples/s\n' % (epoch, self.last_samples_per_sec))
+
+        # only full validations may select the best checkpoint, the last epoch is always fully validated
+        full_val = fast_valid_loader is None or epoch % full_val_every == 0 or epoch == epochs
+        valid_loss, valid_acc, metrics = self.validate(valid_loader if full_val else fast_valid_loader, epoch)
+        if not full_val:
+            self.log.write('>> epoch %d: fast validation on a subset, best checkpoint is not updated\n' % epoch)
+
+        self.last_metrics = metrics
+        self.last_full_val = full_val
+
+        # remember best score and save checkpoint
+        score = metrics[self.score_name]
+        is_best = full_val and self.is_better(score)
+        self.best_epoch = epoch if is_best else self.best_epoch
+        self.best_score = score if is_best else self.best_score
+
+        self._log_row(epoch, iter + 1, lr, train_loss, train_acc, valid_loss, valid_acc, metrics,
+                      (time.time() - epoch_start_time) / 60)
+        self.save_model(is_best, epoch)
+        self._call_hooks('on_epoch_end', epoch, is_best)
+
+    def save_model(self, is_best, epoch):
+        state_dict = unwrap_model(self.model).state_dict()
+        for key in state_dict.keys():
+            state_dict[key] = state_dict[key].cpu()
+
+        model_fpath = os.path.join(self.model_out_dir, '%03d.pth' % epoch)
+        checkpoint = {
+            'save_dir': self.model_out_dir,
+            'state_dict': state_dict,
+            'best_epoch': self.best_epoch,
+            'epoch': epoch,
+            self.best_score_key: self.best_score,
+        }
+        # pruned networks can only be rebuilt with their dense layer widths
+        pruned_config = getattr(unwrap_model(self.model), 'pruned_config', None)
+        if pruned_config is not None:
+            checkpoint['pruned_config'] = pruned_config
+        torch.save(checkpoint, model_fpath)
+
+        optim_fpath = os.path.join(self.model_out_dir, '%03d_optim.pth' % epoch)
+        torch.save({
+            'optimizer': self.optimizer.state_dict(),
+        }, optim_fpath)
+
+        if is_best:
+            shutil.copyfile(model_fpath, os.path.join(self.model_out_dir, 'final.pth'))
+            shutil.copyfile(optim_fpath, os.path.join(self.model_out_dir, 'final_optim.pth'))
+
+    def resume(self, checkpoint_fpath):
+        if not os.path.isfile(checkpoint_fpath):
+            self.log.write(">> No checkpoint found at '{}'\n".format(checkpoint_fpath))
+            return
+        # load checkpoint weights and update model and optimizer
+        self.log.write(">> Loading checkpoint:\n>> '{}'\n".format(checkpoint_fpath))
+        checkpoint = torch.load(checkpoint_fpath, map_location='cpu')
+        self.start_epoch = checkpoint['epoch']
+        self.best_epoch = checkpoint['best_epoch']
+        self.best_score = checkpoint[self.best_score_key]
+        unwrap_model(self.model).load_state_dict(checkpoint['state_dict'])
+
+        optimizer_fpath = checkpoint_fpath.replace('.pth', '_optim.pth')
+        if os.path.exists(optimizer_fpath):
+            self.log.write(">> Loading checkpoint:\n>> '{}'\n".format(optimizer_fpath))
+            self.optimizer.load_state_dict(torch.load(optimizer_fpath, map_location='cpu')['optimizer'])
+        self.log.write(">>>> loaded checkpoint:\n>>>> '{}' (epoch {})\n".format(checkpoint_fpath, checkpoint['epoch']))
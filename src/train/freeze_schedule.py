@@ -0,0 +1,58 @@
+from src.train.engine import TrainHooks, unwrap_model
+
+# Layer-freezing schedule for DensenetClass fine-tuning, e.g. '1:encoder3,3:none' keeps conv1 to encoder3 frozen
+# in epochs 1-2 and trains the whole network from epoch 3. Frozen blocks run under no_grad, their parameters
+# get no gradients (Adam skips them) and their BatchNorm layers stay in eval mode, i.e. use and keep the
+# running statistics of the checkpoint.
+
+
+def parse_freeze_schedule(schedule, block_names):
+    try:
+        steps = sorted((int(epoch), name) for epoch, name in (item.split(':') for item in schedule.split(',')))
+    except ValueError:
+        raise ValueError(f"--freeze-schedule must look like '1:encoder3,3:none', got '{schedule}'")
+    for _, name in steps:
+        if name != 'none' and name not in block_names:
+            raise ValueError(f"unknown block '{name}' in --freeze-schedule, expected one of "
+                             f"{', '.join(block_names)} or none")
+    return steps
+
+
+def num_frozen_blocks_for_epoch(steps, epoch, block_names):
+    name = 'none'
+    for start_epoch, step_name in steps:
+        if epoch >= start_epoch:
+            name = step_name
+    return 0 if name == 'none' else block_names.index(name) + 1
+
+
+class FreezeSchedule(TrainHooks):
+    def __init__(self, steps, log):
+        self.steps = steps
+        self.log = log
+
+    def frozen_blocks(self, model):
+        return [getattr(model, name) for name in model.FEATURE_BLOCKS[:model.num_frozen_blocks]]
+
+    def on_epoch_start(self, trainer, epoch):
+        model = unwrap_model(trainer.model)
+        num_frozen = num_frozen_blocks_for_epoch(self.steps, epoch, model.FEATURE_BLOCKS)
+        if num_frozen != model.num_frozen_blocks or epoch == trainer.start_epoch + 1:
+            self.log.write('>> epoch %d: frozen blocks: %s\n' %
+                           (epoch, ', '.join(model.FEATURE_BLOCKS[:num_frozen]) or 'none'))
+        model.num_frozen_blocks = num_frozen
+        for i, name in enumerate(model.FEATURE_BLOCKS):
+            for param in getattr(model, name).parameters():
+                param.requires_grad = i >= num_frozen
+
+    def on_train_start(self, trainer, epoch):
+        # called after model.train(), frozen BatchNorm layers must not update their running statistics
+        for block in self.frozen_blocks(unwrap_model(trainer.model)):
+            block.eval()
+
+
+def add_freeze_schedule(trainer, schedule):
+    model = unwrap_model(trainer.model)
+    if not hasattr(model, 'FEATURE_BLOCKS'):
+        raise ValueError('--freeze-schedule is only supported for DensenetClass architectures')
+    trainer.hooks.append(FreezeSchedule(parse_freeze_schedule(schedule, model.FEATURE_BLOCKS), trainer.log))
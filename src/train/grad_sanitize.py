@@ -0,0 +1,132 @@
+from functools import partial
+
+import torch
+
+from src.train.engine import TrainHooks
+
+# Fused replacement of the per-parameter gradient hooks of --clip-and-replace-grad-explosures. The gradients of
+# all trainable parameters are views into one flat buffer per device/dtype, so that NaN/Inf replacement, value
+# clamping, accumulation and norm clipping are a handful of kernels per backward instead of several per parameter.
+# As with the hooks, every backward pass (micro-batch) is sanitized and clamped before it is accumulated.
+
+
+class _FlatGradients(object):
+    def __init__(self, params):
+        self.params = params
+        numel = sum(p.numel() for p in params)
+        self.contribution = torch.zeros(numel, dtype=params[0].dtype, device=params[0].device)
+        self.accumulated = torch.zeros_like(self.contribution)
+        self.contribution_views = self._views(self.contribution)
+        self.accumulated_views = self._views(self.accumulated)
+        # set when a parameter receives a gradient, the hooks only record that and launch no kernels
+        self.touched = [False] * len(params)
+        self.hook_handles = [p.register_hook(partial(self._mark_touched, i)) for i, p in enumerate(params)]
+
+    def _mark_touched(self, i, grad):
+        self.touched[i] = True
+
+    def remove_hooks(self):
+        for handle in self.hook_handles:
+            handle.remove()
+
+    def _views(self, flat):
+        views = []
+        offset = 0
+        for p in self.params:
+            views.append(flat[offset:offset + p.numel()].view_as(p))
+            offset += p.numel()
+        return views
+
+
+class GradSanitizer(TrainHooks):
+    """Runs loss.backward() so that the new gradients land in a zeroed buffer, replaces NaN/Inf by 0, clamps to
+    [-clip_value, clip_value] and adds the result to the gradients accumulated so far. As with the hooks, parameters
+    that got no gradient since the last zero_grad keep grad None, so the optimizer skips them. The number of replaced
+    elements per optimizer step is kept on the device and written to the log at the end of every epoch."""
+
+    def __init__(self, model, log, clip_value=0.5):
+        self.model = model
+        self.log = log
+        self.clip_value = clip_value
+        self.groups = None
+        self.trainable = None
+        self.step_replaced = None
+        self.pending_steps = []
+
+    def _groups(self):
+        trainable = [p for p in self.model.parameters() if p.requires_grad]
+        # rebuilt when the set of trainable parameters changes, e.g. by a freeze schedule
+        if self.trainable is None or len(trainable) != len(self.trainable) or \
+                any(p is not q for p, q in zip(trainable, self.trainable)):
+            for group in self.groups or []:
+                group.remove_hooks()
+            grouped = {}
+            for p in trainable:
+                grouped.setdefault((p.device, p.dtype), []).append(p)
+            self.groups = [_FlatGradients(params) for params in grouped.values()]
+            self.trainable = trainable
+            # gradients accumulated in the old buffers are carried over
+            for group in self.groups:
+                for i, (p, view) in enumerate(zip(group.params, group.accumulated_views)):
+                    if p.grad is not None:
+                        view.copy_(p.grad)
+                        group.touched[i] = True
+                        p.grad = view
+        return self.groups
+
+    def backward(self, loss):
+        groups = self._groups()
+        for group in groups:
+            # set_to_none=True in the optimizer step means nothing has been accumulated yet
+            if not any(p.grad is not None and p.grad.data_ptr() == view.data_ptr()
+                       for p, view in zip(group.params, group.accumulated_views)):
+                group.accumulated.zero_()
+                group.touched = [False] * len(group.params)
+            for p, view in zip(group.params, group.contribution_views):
+                p.grad = view
+        loss.backward()
+        replaced = None
+        for group in groups:
+            contribution = group.contribution
+            num_replaced = (~torch.isfinite(contribution)).sum()
+            replaced = num_replaced if replaced is None else replaced + num_replaced
+            torch.nan_to_num_(contribution, nan=0.0, posinf=0.0, neginf=0.0)
+            contribution.clamp_(-self.clip_value, self.clip_value)
+            group.accumulated.add_(contribution)
+            contribution.zero_()
+            for p, view, touched in zip(group.params, group.accumulated_views, group.touched):
+                p.grad = view if touched else None
+        if replaced is not None:
+            self.step_replaced = replaced if self.step_replaced is None else self.step_replaced + replaced
+
+    def clip_grad_norm_(self, max_norm):
+        """Same scaling as torch.nn.utils.clip_grad_norm_, on the flat buffers."""
+        if not self.groups:
+            return None
+        norms = [group.accumulated.norm(2.0) for group in self.groups]
+        total_norm = torch.stack(norms).norm(2.0) if len(norms) > 1 else norms[0]
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for group in self.groups:
+            group.accumulated.mul_(clip_coef.to(group.accumulated.device))
+        return total_norm
+
+    def after_optimizer_step(self, trainer, epoch, iter):
+        if self.step_replaced is not None:
+            self.pending_steps.append(self.step_replaced)
+        self.step_replaced = None
+
+    def on_epoch_end(self, trainer, epoch, is_best):
+        if not self.pending_steps:
+            return
+        replaced = torch.stack(self.pending_steps).cpu()
+        self.pending_steps = []
+        self.log.write('>> epoch %d: NaN/Inf gradient elements replaced in %d of %d steps, %d in total, '
+                       'at most %d per step\n' % (epoch, int((replaced > 0).sum()), len(replaced),
+                                                  int(replaced.sum()), int(replaced.max())))
+
+
+def add_grad_sanitizer(trainer, clip_value=0.5):
+    sanitizer = GradSanitizer(trainer.model, trainer.log, clip_value=clip_value)
+    trainer.grad_sanitizer = sanitizer
+    trainer.hooks.append(sanitizer)
+    return sanitizer
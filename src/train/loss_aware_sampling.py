@@ -0,0 +1,69 @@
+import os
+
+import torch
+import torch.nn.functional as F
+
+from src.data.datasets import LossAwareSampler
+from src.train.engine import TrainHooks
+
+# Persistent hard-example sampling: the per-sample losses of the training batches are collected into the
+# memory of a LossAwareSampler, which skips easy and oversamples hard or rarely seen samples in later epochs.
+# In contrast to get_hard_samples in layers_bestfitting/hard_example.py no forward pass is spent on skipped samples.
+
+
+def per_sample_bce(outputs, labels):
+    return F.binary_cross_entropy_with_logits(outputs.float(), labels.float(), reduction='none').mean(dim=1)
+
+
+class LossMemory(TrainHooks):
+    """Collects per-sample losses from on_batch_end. The values stay on the device until the end of the epoch,
+    `key_to_index` maps the third element of a batch (dataset index or image id) to the dataset index."""
+
+    def __init__(self, sampler, log, per_sample_loss=per_sample_bce, key_to_index=None):
+        self.sampler = sampler
+        self.log = log
+        self.per_sample_loss = per_sample_loss
+        self.key_to_index = key_to_index
+        self.pending = []
+
+    def on_epoch_start(self, trainer, epoch):
+        self.pending = []
+
+    def on_batch_end(self, trainer, epoch, iter, indices, outputs, labels, loss):
+        if torch.is_tensor(indices):
+            indices = indices.tolist()
+        if self.key_to_index is not None:
+            pairs = [(i, self.key_to_index.get(key)) for i, key in enumerate(indices)]
+            # e.g. tiled copy-paste samples of train_bestfitting are not dataset items
+            pairs = [(i, index) for i, index in pairs if index is not None]
+            if not pairs:
+                return
+            rows, indices = zip(*pairs)
+            if len(rows) < len(outputs):
+                rows = torch.as_tensor(rows, device=outputs.device)
+                outputs, labels = outputs.index_select(0, rows), labels.index_select(0, rows)
+        with torch.no_grad():
+            self.pending.append((list(indices), self.per_sample_loss(outputs.detach(), labels)))
+
+    def on_epoch_end(self, trainer, epoch, is_best):
+        if self.pending:
+            indices = [index for batch_indices, _ in self.pending for index in batch_indices]
+            losses = torch.cat([batch_losses for _, batch_losses in self.pending]).cpu().numpy()
+            self.sampler.update(indices, losses)
+        self.pending = []
+        stats = self.sampler.last_stats
+        if stats is not None:
+            self.log.write('>> epoch %d: loss-aware sampling skipped %d of %d samples, %d hard samples added\n' %
+                           (epoch, stats['skipped'], stats['base'], stats['oversampled']))
+
+
+def add_loss_aware_sampling(trainer, base_sampler, num_items, args, key_to_index=None):
+    """Wraps the train sampler into a LossAwareSampler and registers the hook filling its loss memory."""
+    sampler = LossAwareSampler(base_sampler, num_items, easy_skip_rate=args.easy_skip_rate,
+                               hard_oversample=args.hard_oversample)
+    trainer.hooks.append(LossMemory(sampler, trainer.log, key_to_index=key_to_index))
+    return sampler
+
+
+def img_id_to_index(img_paths):
+    return {os.path.basename(path): i for i, path in enumerate(img_paths)}
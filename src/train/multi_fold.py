@@ -0,0 +1,162 @@
+import time
+
+import numpy as np
+import torch
+
+from src.commons import instrumentation
+from src.train.engine import AverageMeter, _drain
+
+# Co-training of several fold models from one data pipeline. Every image is decoded and augmented once per epoch
+# and routed to the models of all folds whose train split contains it (4 of 5 folds for the 5-fold split),
+# so data loading is paid once for all folds. Each fold keeps its own Trainer, i.e. model, optimizer,
+# scheduler, log, hooks and checkpoints, validation runs per fold on its own validation split.
+
+
+class FoldRouter(object):
+    """Maps the image ids of a batch to the folds whose train split contains them."""
+
+    def __init__(self, fold_train_ids):
+        self.fold_train_ids = {fold: set(ids) for fold, ids in fold_train_ids.items()}
+
+    def indices(self, img_ids, fold):
+        train_ids = self.fold_train_ids[fold]
+        return [i for i, img_id in enumerate(img_ids) if img_id in train_ids]
+
+
+class MultiFoldTrainer(object):
+    def __init__(self, trainers, router, min_fold_batch=2, print_freq=10, profile_window=None):
+        """`trainers` maps fold -> Trainer. Fold sub-batches smaller than `min_fold_batch` are skipped,
+        BatchNorm1d in the heads cannot be trained on a single sample. `profile_window` steps once per
+        shared batch, i.e. over the train steps of all folds."""
+        self.trainers = trainers
+        self.router = router
+        self.profile_window = profile_window
+        self.min_fold_batch = min_fold_batch
+        self.print_freq = print_freq
+        # all trainers share the device, the first one moves the shared batches
+        self.shared = next(iter(trainers.values()))
+
+    def train_epoch(self, train_loader, epoch):
+        data_time = AverageMeter()
+        fold_meters = {}
+        fold_iters = {}
+        fold_samples = {}
+        for fold, trainer in self.trainers.items():
+            losses, accuracy = AverageMeter(), AverageMeter()
+            fold_meters[fold] = (losses, [], accuracy, [])
+            trainer.train_meters = fold_meters[fold]
+            fold_iters[fold] = 0
+            fold_samples[fold] = 0
+            trainer.model.train()
+            trainer._call_hooks('on_train_start', epoch)
+            trainer.optimizer.zero_grad(set_to_none=True)
+
+        num_its = len(train_loader)
+        epoch_start = time.time()
+        end = time.time()
+        iter = 0
+        num_samples = 0
+        for iter, iter_data in enumerate(self.shared._iterate(train_loader), 0):
+            data_time.update(time.time() - end)
+            instrumentation.add_time('data_wait', data_time.val)
+
+            if self.profile_window is not None:
+                self.profile_window.step()
+            images, labels, img_ids = iter_data
+            images = self.shared._to_device(images)
+            labels = self.shared._to_device(labels)
+            num_samples += images.size(0)
+
+            for fold, trainer in self.trainers.items():
+                indices = self.router.indices(img_ids, fold)
+                if len(indices) < self.min_fold_batch:
+                    continue
+                if len(indices) == len(img_ids):
+                    fold_images, fold_labels = images, labels
+                else:
+                    index = torch.as_tensor(indices, device=images.device)
+                    fold_images, fold_labels = images.index_select(0, index), labels.index_select(0, index)
+                fold_samples[fold] += len(indices)
+                self._train_step(trainer, fold_meters[fold], epoch, fold_iters[fold], fold_images, fold_labels,
+                                 [img_ids[i] for i in indices])
+                fold_iters[fold] += 1
+
+            end = time.time()
+            if (iter + 1) % self.print_freq == 0 or iter == 0 or (iter + 1) == num_its:
+                fold_losses = []
+                for fold, (losses, pending_losses, _, _) in fold_meters.items():
+                    _drain(losses, pending_losses)
+                    fold_losses.append('%d: %0.4f' % (fold, losses.avg))
+                print('\r%5.1f   %5d   | train_loss %s | ... ' % (epoch - 1 + (iter + 1) / num_its, iter + 1,
+                                                                 '  '.join(fold_losses)), end='\n', flush=True)
+
+        epoch_sec = max(time.time() - epoch_start, 1e-6)
+        print(instrumentation.format_summary(instrumentation.write_epoch_summary(
+            epoch, epoch_sec, phase='train',
+            extra={'data_time_avg_sec': data_time.avg, 'decoded_samples': num_samples,
+                   'routed_samples': sum(fold_samples.values())})), end='')
+
+        results = {}
+        for fold, trainer in self.trainers.items():
+            losses, pending_losses, accuracy, pending_accuracy = fold_meters[fold]
+            _drain(losses, pending_losses)
+            _drain(accuracy, pending_accuracy)
+            trainer.last_samples_per_sec = fold_samples[fold] / epoch_sec
+            results[fold] = (fold_iters[fold] - 1, losses.avg, accuracy.avg)
+        return results
+
+    def _train_step(self, trainer, meters, epoch, iter, images, labels, img_ids):
+        losses, pending_losses, accuracy, pending_accuracy = meters
+        with instrumentation.cuda_synchronized_timer('forward'):
+            outputs = trainer.model(images)
+            loss = trainer.compute_loss(trainer.criterion, outputs, labels, epoch)
+
+        with instrumentation.cuda_synchronized_timer('backward'):
+            trainer.backward(loss)
+
+        # gradient accumulation counts the sub-batches of the fold, the first one triggers a step as in Trainer
+        if iter % trainer.agg_steps == 0:
+            with instrumentation.cuda_synchronized_timer('optimizer'):
+                trainer.clip_grad_norm()
+                trainer.optimizer.step()
+                trainer.optimizer.zero_grad(set_to_none=True)
+            trainer._call_hooks('after_optimizer_step', epoch, iter)
+
+        pending_losses.append(loss.detach())
+        if trainer.batch_metric is not None:
+            with torch.no_grad():
+                pending_accuracy.append(trainer.batch_metric(torch.sigmoid(outputs.detach()), labels))
+        trainer._call_hooks('on_batch_end', epoch, iter, img_ids, outputs, labels, loss)
+
+    def fit(self, train_loader, valid_loaders, epochs, eval_at_start=False, metric_names=('map',),
+            fast_valid_loaders=None, full_val_every=1):
+        """`valid_loaders` and `fast_valid_loaders` map fold -> loader of the validation split of the fold."""
+        fast_valid_loaders = fast_valid_loaders or {}
+        for fold, trainer in self.trainers.items():
+            trainer._log_header(metric_names)
+            if eval_at_start:
+                valid_loss, valid_acc, metrics = trainer.validate(valid_loaders[fold], -1)
+                trainer._log_row(-1, -1, -1, -1, -1, valid_loss, valid_acc, metrics, -1)
+
+        for epoch in range(1, epochs + 1):
+            end = time.time()
+
+            # set manual seeds per epoch
+            np.random.seed(epoch)
+            torch.manual_seed(epoch)
+            torch.cuda.manual_seed_all(epoch)
+
+            lrs = {}
+            for fold, trainer in self.trainers.items():
+                trainer._call_hooks('on_epoch_start', epoch)
+                lrs[fold] = trainer.scheduler.step(trainer.model, epoch, epochs)[0]
+
+            results = self.train_epoch(train_loader, epoch)
+            for fold, trainer in self.trainers.items():
+                iter, train_loss, train_acc = results[fold]
+                trainer.log.write('>> fold %d\n' % fold)
+                trainer.end_epoch(epoch, epochs, iter, lrs[fold], train_loss, train_acc, valid_loaders[fold], end,
+                                  fast_valid_loader=fast_valid_loaders.get(fold), full_val_every=full_val_every)
+
+        if self.profile_window is not None:
+            self.profile_window.close()
@@ -0,0 +1,64 @@
+import os
+
+import torch
+import torch.nn.functional as F
+from sklearn.metrics import precision_recall_curve, auc
+
+from src.models.networks_bestfitting.densenet import DensenetMultiHead
+from src.train.engine import TrainHooks, default_compute_loss, unwrap_model
+
+# Joint training of the 19 class cell model and the mitotic spindle classifier on DensenetMultiHead.
+# Outputs and labels carry the mitotic task in their last column, cells without a mitotic label have -1 there.
+
+
+def balanced_mitotic_bce(logits, labels):
+    """BCE over the labelled cells, positives and negatives weighted equally as with the MitoticBalancingSubSampler
+    of train_cellwise_mitotic_bin, i.e. mitotic spindle cells are not drowned by the negatives of the batch."""
+    logits, labels = logits.float(), labels.float()
+    bce = F.binary_cross_entropy_with_logits(logits, labels.clamp(min=0), reduction='none')
+    positive = (labels > 0.5).float()
+    negative = ((labels >= 0) & (labels <= 0.5)).float()
+    positive_loss = (bce * positive).sum() / positive.sum().clamp(min=1)
+    negative_loss = (bce * negative).sum() / negative.sum().clamp(min=1)
+    return 0.5 * (positive_loss + negative_loss)
+
+
+def multi_head_compute_loss(criterion, outputs, labels, epoch, mitotic_weight=1.0):
+    class_loss = default_compute_loss(criterion, outputs[:, :-1], labels[:, :-1], epoch)
+    return class_loss + mitotic_weight * balanced_mitotic_bce(outputs[:, -1], labels[:, -1])
+
+
+def class_batch_metric(batch_metric):
+    def metric(preds, targs):
+        return batch_metric(preds[:, :-1], targs[:, :-1])
+    return metric
+
+
+def multi_head_epoch_metrics(probs, y_true, logits, class_epoch_metrics, log):
+    metrics = class_epoch_metrics(probs[:, :-1], y_true[:, :-1], logits[:, :-1])
+    labelled = y_true[:, -1] >= 0
+    if labelled.any():
+        precision, recall, _ = precision_recall_curve(y_true[labelled, -1], probs[labelled, -1])
+        mitotic_pr_auc = auc(recall, precision)
+    else:
+        mitotic_pr_auc = float('nan')
+    log.write(f'Mitotic spindle pr_auc ({int(labelled.sum())} labelled cells): {mitotic_pr_auc:.2f}\n')
+    metrics['mitotic_pr_auc'] = mitotic_pr_auc
+    return metrics
+
+
+class SingleTaskCheckpoints(TrainHooks):
+    """Splits the best checkpoint into final_cells.pth and final_mitotic.pth, DensenetClass checkpoints with
+    19 and 1 classes for the prediction scripts of the separately trained models."""
+
+    def on_epoch_end(self, trainer, epoch, is_best):
+        if not is_best:
+            return
+        state_dict = {key: value.cpu() for key, value in unwrap_model(trainer.model).state_dict().items()}
+        class_state_dict, mitotic_state_dict = DensenetMultiHead.split_state_dict(state_dict)
+        for name, task_state_dict in (('cells', class_state_dict), ('mitotic', mitotic_state_dict)):
+            checkpoint = {'state_dict': task_state_dict, 'epoch': epoch, 'best_epoch': trainer.best_epoch}
+            pruned_config = getattr(unwrap_model(trainer.model), 'pruned_config', None)
+            if pruned_config is not None:
+                checkpoint['pruned_config'] = pruned_config
+            torch.save(checkpoint, os.path.join(trainer.model_out_dir, 'final_%s.pth' % name))
@@ -0,0 +1,143 @@
+# coding: utf-8
+import sys
+sys.path.insert(0, '..')
+import argparse
+import copy
+import subprocess
+
+import torch
+import pandas as pd
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import RandomSampler
+
+from ..models.layers_bestfitting.loss import *
+from ..models.pruning import bn_gamma_importance, taylor_importance, prune_densenet, count_macs
+from ..data.datasets import ProteinDatasetCellSeparateLoading
+from src.train.train_cellwise import get_cell_training_data
+from src.benchmarks.student_speed_vs_map import load_model, evaluate, build_valid_cell_loader
+
+# Prune -> fine-tune -> measure loop for DensenetClass cell classifiers:
+# python -m src.train.prune_densenet --checkpoint output/models/densenet121_cellwise/fold0/final.pth \
+#     --criterion taylor --ratios 0.25 0.5 0.75 --finetune-epochs 2
+# Every ratio is written to output/models/<out_dir>/ratio<r>/fold<k>/pruned.pth (with its pruned_config),
+# fine-tuned with train_cellwise into the same directory and measured on the CPU. The latency/mAP table
+# goes to output/logs/<out_dir>/fold<k>/pruning.csv.
+
+parser = argparse.ArgumentParser(description='Structured bottleneck pruning of DensenetClass')
+parser.add_argument('--checkpoint', required=True, type=str, help='checkpoint of the network to prune')
+parser.add_argument('--arch', default='class_densenet121_dropout', type=str)
+parser.add_argument('--effnet-encoder', default='efficientnet-b0', type=str)
+parser.add_argument('--num_classes', default=19, type=int, help='number of classes (default: 19)')
+parser.add_argument('--in_channels', default=4, type=int, help='in channels (default: 4)')
+parser.add_argument('--fold', default=0, type=int, help='index of fold (default: 0)')
+parser.add_argument('--out_dir', default='densenet121_pruned', type=str)
+parser.add_argument('--criterion', default='bn_gamma', choices=['bn_gamma', 'taylor'])
+parser.add_argument('--ratios', nargs='+', type=float, default=[0.25, 0.5, 0.75],
+                    help='fraction of bottleneck channels removed in every dense layer')
+parser.add_argument('--taylor-batches', default=20, type=int, help='training batches for the Taylor criterion')
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--workers', default=4, type=int)
+parser.add_argument('--cell-level-labels-path', default='output/densenet121_pred.h5', type=str)
+parser.add_argument('--finetune-epochs', default=0, type=int,
+                    help='epochs of train_cellwise after pruning (default: 0, measure the pruned network as is)')
+parser.add_argument('--finetune-args', default='', type=str,
+                    help="further train_cellwise arguments, e.g. '--scheduler Adam10 --batch_size 32'")
+parser.add_argument('--img_size', default=512, type=int, help='input size for MACs and latency (default: 512)')
+parser.add_argument('--cell-img-size', default=512, type=int)
+parser.add_argument('--max-cells', default=500, type=int, help='validation cells for the CPU measurement')
+parser.add_argument('--num-threads', default=None, type=int, help='torch CPU threads for the measurement')
+
+
+def get_taylor_batches(args, device):
+    args.include_nn_mitotic, args.upsample_minorities, args.ignore_negative = False, False, False
+    trn_img_paths, _, basepath_2_ohe_vector, labels_df, _ = get_cell_training_data(args)
+    dataset = ProteinDatasetCellSeparateLoading(trn_img_paths,
+                                                labels_df=labels_df,
+                                                in_channels=args.in_channels,
+                                                basepath_2_ohe=basepath_2_ohe_vector)
+    dataset.set_img_size(args.cell_img_size)
+    loader = DataLoader(dataset, sampler=RandomSampler(dataset), batch_size=args.batch_size,
+                        num_workers=args.workers)
+    batches = []
+    for images, labels, _ in loader:
+        batches.append((images.to(device), labels.to(device)))
+        if len(batches) == args.taylor_batches:
+            break
+    return batches
+
+
+def finetune(args, ratio_out_dir, pruned_fpath):
+    command = [sys.executable, '-m', 'src.train.train_cellwise',
+               '--arch', args.arch, '--fold', str(args.fold), '--out_dir', ratio_out_dir,
+               '--load-state-dict-path', pruned_fpath, '--epochs', str(args.finetune_epochs),
+               '--cell-level-labels-path', args.cell_level_labels_path] + args.finetune_args.split()
+    print(' '.join(command))
+    subprocess.run(command, check=True)
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    args.device = device
+    model = load_model(args.arch, args.img_size, args.checkpoint, args)
+    if args.criterion == 'taylor':
+        focal_loss = FocalLoss()
+        importance = taylor_importance(model, get_taylor_batches(args, device),
+                                       lambda logits, labels: focal_loss(logits, labels))
+    else:
+        importance = bn_gamma_importance(model)
+
+    checkpoints = [('baseline', 0.0, args.checkpoint)]
+    for ratio in args.ratios:
+        pruned_model = copy.deepcopy(model)
+        pruned_config = prune_densenet(pruned_model, importance, ratio)
+        ratio_out_dir = os.path.join(args.out_dir, 'ratio%g' % ratio)
+        model_out_dir = os.path.join(RESULT_DIR, 'models', ratio_out_dir, 'fold%d' % args.fold)
+        if not os.path.exists(model_out_dir):
+            os.makedirs(model_out_dir)
+        pruned_fpath = os.path.join(model_out_dir, 'pruned.pth')
+        state_dict = {key: value.cpu() for key, value in pruned_model.state_dict().items()}
+        torch.save({'state_dict': state_dict, 'pruned_config': pruned_config, 'epoch': 0,
+                    'source_checkpoint': args.checkpoint, 'criterion': args.criterion, 'ratio': ratio},
+                   pruned_fpath)
+        print('ratio %g: kept %d of %d bottleneck channels, saved to %s' %
+              (ratio, sum(pruned_config.values()), sum(importance[name].size for name in pruned_config),
+               pruned_fpath))
+        del pruned_model
+
+        if args.finetune_epochs > 0:
+            finetune(args, ratio_out_dir, pruned_fpath)
+            pruned_fpath = os.path.join(model_out_dir, 'final.pth')
+        checkpoints.append(('pruned' if args.finetune_epochs == 0 else 'finetuned', ratio, pruned_fpath))
+    del model
+
+    # all measurements on the CPU
+    args.device = torch.device('cpu')
+    loader = build_valid_cell_loader(args)
+    rows = []
+    print('%-10s %6s %10s %8s %10s %8s' % ('model', 'ratio', 'params(M)', 'GMACs', 'ms/cell', 'mAP'))
+    for name, ratio, checkpoint_fpath in checkpoints:
+        model = load_model(args.arch, args.img_size, checkpoint_fpath, args)
+        num_params = sum(p.numel() for p in model.parameters()) / 1e6
+        gmacs = count_macs(model, args.img_size, args.in_channels) / 1e9
+        evaluate(model, args.img_size, [next(iter(loader))], args.device)
+        map_score, ms_per_cell, _ = evaluate(model, args.img_size, loader, args.device)
+        print('%-10s %6g %10.2f %8.2f %10.1f %8.4f' % (name, ratio, num_params, gmacs, ms_per_cell, map_score))
+        rows.append({'model': name, 'ratio': ratio, 'checkpoint': checkpoint_fpath, 'params_m': num_params,
+                     'gmacs': gmacs, 'cpu_ms_per_cell': ms_per_cell, 'map': map_score,
+                     'num_threads': torch.get_num_threads()})
+
+    log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'fold%d' % args.fold)
+    if not os.path.exists(log_out_dir):
+        os.makedirs(log_out_dir)
+    pd.DataFrame(rows).to_csv(os.path.join(log_out_dir, 'pruning.csv'), index=False)
+    print('Table written to %s' % os.path.join(log_out_dir, 'pruning.csv'))
+
+
+if __name__ == '__main__':
+    print('%s: calling main function ... \n' % os.path.basename(__file__))
+    main()
+    print('\nsuccess!')
@@ -0,0 +1,48 @@
+from src.train.engine import TrainHooks
+
+# Progressive-resolution training: the train dataset is switched to a new input size at given epochs,
+# e.g. '1:512,4:768,7:1024'. The learning rate schedules of the Adam* schedulers are epoch based and stay as they are,
+# validation keeps the final resolution so that the scores are comparable with fixed-resolution runs.
+
+
+def parse_img_size_schedule(schedule):
+    if schedule is None:
+        return None
+    try:
+        steps = sorted((int(epoch), int(size)) for epoch, size in (item.split(':') for item in schedule.split(',')))
+    except ValueError:
+        raise ValueError(f"--img-size-schedule must look like '1:512,4:768,7:1024', got '{schedule}'")
+    if steps[0][0] > 1:
+        raise ValueError(f"--img-size-schedule must define the size for epoch 1, got '{schedule}'")
+    return steps
+
+
+def img_size_for_epoch(steps, epoch):
+    img_size = steps[0][1]
+    for start_epoch, size in steps:
+        if epoch >= start_epoch:
+            img_size = size
+    return img_size
+
+
+class ResolutionSchedule(TrainHooks):
+    def __init__(self, dataset, steps, log):
+        self.dataset = dataset
+        self.steps = steps
+        self.log = log
+
+    def on_epoch_start(self, trainer, epoch):
+        img_size = img_size_for_epoch(self.steps, epoch)
+        if img_size != trainer.train_img_size:
+            self.log.write('>> epoch %d: training at %dpx\n' % (epoch, img_size))
+        # DataLoader workers are started per epoch and pick up the new size
+        self.dataset.set_img_size(img_size)
+        trainer.train_img_size = img_size
+
+
+def add_resolution_schedule(trainer, dataset, schedule, arch):
+    steps = parse_img_size_schedule(schedule)
+    if 'efficientnet' in arch:
+        # the EfficientNet variants are built for a fixed image_size
+        raise ValueError('--img-size-schedule is not supported for EfficientNet architectures')
+    trainer.hooks.append(ResolutionSchedule(dataset, steps, trainer.log))
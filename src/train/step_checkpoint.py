@@ -0,0 +1,123 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+from src.data.datasets import PlannedSampler
+from src.train.engine import TrainHooks, unwrap_model
+
+# Mid-epoch checkpoints written every N optimizer steps. Together with the planned sample order they allow
+# an interrupted epoch to continue from the next batch instead of from the last epoch checkpoint.
+# Sample order, weights, optimizer, scheduler and meters are restored exactly. The main-process RNG streams,
+# e.g. for dropout, are restored at the first batch of the continued epoch, after the DataLoader iterator has drawn
+# its base seed from them. Random augmentations inside DataLoader workers are not replayed.
+
+STEP_CHECKPOINT_NAME = 'step_last.pth'
+
+
+def get_rng_state():
+    np_state = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        # numpy state is stored as a tensor so the checkpoint can be read with torch.load(weights_only=True)
+        'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), np_state[2], np_state[3], np_state[4]),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), np_state[2], np_state[3], np_state[4]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class StepCheckpointer(TrainHooks):
+    def __init__(self, model_out_dir, sampler, batch_size, every_n_steps, log):
+        self.checkpoint_fpath = os.path.join(model_out_dir, STEP_CHECKPOINT_NAME)
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.every_n_steps = every_n_steps
+        self.log = log
+        self.num_steps = 0
+        self.resume_state = None
+        self.resume_rng = None
+
+    def on_epoch_start(self, trainer, epoch):
+        if self.resume_state is not None and self.resume_state['epoch'] == epoch:
+            state = self.resume_state
+            self.resume_state = None
+            self.sampler.load_state_dict(state['sampler'])
+            trainer.resume_iter = state['iter'] + 1
+            trainer.resume_meters = state['meters']
+            self.resume_rng = state['rng']
+            self.log.write('>> Continuing epoch %d from batch %d\n' % (epoch, trainer.resume_iter))
+        else:
+            self.sampler.plan_epoch()
+
+    def on_first_batch(self, trainer, epoch):
+        if self.resume_rng is not None:
+            set_rng_state(self.resume_rng)
+            self.resume_rng = None
+
+    def after_optimizer_step(self, trainer, epoch, iter):
+        self.num_steps += 1
+        if self.every_n_steps > 0 and self.num_steps % self.every_n_steps == 0:
+            self.save(trainer, epoch, iter)
+
+    def on_epoch_end(self, trainer, epoch, is_best):
+        # the epoch checkpoint supersedes the step checkpoint
+        if os.path.exists(self.checkpoint_fpath):
+            os.remove(self.checkpoint_fpath)
+
+    def save(self, trainer, epoch, iter):
+        scheduler_state = {key: value for key, value in vars(trainer.scheduler).items()
+                           if key != '_cur_optimizer'}
+        state = {
+            'epoch': epoch,
+            'iter': iter,
+            'state_dict': unwrap_model(trainer.model).state_dict(),
+            'optimizer': trainer.optimizer.state_dict(),
+            'scheduler': scheduler_state,
+            'best_epoch': trainer.best_epoch,
+            'best_score': float(trainer.best_score),
+            'sampler': {'plan': self.sampler.plan, 'offset': (iter + 1) * self.batch_size},
+            'meters': trainer.train_meter_state(),
+            'rng': get_rng_state(),
+        }
+        # a crash while writing must not destroy the previous step checkpoint
+        torch.save(state, self.checkpoint_fpath + '.tmp')
+        os.replace(self.checkpoint_fpath + '.tmp', self.checkpoint_fpath)
+
+    def load(self, trainer, checkpoint_fpath):
+        if not os.path.isfile(checkpoint_fpath):
+            self.log.write(">> No step checkpoint found at '{}'\n".format(checkpoint_fpath))
+            return
+        self.log.write(">> Loading step checkpoint:\n>> '{}'\n".format(checkpoint_fpath))
+        state = torch.load(checkpoint_fpath, map_location='cpu')
+        unwrap_model(trainer.model).load_state_dict(state['state_dict'])
+        trainer.optimizer.load_state_dict(state['optimizer'])
+        vars(trainer.scheduler).update(state['scheduler'])
+        trainer.start_epoch = state['epoch'] - 1
+        trainer.best_epoch = state['best_epoch']
+        trainer.best_score = state['best_score']
+        self.resume_state = state
+        self.log.write(">>>> loaded step checkpoint (epoch {}, batch {})\n".format(state['epoch'], state['iter'] + 1))
+
+
+def add_step_checkpointing(trainer, sampler, batch_size, every_n_steps, resume_step=None):
+    """Wraps the train sampler into a PlannedSampler and registers the checkpointing hook on the trainer.
+    `resume_step` is a checkpoint path or 'last' for the step checkpoint in the model directory."""
+    sampler = PlannedSampler(sampler)
+    checkpointer = StepCheckpointer(trainer.model_out_dir, sampler, batch_size, every_n_steps, trainer.log)
+    trainer.hooks.append(checkpointer)
+    if resume_step is not None:
+        checkpoint_fpath = checkpointer.checkpoint_fpath if resume_step == 'last' else resume_step
+        checkpointer.load(trainer, checkpoint_fpath)
+    return sampler
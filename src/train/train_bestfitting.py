@@ -3,29 +3,38 @@ import sys
 
 sys.path.insert(0, '..')
 import argparse
-import shutil
 import pickle
+from collections import OrderedDict
+from functools import partial
 
 import torch
 import pandas as pd
 import torch.optim
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import RandomSampler, SequentialSampler
-from torch.nn import DataParallel
+from torch.utils.data.sampler import RandomSampler
 from torch.backends import cudnn
-import torch.nn.functional as F
-from torch.autograd import Variable
 from sklearn.metrics import average_precision_score
 
 from ..data.augment_util_bestfitting import train_multi_augment2
 from ..models.layers_bestfitting.loss import *
 from ..models.layers_bestfitting.scheduler import *
 from ..models.networks_bestfitting.imageclsnet import init_network
-from ..data.datasets import ProteinDatasetImageLevel, BalancingSubSampler
+from ..data.datasets import ProteinDatasetImageLevel, BalancingSubSampler, LossAwareSampler
 from ..data.utils import get_train_df_ohe, get_public_df_ohe, get_class_names
 from src.commons.utils import Logger
+from src.commons import instrumentation
+from src.commons.profiling import ProfileWindow
+from src.train.engine import Trainer, ProgressLogger, default_compute_loss
+from src.train.step_checkpoint import add_step_checkpointing
+from src.train.loss_aware_sampling import add_loss_aware_sampling, img_id_to_index, LossMemory
+from src.train.batch_planner import plan_batches
+from src.data.val_cache import build_valid_loaders
+from src.commons.compilation import compile_model
+from src.train.resolution_schedule import add_resolution_schedule
+from src.train.freeze_schedule import add_freeze_schedule
+from src.train.grad_sanitize import add_grad_sanitizer
+from src.train.multi_fold import FoldRouter, MultiFoldTrainer
 import multiprocessing
-import time
 
 loss_names = ['FocalSymmetricLovaszHardLogLoss']
 
@@ -66,16 +75,63 @@ parser.add_argument('--clean-mitotic-samples', action='store_true')
 parser.add_argument('--clean-aggresome', action='store_true')
 parser.add_argument('--copy-paste-augment-mitotic-aggresome', action='store_true')
 parser.add_argument('--clip-and-replace-grad-explosures', action='store_true')
+parser.add_argument('--instrument', action='store_true',
+                    help='record stage timings and throughput to stages.jsonl in the log directory')
+parser.add_argument('--profile-steps', default=None, type=str,
+                    help='capture a torch.profiler trace for global training steps start:end (default: None)')
+parser.add_argument('--profile-on-signal', action='store_true',
+                    help='capture a torch.profiler trace after SIGUSR1 is received')
+parser.add_argument('--profile-signal-steps', default=20, type=int)
+parser.add_argument('--step-checkpoint-every', default=0, type=int,
+                    help='write step_last.pth every N optimizer steps to continue an interrupted epoch (default: 0, off)')
+parser.add_argument('--resume-step', default=None, type=str,
+                    help="step checkpoint to continue an interrupted epoch from, 'last' for step_last.pth of out_dir")
+parser.add_argument('--auto-batch', action='store_true',
+                    help='probe the largest micro-batch that fits and derive the gradient accumulation steps')
+parser.add_argument('--target-effective-batch', default=None, type=int,
+                    help='effective batch size for --auto-batch (default: batch_size * gradient-accumulation-steps)')
+parser.add_argument('--memory-budget-gb', default=None, type=float,
+                    help='memory budget for --auto-batch (default: the whole device memory)')
+parser.add_argument('--max-micro-batch', default=256, type=int)
+parser.add_argument('--val-cache', action='store_true',
+                    help='decode the validation inputs once into a memory-mapped store under output/val_cache')
+parser.add_argument('--fast-val-fraction', default=None, type=float,
+                    help='validate on a fixed stratified subset of this size, except every --full-val-every epochs')
+parser.add_argument('--full-val-every', default=5, type=int)
+parser.add_argument('--compile', action='store_true',
+                    help='run the model through torch.compile (eager fallback), kernels are cached in output/compile_cache')
+parser.add_argument('--compile-mode', default=None, type=str, help="torch.compile mode, e.g. 'max-autotune' (default: None)")
+parser.add_argument('--loss-aware-sampling', action='store_true',
+                    help='skip easy and oversample hard samples using the losses remembered from earlier epochs')
+parser.add_argument('--easy-skip-rate', default=0.5, type=float, help='probability of skipping an easy sample (default: 0.5)')
+parser.add_argument('--hard-oversample', default=0.1, type=float,
+                    help='extra loss-weighted draws per epoch as a fraction of the epoch (default: 0.1)')
+parser.add_argument('--img-size-schedule', default=None, type=str,
+                    help="progressive resolution by epoch, e.g. '1:512,4:768,7:1024' (default: None, fixed img_size)")
+parser.add_argument('--freeze-schedule', default=None, type=str,
+                    help="DensenetClass blocks frozen by epoch, e.g. '1:encoder3,3:none' (default: None, nothing frozen)")
+parser.add_argument('--crop-size', default=0, type=int,
+                    help='train on random crop_size windows (at the img_size scale) containing whole cells, '
+                         'validation stays on full images (default: 0, full images)')
+parser.add_argument('--co-train-folds', nargs='+', default=None, type=int,
+                    help='train the models of these folds in one process from a shared data pipeline (default: None)')
 
 
 def main():
     args = parser.parse_args()
+    if args.co_train_folds is not None:
+        co_train(args)
+        return
 
     log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'fold%d' % args.fold)
     if not os.path.exists(log_out_dir):
         os.makedirs(log_out_dir)
     log = Logger()
     log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+    if args.instrument:
+        instrumentation.enable(os.path.join(log_out_dir, 'stages.jsonl'))
+    profile_window = ProfileWindow(log_out_dir, steps=args.profile_steps, on_signal=args.profile_on_signal,
+                                   signal_steps=args.profile_signal_steps, log=log)
 
     model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % args.fold)
     log.write(">> Creating directory if it does not exist:\n>> '{}'\n".format(model_out_dir))
@@ -92,36 +148,10 @@ def main():
     torch.cuda.manual_seed_all(0)
     np.random.seed(0)
 
-    model_params = {}
-    model_params['architecture'] = args.arch
-    model_params['num_classes'] = args.num_classes
-    model_params['in_channels'] = args.in_channels
-    if 'efficientnet' in args.arch:
-        model_params['image_size'] = args.img_size
-        model_params['encoder'] = args.effnet_encoder
-    model = init_network(model_params)
-
-    if args.load_state_dict_path is not None:
-        init_pretrained = torch.load(args.load_state_dict_path)
-        model.load_state_dict(init_pretrained['state_dict'])
-    # state_dict = model.state_dict()
-    # torch.save({
-    #     'state_dict': state_dict
-    # }, 'output/densenet121_bestfitting_converted_classes.h5')
-    # sys.exit(0)
-    # move network to gpu
-    # model = DataParallel(model)
-
-    if args.clip_and_replace_grad_explosures:
-        def clip_and_replace_explosures(grad):
-            grad[torch.logical_or(torch.isnan(grad), torch.isinf(grad))] = torch.tensor(0.0).cuda()
-            grad = torch.clamp(grad, -0.5, 0.5)
-            return grad
-
-        for param in model.parameters():
-            if param.requires_grad:
-                param.register_hook(clip_and_replace_explosures)
-    model.cuda()
+    model = build_model(args)
+    if args.compile:
+        model = compile_model(model, torch.rand(2, args.in_channels, args.img_size, args.img_size).cuda(), train=True,
+                              mode=args.compile_mode, log=log)
 
     # define loss function (criterion)
     try:
@@ -129,46 +159,181 @@ def main():
     except:
         raise (RuntimeError("Loss {} not available!".format(args.loss)))
 
-    start_epoch = 0
-    best_loss = 1e5
-    best_epoch = 0
-    best_map = 0
-
     # define scheduler
     try:
         scheduler = eval(args.scheduler)(scheduler_lr_multiplier=args.scheduler_lr_multiplier,
                                          scheduler_epoch_offset=args.scheduler_epoch_offset)
     except:
         raise (RuntimeError("Scheduler {} not available!".format(args.scheduler)))
-    optimizer = scheduler.schedule(model, start_epoch, args.epochs)[0]
+    optimizer = scheduler.schedule(model, 0, args.epochs)[0]
+
+    trainer = Trainer(model, criterion, optimizer, scheduler, model_out_dir, log,
+                      clipnorm=args.clipnorm, agg_steps=args.gradient_accumulation_steps,
+                      batch_metric=multi_class_acc, epoch_metrics=partial(epoch_metrics, log=log),
+                      score_name='map', greater_is_better=True, best_score_key='best_score',
+                      profile_window=profile_window, print_end='\n')
+
+    if args.clip_and_replace_grad_explosures:
+        # NaN/Inf gradient elements are set to 0 and all elements clamped to [-0.5, 0.5] before accumulation
+        add_grad_sanitizer(trainer, clip_value=0.5)
 
     # optionally resume from a checkpoint
     if args.resume:
-        # args.resume = os.path.join(model_out_dir, args.resume)
-        if os.path.isfile(args.resume):
-            # load checkpoint weights and update model and optimizer
-            log.write(">> Loading checkpoint:\n>> '{}'\n".format(args.resume))
-
-            checkpoint = torch.load(args.resume)
-            start_epoch = checkpoint['epoch']
-            best_epoch = checkpoint['best_epoch']
-            best_map = checkpoint['best_score']
-            model.module.load_state_dict(checkpoint['state_dict'])
-
-            optimizer_fpath = args.resume.replace('.pth', '_optim.pth')
-            if os.path.exists(optimizer_fpath):
-                log.write(">> Loading checkpoint:\n>> '{}'\n".format(optimizer_fpath))
-                optimizer.load_state_dict(torch.load(optimizer_fpath)['optimizer'])
-            log.write(">>>> loaded checkpoint:\n>>>> '{}' (epoch {})\n".format(args.resume, checkpoint['epoch']))
-        else:
-            log.write(">> No checkpoint found at '{}'\n".format(args.resume))
+        trainer.resume(args.resume)
+
+    trn_img_paths, val_img_paths, basepath_2_ohe_vector = get_fold_img_paths(args, args.fold)
+    train_dataset, valid_dataset, sampler = build_datasets(args, trn_img_paths, val_img_paths, basepath_2_ohe_vector)
+    trainer.hooks.append(ProgressLogger(os.path.join(log_out_dir, 'progress.jsonl'), img_size=args.img_size))
+    if args.img_size_schedule is not None:
+        add_resolution_schedule(trainer, train_dataset, args.img_size_schedule, args.arch)
+    if args.freeze_schedule is not None:
+        add_freeze_schedule(trainer, args.freeze_schedule)
+    if args.auto_batch:
+        plan_batches(args, model, criterion, default_compute_loss, train_dataset, log, device=trainer.device)
+        trainer.agg_steps = args.gradient_accumulation_steps
+    if args.loss_aware_sampling:
+        # copy-paste samples come back as 'tiled' and are not tracked
+        sampler = add_loss_aware_sampling(trainer, sampler, len(train_dataset), args,
+                                          key_to_index=img_id_to_index(train_dataset.img_paths))
+    if args.step_checkpoint_every > 0 or args.resume_step is not None:
+        sampler = add_step_checkpointing(trainer, sampler, args.batch_size, args.step_checkpoint_every,
+                                         resume_step=args.resume_step)
 
-    # Data loading code
-    train_transform = train_multi_augment2
+    train_loader = DataLoader(
+        train_dataset,
+        sampler=sampler,
+        batch_size=args.batch_size,
+        drop_last=True,
+        num_workers=args.workers,
+        pin_memory=True,
+        worker_init_fn=instrumentation.worker_init_fn,
+    )
+    valid_loader, fast_valid_loader = build_valid_loaders(args, valid_dataset, log)
+
+    trainer.fit(train_loader, valid_loader, args.epochs, eval_at_start=args.eval_at_start,
+                metric_names=('focal', 'map'),
+                fast_valid_loader=fast_valid_loader, full_val_every=args.full_val_every)
+
+
+def co_train(args):
+    unsupported = [('--copy-paste-augment-mitotic-aggresome', args.copy_paste_augment_mitotic_aggresome),
+                   ('--resume', args.resume is not None), ('--auto-batch', args.auto_batch),
+                   ('--step-checkpoint-every/--resume-step', args.step_checkpoint_every > 0 or args.resume_step is not None)]
+    for name, is_set in unsupported:
+        if is_set:
+            raise ValueError('%s is not supported with --co-train-folds' % name)
+
+    # stage timings and profiler traces cover the shared pipeline of all folds
+    shared_log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'co_train')
+    if not os.path.exists(shared_log_out_dir):
+        os.makedirs(shared_log_out_dir)
+    if args.instrument:
+        instrumentation.enable(os.path.join(shared_log_out_dir, 'stages.jsonl'))
+    profile_window = ProfileWindow(shared_log_out_dir, steps=args.profile_steps, on_signal=args.profile_on_signal,
+                                   signal_steps=args.profile_signal_steps)
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+    cudnn.benchmark = True
+
+    # set random seeds
+    torch.manual_seed(0)
+    torch.cuda.manual_seed_all(0)
+    np.random.seed(0)
+
+    trainers = OrderedDict()
+    fold_train_ids = {}
+    valid_loaders, fast_valid_loaders = {}, {}
+    union_trn_img_paths = OrderedDict()
+    for fold in args.co_train_folds:
+        log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'fold%d' % fold)
+        if not os.path.exists(log_out_dir):
+            os.makedirs(log_out_dir)
+        log = Logger()
+        log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+        model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % fold)
+        log.write(">> Co-training folds {}, creating directory if it does not exist:\n>> '{}'\n".format(
+            args.co_train_folds, model_out_dir))
+        if not os.path.exists(model_out_dir):
+            os.makedirs(model_out_dir)
+
+        model = build_model(args)
+        if args.compile:
+            model = compile_model(model, torch.rand(2, args.in_channels, args.img_size, args.img_size).cuda(),
+                                  train=True, mode=args.compile_mode, log=log)
+        criterion = eval(args.loss)().cuda()
+        scheduler = eval(args.scheduler)(scheduler_lr_multiplier=args.scheduler_lr_multiplier,
+                                         scheduler_epoch_offset=args.scheduler_epoch_offset)
+        optimizer = scheduler.schedule(model, 0, args.epochs)[0]
+        trainer = Trainer(model, criterion, optimizer, scheduler, model_out_dir, log,
+                          clipnorm=args.clipnorm, agg_steps=args.gradient_accumulation_steps,
+                          batch_metric=multi_class_acc, epoch_metrics=partial(epoch_metrics, log=log),
+                          score_name='map', greater_is_better=True, best_score_key='best_score', print_end='\n')
+        trainer.hooks.append(ProgressLogger(os.path.join(log_out_dir, 'progress.jsonl'), img_size=args.img_size))
+        if args.freeze_schedule is not None:
+            add_freeze_schedule(trainer, args.freeze_schedule)
+        if args.clip_and_replace_grad_explosures:
+            add_grad_sanitizer(trainer, clip_value=0.5)
+        trainers[fold] = trainer
+
+        trn_img_paths, val_img_paths, basepath_2_ohe_vector = get_fold_img_paths(args, fold)
+        fold_train_ids[fold] = {os.path.basename(path) for path in trn_img_paths}
+        union_trn_img_paths.update((path, None) for path in trn_img_paths)
+        valid_dataset = build_valid_dataset(args, val_img_paths, basepath_2_ohe_vector)
+        valid_loaders[fold], fast_valid_loaders[fold] = build_valid_loaders(args, valid_dataset, log)
+
+    # one train dataset over the union of the train splits, every image is routed to the folds that train on it;
+    # the labels do not depend on the fold, basepath_2_ohe_vector of the last fold serves all of them
+    train_dataset, _, sampler = build_datasets(args, list(union_trn_img_paths), [], basepath_2_ohe_vector)
+    if args.img_size_schedule is not None:
+        for trainer in trainers.values():
+            add_resolution_schedule(trainer, train_dataset, args.img_size_schedule, args.arch)
+    if args.loss_aware_sampling:
+        # one sampler over the shared epoch, every fold adds the losses of its model on the images it trains on
+        sampler = LossAwareSampler(sampler, len(train_dataset), easy_skip_rate=args.easy_skip_rate,
+                                   hard_oversample=args.hard_oversample)
+        key_to_index = img_id_to_index(train_dataset.img_paths)
+        for trainer in trainers.values():
+            trainer.hooks.append(LossMemory(sampler, trainer.log, key_to_index=key_to_index))
+    train_loader = DataLoader(
+        train_dataset,
+        sampler=sampler,
+        batch_size=args.batch_size,
+        drop_last=True,
+        num_workers=args.workers,
+        pin_memory=True,
+        worker_init_fn=instrumentation.worker_init_fn,
+    )
+
+    multi_fold_trainer = MultiFoldTrainer(trainers, FoldRouter(fold_train_ids), profile_window=profile_window)
+    multi_fold_trainer.fit(train_loader, valid_loaders, args.epochs, eval_at_start=args.eval_at_start,
+                           metric_names=('focal', 'map'), fast_valid_loaders=fast_valid_loaders,
+                           full_val_every=args.full_val_every)
+
+
+def build_model(args):
+    model_params = {}
+    model_params['architecture'] = args.arch
+    model_params['num_classes'] = args.num_classes
+    model_params['in_channels'] = args.in_channels
+    if 'efficientnet' in args.arch:
+        model_params['image_size'] = args.img_size
+        model_params['encoder'] = args.effnet_encoder
+    init_pretrained = None
+    if args.load_state_dict_path is not None:
+        init_pretrained = torch.load(args.load_state_dict_path)
+        # pruned checkpoints carry the widths of their dense layers
+        model_params['pruned_config'] = init_pretrained.get('pruned_config')
+    model = init_network(model_params)
+
+    if init_pretrained is not None:
+        model.load_state_dict(init_pretrained['state_dict'])
+    model.cuda()
+    return model
 
+
+def get_fold_img_paths(args, fold):
     with open('input/imagelevel_folds_obvious_staining_5.pkl', 'rb') as f:
         folds = pickle.load(f)
-    fold = args.fold
     trn_img_paths, val_img_paths = folds[fold]
 
     train_df = get_train_df_ohe(clean_from_duplicates=args.clean_duplicates,
@@ -177,8 +342,6 @@ def main():
     if args.ignore_negs:
         train_df['Negative'] = 0
 
-    train_paths_set = set(train_df['img_base_path'])
-
     basepath_2_ohe_vector = {img: vec for img, vec in zip(train_df['img_base_path'], train_df.iloc[:, 2:].values)}
 
     train_paths_set = set(train_df['img_base_path'])
@@ -192,50 +355,62 @@ def main():
         public_basepath_2_ohe_vector = {img_path: vec for img_path, vec in zip(public_hpa_df_17['img_base_path'],
                                                                                public_hpa_df_17.iloc[:, 2:].values)}
         basepath_2_ohe_vector.update(public_basepath_2_ohe_vector)
-    else:
-        trn_img_paths = [path for path in trn_img_paths if path in train_paths_set]
-
-    if not args.without_public_data:
         available_paths = set(np.concatenate((train_df['img_base_path'].values,
                                               public_hpa_df_17['img_base_path'].values)))
     else:
+        trn_img_paths = [path for path in trn_img_paths if path in train_paths_set]
         available_paths = set(train_df['img_base_path'].values)
+
     trn_img_paths = [path for path in trn_img_paths if path in available_paths]
     val_img_paths = [path for path in val_img_paths if path in available_paths]
+    return trn_img_paths, val_img_paths, basepath_2_ohe_vector
 
-    if args.copy_paste_augment_mitotic_aggresome:
-        train_ids = {os.path.basename(x) for x in trn_img_paths}
-        id_2_ohe_vector = {os.path.basename(path): ohe for path, ohe in basepath_2_ohe_vector.items()}
 
-        cherrypicked_mitotic_spindle = pd.read_csv('input/mitotic_cells_selection.csv')
-        cherrypicked_mitotic_spindle = cherrypicked_mitotic_spindle[cherrypicked_mitotic_spindle['ID'].isin(train_ids)]
+def get_cherrypicked_cells(trn_img_paths, basepath_2_ohe_vector):
+    train_ids = {os.path.basename(x) for x in trn_img_paths}
+    id_2_ohe_vector = {os.path.basename(path): ohe for path, ohe in basepath_2_ohe_vector.items()}
 
-        cherrypicked_aggresome = pd.read_csv('input/aggressome_cells_selection.csv')
-        cherrypicked_aggresome = cherrypicked_aggresome[cherrypicked_aggresome['ID'].isin(train_ids)]
+    cherrypicked_mitotic_spindle = pd.read_csv('input/mitotic_cells_selection.csv')
+    cherrypicked_mitotic_spindle = cherrypicked_mitotic_spindle[cherrypicked_mitotic_spindle['ID'].isin(train_ids)]
 
-        cherrypicked_mitotic_spindle['ohe'] = cherrypicked_mitotic_spindle['ID'].map(id_2_ohe_vector)
-        cherrypicked_aggresome['ohe'] = cherrypicked_aggresome['ID'].map(id_2_ohe_vector)
+    cherrypicked_aggresome = pd.read_csv('input/aggressome_cells_selection.csv')
+    cherrypicked_aggresome = cherrypicked_aggresome[cherrypicked_aggresome['ID'].isin(train_ids)]
 
-        mitotic_idx = [idx for idx, colname in enumerate(train_df.columns) if colname == 'Mitotic spindle'][0]
-        aggresome_idx = [idx for idx, colname in enumerate(train_df.columns) if colname == 'Aggresome'][0]
-        mitotic_ohe = np.zeros_like(cherrypicked_aggresome['ohe'].values[0])
-        mitotic_ohe[mitotic_idx] = 1
+    cherrypicked_mitotic_spindle['ohe'] = cherrypicked_mitotic_spindle['ID'].map(id_2_ohe_vector)
+    cherrypicked_aggresome['ohe'] = cherrypicked_aggresome['ID'].map(id_2_ohe_vector)
 
-        aggresome_ohe = np.zeros_like(cherrypicked_aggresome['ohe'].values[0])
-        aggresome_ohe[aggresome_idx] = 1
+    # positions are taken from the columns of get_train_df_ohe() as in the original copy-paste setup
+    train_df_columns = ['ID', 'img_base_path'] + get_class_names()
+    mitotic_idx = train_df_columns.index('Mitotic spindle')
+    aggresome_idx = train_df_columns.index('Aggresome')
+    mitotic_ohe = np.zeros_like(cherrypicked_aggresome['ohe'].values[0])
+    mitotic_ohe[mitotic_idx] = 1
 
-        cherrypicked_mitotic_spindle.loc[cherrypicked_mitotic_spindle['is_pure'] == 1, 'ohe'] = pd.Series(
-            [mitotic_ohe for _ in range(sum(cherrypicked_mitotic_spindle['is_pure'] == 1))],
-            index=cherrypicked_mitotic_spindle.index[cherrypicked_mitotic_spindle['is_pure'] == 1])
+    aggresome_ohe = np.zeros_like(cherrypicked_aggresome['ohe'].values[0])
+    aggresome_ohe[aggresome_idx] = 1
 
-        cherrypicked_aggresome.loc[cherrypicked_aggresome['is_pure'] == 1, 'ohe'] = pd.Series(
-            [mitotic_ohe for _ in range(sum(cherrypicked_aggresome['is_pure'] == 1))],
-            index=cherrypicked_aggresome.index[cherrypicked_aggresome['is_pure'] == 1])
+    cherrypicked_mitotic_spindle.loc[cherrypicked_mitotic_spindle['is_pure'] == 1, 'ohe'] = pd.Series(
+        [mitotic_ohe for _ in range(sum(cherrypicked_mitotic_spindle['is_pure'] == 1))],
+        index=cherrypicked_mitotic_spindle.index[cherrypicked_mitotic_spindle['is_pure'] == 1])
+
+    cherrypicked_aggresome.loc[cherrypicked_aggresome['is_pure'] == 1, 'ohe'] = pd.Series(
+        [mitotic_ohe for _ in range(sum(cherrypicked_aggresome['is_pure'] == 1))],
+        index=cherrypicked_aggresome.index[cherrypicked_aggresome['is_pure'] == 1])
+
+    class_purity_2_weight = {1: 4, 0: 1}
+    cherrypicked_mitotic_spindle['sampling_weight'] = cherrypicked_mitotic_spindle['is_pure'].map(
+        class_purity_2_weight)
+    cherrypicked_aggresome['sampling_weight'] = cherrypicked_aggresome['is_pure'].map(class_purity_2_weight)
+    return cherrypicked_mitotic_spindle, cherrypicked_aggresome
+
+
+def build_datasets(args, trn_img_paths, val_img_paths, basepath_2_ohe_vector):
+    # Data loading code
+    train_transform = train_multi_augment2
 
-        class_purity_2_weight = {1: 4, 0: 1}
-        cherrypicked_mitotic_spindle['sampling_weight'] = cherrypicked_mitotic_spindle['is_pure'].map(
-            class_purity_2_weight)
-        cherrypicked_aggresome['sampling_weight'] = cherrypicked_aggresome['is_pure'].map(class_purity_2_weight)
+    if args.copy_paste_augment_mitotic_aggresome:
+        cherrypicked_mitotic_spindle, cherrypicked_aggresome = get_cherrypicked_cells(trn_img_paths,
+                                                                                      basepath_2_ohe_vector)
     else:
         cherrypicked_mitotic_spindle = None
         cherrypicked_aggresome = None
@@ -248,6 +423,8 @@ def main():
         return_label=True,
         in_channels=args.in_channels,
         transform=train_transform,
+        crop_size=args.crop_size,
+        random_crop=args.crop_size > 0,
         cherrypicked_mitotic_spindle_df=cherrypicked_mitotic_spindle,
         cherrypicked_aggresome_df=cherrypicked_aggresome
     )
@@ -258,190 +435,28 @@ def main():
     else:
         sampler = RandomSampler(train_dataset)
 
-    train_loader = DataLoader(
-        train_dataset,
-        sampler=sampler,
-        batch_size=args.batch_size,
-        drop_last=True,
-        num_workers=args.workers,
-        pin_memory=True,
-    )
+    valid_dataset = build_valid_dataset(args, val_img_paths, basepath_2_ohe_vector)
+    return train_dataset, valid_dataset, sampler
 
-    # val_img_paths = [path for path in val_img_paths if path in train_paths_set]
 
-    valid_dataset = ProteinDatasetImageLevel(
+def build_valid_dataset(args, val_img_paths, basepath_2_ohe_vector):
+    # cached validation inputs have to be deterministic, so they are not augmented
+    return ProteinDatasetImageLevel(
         val_img_paths,
         basepath_2_ohe=basepath_2_ohe_vector,
         img_size=args.img_size,
         is_trainset=True,
         return_label=True,
         in_channels=args.in_channels,
-        transform=train_transform
+        transform=None if args.val_cache else train_multi_augment2
     )
-    valid_loader = DataLoader(
-        valid_dataset,
-        sampler=SequentialSampler(valid_dataset),
-        batch_size=args.batch_size,
-        drop_last=False,
-        num_workers=args.workers,
-        pin_memory=True
-    )
-
-    focal_loss = FocalLoss().cuda()
-    log.write('** start training here! **\n')
-    log.write('\n')
-    log.write(
-        'epoch    iter      rate     |  train_loss/acc  |    valid_loss/acc/focal/map     |best_epoch/best_map|  min \n')
-    log.write(
-        '-----------------------------------------------------------------------------------------------------------------\n')
-    start_epoch += 1
-
-    if args.eval_at_start:
-        with torch.no_grad():
-            valid_loss, valid_acc, valid_focal_loss, valid_map = validate(valid_loader, model, criterion, -1,
-                                                                          focal_loss, log)
-        print('\r', end='', flush=True)
-        log.write(
-            '%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %6.4f %6.4f    |  %6.1f    %6.4f   | %3.1f min \n' % \
-            (-1, -1, -1, -1, -1, valid_loss, valid_acc, valid_focal_loss, valid_map,
-             best_epoch, best_map, -1))
-
-    for epoch in range(start_epoch, args.epochs + 1):
-        end = time.time()
-
-        # set manual seeds per epoch
-        np.random.seed(epoch)
-        torch.manual_seed(epoch)
-        torch.cuda.manual_seed_all(epoch)
-
-        # adjust learning rate for each epoch
-        lr_list = scheduler.step(model, epoch, args.epochs)
-        lr = lr_list[0]
-
-        # train for one epoch on train set
-        iter, train_loss, train_acc = train(train_loader, model, criterion, optimizer, epoch,
-                                            clipnorm=args.clipnorm, lr=lr, agg_steps=args.gradient_accumulation_steps)
-        if np.isnan(train_loss):
-            print('@@@@@NAN!')
-        else:
-            print('norm')
-
-        with torch.no_grad():
-            valid_loss, valid_acc, valid_focal_loss, valid_map = validate(valid_loader, model, criterion, epoch,
-                                                                          focal_loss, log)
-
-        # remember best loss and save checkpoint
-        is_best = valid_map > best_map
-        best_loss = min(valid_focal_loss, best_loss)
-        best_epoch = epoch if is_best else best_epoch
-        best_map = valid_map if is_best else best_map
-
-        print('\r', end='', flush=True)
-        log.write(
-            '%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %6.4f %6.4f    |  %6.1f    %6.4f   | %3.1f min \n' % \
-            (epoch, iter + 1, lr, train_loss, train_acc, valid_loss, valid_acc, valid_focal_loss, valid_map,
-             best_epoch, best_map, (time.time() - end) / 60))
-
-        save_model(model, is_best, model_out_dir, optimizer=optimizer, epoch=epoch, best_epoch=best_epoch,
-                   best_map=best_map)
-
-
-def train(train_loader, model, criterion, optimizer, epoch, clipnorm=1, lr=1e-5, agg_steps=30):
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    losses = AverageMeter()
-    accuracy = AverageMeter()
-
-    # switch to train mode
-    model.train()
-
-    num_its = len(train_loader)
-    end = time.time()
-    iter = 0
-    print_freq = 1
-    optimizer.zero_grad()
-    for iter, iter_data in enumerate(train_loader, 0):
-        # measure data loading time
-        data_time.update(time.time() - end)
-
-        images, labels, indices = iter_data
-
-        images = Variable(images.cuda())
-        labels = Variable(labels.cuda())
-
-        outputs = model(images)
-        loss = criterion(outputs, labels, epoch=epoch)
-
-        losses.update(loss.item())
-        loss.backward()
-
-        if iter % agg_steps == 0:
-            torch.nn.utils.clip_grad_norm(model.parameters(), clipnorm)
-            optimizer.step()
-            # zero out gradients so we can accumulate new ones over batches
-            optimizer.zero_grad()
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        logits = outputs
-        probs = F.sigmoid(logits)
-        acc = multi_class_acc(probs, labels)
-        accuracy.update(acc.item())
-
-        if (iter + 1) % print_freq == 0 or iter == 0 or (iter + 1) == num_its:
-            print('\r%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  | ... ' % \
-                  (epoch - 1 + (iter + 1) / num_its, iter + 1, lr, losses.avg, accuracy.avg))
-            # , \
-            #       end='', flush=True)
-
-
-    return iter, losses.avg, accuracy.avg
-
-
-def validate(valid_loader, model, criterion, epoch, focal_loss, log, threshold=0.5):
-    batch_time = AverageMeter()
-    losses = AverageMeter()
-    accuracy = AverageMeter()
-
-    # switch to evaluate mode
-    model.eval()
 
-    probs_list = []
-    labels_list = []
-    logits_list = []
 
-    end = time.time()
-    print('validating...')
-    for it, iter_data in enumerate(valid_loader, 0):
-        images, labels, indices = iter_data
-        images = Variable(images.cuda())
-        labels = Variable(labels.cuda())
+_focal_loss = FocalLoss()
 
-        outputs = model(images)
-        loss = criterion(outputs, labels, epoch=epoch)
 
-        logits = outputs
-        probs = F.sigmoid(logits)
-
-        acc = multi_class_acc(probs, labels)
-
-        probs_list.append(probs.cpu().detach().numpy())
-        labels_list.append(labels.cpu().detach().numpy())
-        logits_list.append(logits.cpu().detach().numpy())
-
-        losses.update(loss.item())
-        accuracy.update(acc.item())
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-    probs = np.vstack(probs_list)
-    y_true = np.vstack(labels_list)
-    logits = np.vstack(logits_list)
-    valid_focal_loss = focal_loss.forward(torch.from_numpy(logits), torch.from_numpy(y_true))
+def epoch_metrics(probs, y_true, logits, log):
+    valid_focal_loss = _focal_loss.forward(torch.from_numpy(logits), torch.from_numpy(y_true)).item()
 
     kaggle_score = average_precision_score(y_true, probs, average='macro')
 
@@ -450,38 +465,7 @@ def validate(valid_loader, model, criterion, epoch, focal_loss, log, threshold=0
     for class_name, map_score in zip(class_names, map_scores):
         log.write(f'{class_name}: {map_score:.2f}\n')
 
-    return losses.avg, accuracy.avg, valid_focal_loss, kaggle_score
-
-
-def save_model(model, is_best, model_out_dir, optimizer=None, epoch=None, best_epoch=None, best_map=None):
-    if type(model) == DataParallel:
-        state_dict = model.module.state_dict()
-    else:
-        state_dict = model.state_dict()
-    for key in state_dict.keys():
-        state_dict[key] = state_dict[key].cpu()
-
-    model_fpath = os.path.join(model_out_dir, '%03d.pth' % epoch)
-    torch.save({
-        'save_dir': model_out_dir,
-        'state_dict': state_dict,
-        'best_epoch': best_epoch,
-        'epoch': epoch,
-        'best_score': best_map,
-    }, model_fpath)
-
-    optim_fpath = os.path.join(model_out_dir, '%03d_optim.pth' % epoch)
-    if optimizer is not None:
-        torch.save({
-            'optimizer': optimizer.state_dict(),
-        }, optim_fpath)
-
-    if is_best:
-        best_model_fpath = os.path.join(model_out_dir, 'final.pth')
-        shutil.copyfile(model_fpath, best_model_fpath)
-        if optimizer is not None:
-            best_optim_fpath = os.path.join(model_out_dir, 'final_optim.pth')
-            shutil.copyfile(optim_fpath, best_optim_fpath)
+    return OrderedDict([('focal', valid_focal_loss), ('map', kaggle_score)])
 
 
 def multi_class_acc(preds, targs, th=0.5):
@@ -490,25 +474,6 @@ def multi_class_acc(preds, targs, th=0.5):
     return (preds == targs).float().mean()
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0.
-        self.avg = 0.
-        self.sum = 0.
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-
 if __name__ == '__main__':
     print('%s: calling main function ... \n' % os.path.basename(__file__))
     main()
@@ -2,17 +2,16 @@
 import sys
 sys.path.insert(0, '..')
 import argparse
-import shutil
 import pickle
+from collections import OrderedDict
+from functools import partial
 
 import torch
 import torch.optim
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import RandomSampler, SequentialSampler
+from torch.utils.data.sampler import RandomSampler
 from torch.nn import DataParallel
 from torch.backends import cudnn
-import torch.nn.functional as F
-from torch.autograd import Variable
 from sklearn.metrics import average_precision_score
 import pandas as pd
 
@@ -20,11 +19,26 @@ from ..data.augment_util_bestfitting import train_multi_augment2
 from ..models.layers_bestfitting.loss import *
 from ..models.layers_bestfitting.scheduler import *
 from ..models.networks_bestfitting.imageclsnet import init_network
-from ..data.datasets import ProteinDatasetCellSeparateLoading #ProteinDatasetCellLevel
+from ..models.networks_bestfitting.densenet import DensenetMultiHead
+from ..data.datasets import ProteinDatasetCellSeparateLoading, ProteinMultiHeadDatasetCellSeparateLoading, \
+    CellSizeBucketBatchSampler #ProteinDatasetCellLevel
 from ..data.utils import get_train_df_ohe, get_public_df_ohe, get_class_names
 from src.commons.utils import Logger
+from src.commons import instrumentation
+from src.commons.profiling import ProfileWindow
+from src.train.engine import Trainer, ProgressLogger, default_compute_loss
+from src.train.step_checkpoint import add_step_checkpointing
+from src.train.loss_aware_sampling import add_loss_aware_sampling
+from src.train.batch_planner import plan_batches
+from src.data.val_cache import build_valid_loaders
+from src.commons.compilation import compile_model
+from src.train.resolution_schedule import add_resolution_schedule
+from src.train.freeze_schedule import add_freeze_schedule
+from src.train.multi_head import multi_head_compute_loss, multi_head_epoch_metrics, class_batch_metric, \
+    SingleTaskCheckpoints
+from src.train.train_cellwise_mitotic_bin import get_mitotic_labels
+from src.data.label_overrides import patch_from_cell_list, load_patch, apply_label_patches
 import multiprocessing
-import time
 
 loss_names = ['FocalSymmetricHardLogLoss', 'SoftFocalSymmetricHardLogLoss', 'FocalSymmetricLovaszHardLogLoss']
 
@@ -60,15 +74,71 @@ parser.add_argument('--target-raw-img-size', default=None, type=int)
 parser.add_argument('--include-nn-mitotic', action='store_true')
 parser.add_argument('--upsample-minorities', action='store_true')
 parser.add_argument('--all-gpus', action='store_true')
+parser.add_argument('--instrument', action='store_true',
+                    help='record stage timings and throughput to stages.jsonl in the log directory')
+parser.add_argument('--profile-steps', default=None, type=str,
+                    help='capture a torch.profiler trace for global training steps start:end (default: None)')
+parser.add_argument('--profile-on-signal', action='store_true',
+                    help='capture a torch.profiler trace after SIGUSR1 is received')
+parser.add_argument('--profile-signal-steps', default=20, type=int)
+parser.add_argument('--step-checkpoint-every', default=0, type=int,
+                    help='write step_last.pth every N optimizer steps to continue an interrupted epoch (default: 0, off)')
+parser.add_argument('--resume-step', default=None, type=str,
+                    help="step checkpoint to continue an interrupted epoch from, 'last' for step_last.pth of out_dir")
+parser.add_argument('--auto-batch', action='store_true',
+                    help='probe the largest micro-batch that fits and derive the gradient accumulation steps')
+parser.add_argument('--target-effective-batch', default=None, type=int,
+                    help='effective batch size for --auto-batch (default: batch_size * gradient-accumulation-steps)')
+parser.add_argument('--memory-budget-gb', default=None, type=float,
+                    help='memory budget for --auto-batch (default: the whole device memory)')
+parser.add_argument('--max-micro-batch', default=256, type=int)
+parser.add_argument('--val-cache', action='store_true',
+                    help='decode the validation inputs once into a memory-mapped store under output/val_cache')
+parser.add_argument('--fast-val-fraction', default=None, type=float,
+                    help='validate on a fixed stratified subset of this size, except every --full-val-every epochs')
+parser.add_argument('--full-val-every', default=5, type=int)
+parser.add_argument('--compile', action='store_true',
+                    help='run the model through torch.compile (eager fallback), kernels are cached in output/compile_cache')
+parser.add_argument('--compile-mode', default=None, type=str, help="torch.compile mode, e.g. 'max-autotune' (default: None)")
+parser.add_argument('--loss-aware-sampling', action='store_true',
+                    help='skip easy and oversample hard samples using the losses remembered from earlier epochs')
+parser.add_argument('--easy-skip-rate', default=0.5, type=float, help='probability of skipping an easy sample (default: 0.5)')
+parser.add_argument('--hard-oversample', default=0.1, type=float,
+                    help='extra loss-weighted draws per epoch as a fraction of the epoch (default: 0.1)')
+parser.add_argument('--size-buckets', nargs='+', default=None, type=int,
+                    help='resize cells to the smallest of these sizes not below their native size, e.g. 256 384 512, '
+                         'and batch per size (default: None, every cell at 512)')
+parser.add_argument('--img-size-schedule', default=None, type=str,
+                    help="progressive resolution by epoch, e.g. '1:512,4:768,7:1024' (default: None, fixed img_size)")
+parser.add_argument('--freeze-schedule', default=None, type=str,
+                    help="DensenetClass blocks frozen by epoch, e.g. '1:encoder3,3:none' (default: None, nothing frozen)")
+parser.add_argument('--label-patches', nargs='+', default=None, type=str,
+                    help="stored label patches applied in this order, 'name' for the latest or 'name:version'")
+parser.add_argument('--mitotic-head', action='store_true',
+                    help='train the binary mitotic spindle classifier as a second head on the same backbone forward')
+parser.add_argument('--mitotic-context-crop', action='store_true',
+                    help='feed the mitotic head the context crop of train_cellwise_mitotic_bin, cut from the same decoded image')
+parser.add_argument('--mitotic-loss-weight', default=1.0, type=float, help='weight of the mitotic head loss (default: 1.0)')
 
 def main():
     args = parser.parse_args()
+    if args.size_buckets is not None and (args.step_checkpoint_every > 0 or args.resume_step is not None
+                                          or args.auto_batch):
+        raise ValueError('--size-buckets cannot be combined with step checkpoints or --auto-batch')
+    if args.mitotic_context_crop and not args.mitotic_head:
+        raise ValueError('--mitotic-context-crop requires --mitotic-head')
+    if args.mitotic_head and args.freeze_schedule is not None:
+        raise ValueError('--freeze-schedule is not supported with --mitotic-head')
 
     log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'fold%d' % args.fold)
     if not os.path.exists(log_out_dir):
         os.makedirs(log_out_dir)
     log = Logger()
     log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+    if args.instrument:
+        instrumentation.enable(os.path.join(log_out_dir, 'stages.jsonl'))
+    profile_window = ProfileWindow(log_out_dir, steps=args.profile_steps, on_signal=args.profile_on_signal,
+                                   signal_steps=args.profile_signal_steps, log=log)
 
     model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % args.fold)
     log.write(">> Creating directory if it does not exist:\n>> '{}'\n".format(model_out_dir))
@@ -94,8 +164,7 @@ def main():
         model_params['image_size'] = args.img_size
         model_params['encoder'] = args.effnet_encoder
 
-    model = init_network(model_params)
-
+    init_pretrained = None
     if args.load_state_dict_path is not None:
         if args.load_state_dict_path == 'use-img-level-densenet-ckpt':
             model_dir = 'output/models/densenet121_1024_all_data__obvious_neg__gradaccum_20__start_lr_3e6'
@@ -103,11 +172,26 @@ def main():
         else:
             pretrained_ckpt_path = args.load_state_dict_path
         init_pretrained = torch.load(pretrained_ckpt_path)
-        model.load_state_dict(init_pretrained['state_dict'])
+        # pruned checkpoints carry the widths of their dense layers
+        model_params['pruned_config'] = init_pretrained.get('pruned_config')
+    model = init_network(model_params)
+    if args.mitotic_head:
+        model = DensenetMultiHead(model)
+
+    if init_pretrained is not None:
+        if args.mitotic_head and not any(key.startswith('densenet.') for key in init_pretrained['state_dict']):
+            model.load_single_task_state_dict(init_pretrained['state_dict'])
+        else:
+            model.load_state_dict(init_pretrained['state_dict'])
 
     if args.all_gpus:
         model = DataParallel(model)
     model.cuda()
+    if args.compile:
+        # with context crops every sample is a stack of two crops
+        example_shape = (2, 2) if args.mitotic_context_crop else (2,)
+        model = compile_model(model, torch.rand(*example_shape, args.in_channels, args.img_size, args.img_size).cuda(),
+                              train=True, mode=args.compile_mode, log=log)
 
     # define loss function (criterion)
     try:
@@ -115,47 +199,129 @@ def main():
     except:
         raise(RuntimeError("Loss {} not available!".format(args.loss)))
 
-    start_epoch = 0
-    best_loss = 1e5
-    best_epoch = 0
-    best_focal = float('inf')
-
     # define scheduler
     try:
         scheduler = eval(args.scheduler)(scheduler_lr_multiplier=args.scheduler_lr_multiplier,
                                          scheduler_epoch_offset=args.scheduler_epoch_offset)
     except:
         raise (RuntimeError("Scheduler {} not available!".format(args.scheduler)))
-    optimizer = scheduler.schedule(model, start_epoch, args.epochs)[0]
+    optimizer = scheduler.schedule(model, 0, args.epochs)[0]
+
+    compute_loss = default_compute_loss
+    batch_metric = multi_class_acc
+    trainer_epoch_metrics = partial(epoch_metrics, log=log)
+    if args.mitotic_head:
+        # the last column of outputs and labels is the mitotic spindle task
+        compute_loss = partial(multi_head_compute_loss, mitotic_weight=args.mitotic_loss_weight)
+        batch_metric = class_batch_metric(multi_class_acc)
+        trainer_epoch_metrics = partial(multi_head_epoch_metrics, class_epoch_metrics=trainer_epoch_metrics, log=log)
+    trainer = Trainer(model, criterion, optimizer, scheduler, model_out_dir, log,
+                      clipnorm=args.clipnorm, agg_steps=args.gradient_accumulation_steps,
+                      compute_loss=compute_loss, batch_metric=batch_metric, epoch_metrics=trainer_epoch_metrics,
+                      score_name='focal', greater_is_better=False, best_score_key='best_map',
+                      profile_window=profile_window)
+    if args.mitotic_head:
+        trainer.hooks.append(SingleTaskCheckpoints())
 
     # optionally resume from a checkpoint
     if args.resume:
-        args.resume = os.path.join(model_out_dir, args.resume)
-        if os.path.isfile(args.resume):
-            # load checkpoint weights and update model and optimizer
-            log.write(">> Loading checkpoint:\n>> '{}'\n".format(args.resume))
-
-            checkpoint = torch.load(args.resume)
-            start_epoch = checkpoint['epoch']
-            best_epoch = checkpoint['best_epoch']
-            best_focal = checkpoint['best_map']
-            model.load_state_dict(checkpoint['state_dict'])
-
-            optimizer_fpath = args.resume.replace('.pth', '_optim.pth')
-            if os.path.exists(optimizer_fpath):
-                log.write(">> Loading checkpoint:\n>> '{}'\n".format(optimizer_fpath))
-                optimizer.load_state_dict(torch.load(optimizer_fpath)['optimizer'])
-            log.write(">>>> loaded checkpoint:\n>>>> '{}' (epoch {})\n".format(args.resume, checkpoint['epoch']))
-        else:
-            log.write(">> No checkpoint found at '{}'\n".format(args.resume))
+        trainer.resume(os.path.join(model_out_dir, args.resume))
 
     # Data loading code
     train_transform = train_multi_augment2
 
+    trn_img_paths, val_img_paths, basepath_2_ohe_vector, labels_df, cells_to_upsample = get_cell_training_data(args)
+    dataset_class = ProteinDatasetCellSeparateLoading
+    if args.mitotic_head:
+        positive_img_ids_cell, negative_img_ids_cell = get_mitotic_labels(labels_df)
+        # later negatives override positives, as in ProteinMitoticDatasetCellSeparateLoading
+        mitotic_id_cell_2_y = {tuple(x): 1.0 for x in positive_img_ids_cell}
+        mitotic_id_cell_2_y.update({tuple(x): 0.0 for x in negative_img_ids_cell})
+        dataset_class = partial(ProteinMultiHeadDatasetCellSeparateLoading, mitotic_id_cell_2_y=mitotic_id_cell_2_y,
+                                context_crop=args.mitotic_context_crop)
+    train_dataset = dataset_class(trn_img_paths,
+                                            labels_df=labels_df,
+                                                      cells_to_upsample=cells_to_upsample,
+                                            img_size=args.img_size,
+                                            in_channels=args.in_channels,
+                                            transform=train_transform,
+                                                      basepath_2_ohe=basepath_2_ohe_vector,
+                                                      normalize=args.normalize,
+                                                      target_raw_img_size=args.target_raw_img_size,
+                                                      size_buckets=args.size_buckets
+    )
+    if args.size_buckets is not None:
+        log_size_buckets(train_dataset, 'train', log)
+    trainer.hooks.append(ProgressLogger(os.path.join(log_out_dir, 'progress.jsonl'), img_size=args.img_size))
+    if args.img_size_schedule is not None:
+        add_resolution_schedule(trainer, train_dataset, args.img_size_schedule, args.arch)
+    if args.freeze_schedule is not None:
+        add_freeze_schedule(trainer, args.freeze_schedule)
+    if args.auto_batch:
+        plan_batches(args, model, criterion, compute_loss, train_dataset, log, device=trainer.device)
+        trainer.agg_steps = args.gradient_accumulation_steps
+    sampler = RandomSampler(train_dataset)
+    if args.loss_aware_sampling:
+        sampler = add_loss_aware_sampling(trainer, sampler, len(train_dataset), args)
+    if args.step_checkpoint_every > 0 or args.resume_step is not None:
+        sampler = add_step_checkpointing(trainer, sampler, args.batch_size, args.step_checkpoint_every,
+                                         resume_step=args.resume_step)
+    if args.size_buckets is not None:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=CellSizeBucketBatchSampler(train_dataset.cell_buckets, args.batch_size, base_sampler=sampler),
+            num_workers=args.workers,
+            pin_memory=True,
+            worker_init_fn=instrumentation.worker_init_fn,
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            sampler=sampler,
+            batch_size=args.batch_size,
+            drop_last=False,
+            num_workers=args.workers,
+            pin_memory=True,
+            worker_init_fn=instrumentation.worker_init_fn,
+        )
+
+    # valid_dataset = ProteinDatasetCellLevel(val_img_paths,
+    #                                         labels_df=labels_df,
+    #                                         img_size=args.img_size,
+    #                                         batch_size=64,
+    #                                         is_trainset=True,
+    #                                         in_channels=args.in_channels)
+
+    valid_dataset = dataset_class(val_img_paths,
+                                            labels_df=labels_df,
+                                            img_size=args.img_size,
+                                            in_channels=args.in_channels,
+                                                      basepath_2_ohe=basepath_2_ohe_vector,
+                                                      normalize=args.normalize,
+                                                      target_raw_img_size=args.target_raw_img_size,
+                                                      size_buckets=args.size_buckets)
+    if args.size_buckets is not None:
+        log_size_buckets(valid_dataset, 'valid', log)
+    valid_loader, fast_valid_loader = build_valid_loaders(args, valid_dataset, log)
+
+    trainer.fit(train_loader, valid_loader, args.epochs, eval_at_start=args.eval_at_start,
+                metric_names=('map', 'focal', 'mitotic_pr_auc') if args.mitotic_head else ('map', 'focal'),
+                fast_valid_loader=fast_valid_loader, full_val_every=args.full_val_every)
+
+
+def log_size_buckets(dataset, name, log):
+    counts, pixel_ratio = dataset.size_bucket_stats()
+    log.write('>> %s cells per size bucket: %s, %.1f%% of the convolution FLOPs of fixed %dpx crops\n' %
+              (name, ', '.join('%dpx: %d' % item for item in counts.items()), 100 * pixel_ratio,
+               dataset.cell_img_size))
+
+
+def get_cell_training_data(args):
+    """Image paths of the fold, image-level label vectors and the corrected cell-level soft labels,
+    shared with train_distill_cellwise."""
     with open('input/imagelevel_folds_obvious_staining_5.pkl', 'rb') as f:
         folds = pickle.load(f)
-    fold = args.fold
-    trn_img_paths, val_img_paths = folds[fold]
+    trn_img_paths, val_img_paths = folds[args.fold]
 
     train_df = get_train_df_ohe(clean_from_duplicates=True)
     basepath_2_ohe_vector = {img: vec for img, vec in zip(train_df['img_base_path'], train_df.iloc[:, 2:].values)}
@@ -179,27 +345,18 @@ def main():
     cherrypicked_mitotic_spindle_img_cell = {(img, cell_i - 1) for img, cell_i in cherrypicked_mitotic_spindle_img_cell}
 
     class_names = get_class_names()
-    mitotic_spindle_class_i = class_names.index('Mitotic spindle')
+    label_patches = [patch_from_cell_list('input/mitotic_cells_selection.csv', 'Mitotic spindle', 1, one_based=True)]
 
     if args.include_nn_mitotic:
         cherrypicked_mitotic_spindle_based_on_nn = pd.read_csv('input/mitotic_pos_nn_added.csv')
         cherrypicked_mitotic_spindle_img_cell.update(set(cherrypicked_mitotic_spindle_based_on_nn[['ID', 'cell_i']].apply(tuple, axis=1).values))
         print('len cherrypicked_mitotic_spindle_img_cell', len(cherrypicked_mitotic_spindle_img_cell))
-    mitotic_bool_idx = labels_df.index.isin(cherrypicked_mitotic_spindle_img_cell)
-
-    def modify_label(labels, idx, val):
-        labels[idx] = val
-        return labels
+        label_patches.append(patch_from_cell_list('input/mitotic_pos_nn_added.csv', 'Mitotic spindle', 1))
+        label_patches.append(patch_from_cell_list('input/mitotic_neg_nn_added.csv', 'Mitotic spindle', 0))
 
-    labels_df.loc[mitotic_bool_idx, 'image_level_pred'] = labels_df.loc[
-        mitotic_bool_idx, 'image_level_pred'].map(lambda x: modify_label(x, mitotic_spindle_class_i, 1))
-
-    if args.include_nn_mitotic:
-        cherrypicked_not_mitotic_spindle_based_on_nn = pd.read_csv('input/mitotic_neg_nn_added.csv')
-        cherrypicked_not_mitotic_spindle_based_on_nn = set(cherrypicked_not_mitotic_spindle_based_on_nn[['ID', 'cell_i']].apply(tuple, axis=1).values)
-        not_mitotic_bool_idx = labels_df.index.isin(cherrypicked_not_mitotic_spindle_based_on_nn)
-        labels_df.loc[not_mitotic_bool_idx, 'image_level_pred'] = labels_df.loc[
-            not_mitotic_bool_idx, 'image_level_pred'].map(lambda x: modify_label(x, mitotic_spindle_class_i, 0))
+    # stored patches, e.g. of a denoising run, are applied after the cherry-picked ones
+    label_patches += [load_patch(spec) for spec in (getattr(args, 'label_patches', None) or [])]
+    labels_df = apply_label_patches(labels_df, label_patches, class_names=class_names)
 
     if args.ignore_negative:
         raise NotImplementedError
@@ -213,198 +370,14 @@ def main():
         cells_to_upsample += confident_aggresome_indices
     else:
         cells_to_upsample = None
-    train_dataset = ProteinDatasetCellSeparateLoading(trn_img_paths,
-                                            labels_df=labels_df,
-                                                      cells_to_upsample=cells_to_upsample,
-                                            img_size=args.img_size,
-                                            in_channels=args.in_channels,
-                                            transform=train_transform,
-                                                      basepath_2_ohe=basepath_2_ohe_vector,
-                                                      normalize=args.normalize,
-                                                      target_raw_img_size=args.target_raw_img_size
-    )
-    train_loader = DataLoader(
-        train_dataset,
-        sampler=RandomSampler(train_dataset),
-        batch_size=args.batch_size,
-        drop_last=False,
-        num_workers=args.workers,
-        pin_memory=True,
-    )
+    return trn_img_paths, val_img_paths, basepath_2_ohe_vector, labels_df, cells_to_upsample
 
-    # valid_dataset = ProteinDatasetCellLevel(val_img_paths,
-    #                                         labels_df=labels_df,
-    #                                         img_size=args.img_size,
-    #                                         batch_size=64,
-    #                                         is_trainset=True,
-    #                                         in_channels=args.in_channels)
-
-    valid_dataset = ProteinDatasetCellSeparateLoading(val_img_paths,
-                                            labels_df=labels_df,
-                                            img_size=args.img_size,
-                                            in_channels=args.in_channels,
-                                                      basepath_2_ohe=basepath_2_ohe_vector,
-                                                      normalize=args.normalize,
-                                                      target_raw_img_size=args.target_raw_img_size)
-    valid_loader = DataLoader(
-        valid_dataset,
-        sampler=SequentialSampler(valid_dataset),
-        batch_size=args.batch_size,
-        drop_last=False,
-        num_workers=args.workers,
-        pin_memory=True
-    )
-
-    log.write('** start training here! **\n')
-    log.write('\n')
-    log.write('epoch    iter      rate     |  train_loss/acc  |    valid_loss/acc/map/focal     |best_epoch/best_focal|  min \n')
-    log.write('-----------------------------------------------------------------------------------------------------------------\n')
-    start_epoch += 1
-
-    if args.eval_at_start:
-        with torch.no_grad():
-            valid_loss, valid_acc, val_focal, val_map_score = validate(valid_loader, model, criterion, -1, log)
-        print('\r', end='', flush=True)
-        log.write(
-            '%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %6.4f %6.1f  |    %6.4f  %6.4f   | %3.1f min \n' % \
-            (-1, -1, -1, -1, -1, valid_loss, valid_acc, val_map_score, val_focal,
-                   best_epoch, best_focal, -1))
-
-    for epoch in range(start_epoch, args.epochs + 1):
-        end = time.time()
-
-        # set manual seeds per epoch
-        np.random.seed(epoch)
-        torch.manual_seed(epoch)
-        torch.cuda.manual_seed_all(epoch)
-
-        # adjust learning rate for each epoch
-        lr_list = scheduler.step(model, epoch, args.epochs)
-        lr = lr_list[0]
-
-        # train for one epoch on train set
-        iter, train_loss, train_acc = train(train_loader, model, criterion, optimizer, epoch, clipnorm=args.clipnorm,
-                                            lr=lr, agg_steps=args.gradient_accumulation_steps)
-
-        with torch.no_grad():
-            valid_loss, valid_acc, val_focal, val_map_score = validate(valid_loader, model, criterion, epoch, log)
-
-        # remember best loss and save checkpoint
-        is_best = val_focal < best_focal
-        best_loss = min(valid_loss, best_loss)
-        best_epoch = epoch if is_best else best_epoch
-        best_focal = val_focal if is_best else best_focal
-
-        print('\r', end='', flush=True)
-        log.write('%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %6.4f  %6.1f |  %6.4f  %6.4f | %3.1f min \n' % \
-                  (epoch, iter + 1, lr, train_loss, train_acc, valid_loss, valid_acc, val_map_score, val_focal,
-                   best_epoch, best_focal, (time.time() - end) / 60))
-
-        save_model(model, is_best, model_out_dir, optimizer=optimizer, epoch=epoch, best_epoch=best_epoch, best_map=best_focal)
-
-
-def train(train_loader, model, criterion, optimizer, epoch, clipnorm=1, lr=1e-5, agg_steps=1):
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    losses = AverageMeter()
-    accuracy = AverageMeter()
-
-    # switch to train mode
-    model.train()
-
-    num_its = len(train_loader)
-    end = time.time()
-    iter = 0
-    print_freq = 1
-    optimizer.zero_grad()
-    for iter, iter_data in enumerate(train_loader, 0):
-        # measure data loading time
-        data_time.update(time.time() - end)
-
-        images, labels, indices = iter_data
-
-        images = Variable(images.cuda())
-        labels = Variable(labels.cuda())
 
-        outputs = model(images)
-        loss = criterion(outputs, labels, epoch=epoch)
+_focal_loss = FocalLoss()
 
-        losses.update(loss.item())
-        loss.backward()
 
-        if iter % agg_steps == 0:
-            torch.nn.utils.clip_grad_norm(model.parameters(), clipnorm)
-            optimizer.step()
-            # zero out gradients so we can accumulate new ones over batches
-            optimizer.zero_grad()
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        logits = outputs
-        probs = F.sigmoid(logits)
-        acc = multi_class_acc(probs, labels)
-        accuracy.update(acc)
-
-        if (iter + 1) % print_freq == 0 or iter == 0 or (iter + 1) == num_its:
-            print('\r%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  | ... ' % \
-                  (epoch - 1 + (iter + 1) / num_its, iter + 1, lr, losses.avg, accuracy.avg),
-                  end='', flush=True)
-
-    return iter, losses.avg, accuracy.avg
-
-
-def validate(valid_loader, model, criterion, epoch, log, focal_loss=FocalLoss().cuda()):
-    batch_time = AverageMeter()
-    losses = AverageMeter()
-    accuracy = AverageMeter()
-
-    # switch to evaluate mode
-    model.eval()
-
-    probs_list = []
-    labels_list = []
-    logits_list = []
-
-    end = time.time()
-    for it, iter_data in enumerate(valid_loader, 0):
-        images, labels, indices = iter_data
-        images = Variable(images.cuda())
-        labels = Variable(labels.cuda())
-
-        outputs = model(images)
-        loss = criterion(outputs, labels, epoch=epoch)
-
-        logits = outputs
-        probs = F.sigmoid(logits)
-
-        if np.random.rand() < 0.005:
-            for prob, label in zip(probs, labels):
-                if np.random.rand() < 0.001:
-                    print('printing pred vs. label')
-                    for p, l in zip(prob.cpu().detach().numpy(), label.cpu().detach().numpy()):
-                        print(p, l)
-                    print('-' * 30)
-
-        acc = multi_class_acc(probs, labels)
-
-        probs_list.append(probs.cpu().detach().numpy())
-        labels_list.append(labels.cpu().detach().numpy())
-        logits_list.append(logits.cpu().detach().numpy())
-
-        losses.update(loss.item())
-        accuracy.update(acc)
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-    probs = np.vstack(probs_list)
-    y_true = np.vstack(labels_list)
-
-    logits = np.vstack(logits_list)
-    valid_focal_loss = focal_loss.forward(torch.from_numpy(logits), torch.from_numpy(y_true))
+def epoch_metrics(probs, y_true, logits, log):
+    valid_focal_loss = _focal_loss.forward(torch.from_numpy(logits), torch.from_numpy(y_true)).item()
 
     class_names = get_class_names()
     y_true_bin = np.zeros_like(y_true)
@@ -413,39 +386,9 @@ def validate(valid_loader, model, criterion, epoch, log, focal_loss=FocalLoss().
     for class_name, map_score in zip(class_names, map_scores):
         log.write(f'{class_name}: {map_score:.2f}\n')
 
-    return losses.avg, accuracy.avg, valid_focal_loss, np.nanmean(map_scores)
+    return OrderedDict([('map', np.nanmean(map_scores)), ('focal', valid_focal_loss)])
 
 
-def save_model(model, is_best, model_out_dir, optimizer=None, epoch=None, best_epoch=None, best_map=None):
-    if type(model) == DataParallel:
-        state_dict = model.module.state_dict()
-    else:
-        state_dict = model.state_dict()
-    for key in state_dict.keys():
-        state_dict[key] = state_dict[key].cpu()
-
-    model_fpath = os.path.join(model_out_dir, '%03d.pth' % epoch)
-    torch.save({
-        'save_dir': model_out_dir,
-        'state_dict': state_dict,
-        'best_epoch': best_epoch,
-        'epoch': epoch,
-        'best_map': best_map,
-    }, model_fpath)
-
-    optim_fpath = os.path.join(model_out_dir, '%03d_optim.pth' % epoch)
-    if optimizer is not None:
-        torch.save({
-            'optimizer': optimizer.state_dict(),
-        }, optim_fpath)
-
-    if is_best:
-        best_model_fpath = os.path.join(model_out_dir, 'final.pth')
-        shutil.copyfile(model_fpath, best_model_fpath)
-        if optimizer is not None:
-            best_optim_fpath = os.path.join(model_out_dir, 'final_optim.pth')
-            shutil.copyfile(optim_fpath, best_optim_fpath)
-
 def multi_class_acc(preds, targs, th=0.5, int_labels=False):
     if int_labels:
         preds = (preds > th).int()
@@ -457,23 +400,6 @@ def multi_class_acc(preds, targs, th=0.5, int_labels=False):
     return (preds == targs).mean()
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0.
-        self.avg = 0.
-        self.sum = 0.
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
 if __name__ == '__main__':
     print('%s: calling main function ... \n' % os.path.basename(__file__))
     main()
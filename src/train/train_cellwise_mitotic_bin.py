@@ -2,21 +2,19 @@
 import sys
 sys.path.insert(0, '..')
 import argparse
-import shutil
 import pickle
+from collections import OrderedDict
+from functools import partial
 from random import sample
 import torch
 import torch.optim
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import RandomSampler, SequentialSampler
+from torch.utils.data.sampler import RandomSampler
 from torch.nn import DataParallel
 from torch.backends import cudnn
-import torch.nn.functional as F
-from torch.autograd import Variable
 from sklearn.metrics import average_precision_score
 import pandas as pd
 from sklearn.metrics import precision_recall_curve, auc
-from torch.nn import BCELoss
 
 from ..data.augment_util_bestfitting import train_multi_augment2
 from ..models.layers_bestfitting.loss import *
@@ -24,10 +22,17 @@ from ..models.layers_bestfitting.scheduler import *
 from ..models.networks_bestfitting.imageclsnet import init_network
 from ..data.datasets import ProteinDatasetCellSeparateLoading, \
     ProteinMitoticDatasetCellSeparateLoading, MitoticBalancingSubSampler  # ProteinDatasetCellLevel
-from ..data.utils import get_train_df_ohe, get_public_df_ohe, get_class_names
+from ..data.utils import get_train_df_ohe, get_public_df_ohe
 from src.commons.utils import Logger
+from src.commons import instrumentation
+from src.commons.profiling import ProfileWindow
+from src.train.engine import Trainer, ProgressLogger
+from src.train.step_checkpoint import add_step_checkpointing
+from src.train.loss_aware_sampling import add_loss_aware_sampling
+from src.train.batch_planner import plan_batches
+from src.data.val_cache import build_valid_loaders
+from src.commons.compilation import compile_model
 import multiprocessing
-import time
 
 loss_names = ['BCELoss']
 
@@ -63,6 +68,37 @@ parser.add_argument('--target-raw-img-size', default=None, type=int)
 parser.add_argument('--include-nn-mitotic', action='store_true')
 parser.add_argument('--upsample-minorities', action='store_true')
 parser.add_argument('--all-gpus', action='store_true')
+parser.add_argument('--instrument', action='store_true',
+                    help='record stage timings and throughput to stages.jsonl in the log directory')
+parser.add_argument('--profile-steps', default=None, type=str,
+                    help='capture a torch.profiler trace for global training steps start:end (default: None)')
+parser.add_argument('--profile-on-signal', action='store_true',
+                    help='capture a torch.profiler trace after SIGUSR1 is received')
+parser.add_argument('--profile-signal-steps', default=20, type=int)
+parser.add_argument('--step-checkpoint-every', default=0, type=int,
+                    help='write step_last.pth every N optimizer steps to continue an interrupted epoch (default: 0, off)')
+parser.add_argument('--resume-step', default=None, type=str,
+                    help="step checkpoint to continue an interrupted epoch from, 'last' for step_last.pth of out_dir")
+parser.add_argument('--auto-batch', action='store_true',
+                    help='probe the largest micro-batch that fits and derive the gradient accumulation steps')
+parser.add_argument('--target-effective-batch', default=None, type=int,
+                    help='effective batch size for --auto-batch (default: batch_size * gradient-accumulation-steps)')
+parser.add_argument('--memory-budget-gb', default=None, type=float,
+                    help='memory budget for --auto-batch (default: the whole device memory)')
+parser.add_argument('--max-micro-batch', default=256, type=int)
+parser.add_argument('--val-cache', action='store_true',
+                    help='decode the validation inputs once into a memory-mapped store under output/val_cache')
+parser.add_argument('--fast-val-fraction', default=None, type=float,
+                    help='validate on a fixed stratified subset of this size, except every --full-val-every epochs')
+parser.add_argument('--full-val-every', default=5, type=int)
+parser.add_argument('--compile', action='store_true',
+                    help='run the model through torch.compile (eager fallback), kernels are cached in output/compile_cache')
+parser.add_argument('--compile-mode', default=None, type=str, help="torch.compile mode, e.g. 'max-autotune' (default: None)")
+parser.add_argument('--loss-aware-sampling', action='store_true',
+                    help='skip easy and oversample hard samples using the losses remembered from earlier epochs')
+parser.add_argument('--easy-skip-rate', default=0.5, type=float, help='probability of skipping an easy sample (default: 0.5)')
+parser.add_argument('--hard-oversample', default=0.1, type=float,
+                    help='extra loss-weighted draws per epoch as a fraction of the epoch (default: 0.1)')
 parser.add_argument('--load-as-is', action='store_true')
 
 def main():
@@ -73,6 +109,10 @@ def main():
         os.makedirs(log_out_dir)
     log = Logger()
     log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+    if args.instrument:
+        instrumentation.enable(os.path.join(log_out_dir, 'stages.jsonl'))
+    profile_window = ProfileWindow(log_out_dir, steps=args.profile_steps, on_signal=args.profile_on_signal,
+                                   signal_steps=args.profile_signal_steps, log=log)
 
     model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % args.fold)
     log.write(">> Creating directory if it does not exist:\n>> '{}'\n".format(model_out_dir))
@@ -98,8 +138,7 @@ def main():
         model_params['image_size'] = args.img_size
         model_params['encoder'] = args.effnet_encoder
 
-    model = init_network(model_params)
-
+    init_pretrained = None
     if args.load_state_dict_path is not None:
         if args.load_state_dict_path == 'use-img-level-densenet-ckpt':
             model_dir = 'output/models/densenet121_1024_all_data__obvious_neg__gradaccum_20__start_lr_3e6'
@@ -107,6 +146,11 @@ def main():
         else:
             pretrained_ckpt_path = args.load_state_dict_path
         init_pretrained = torch.load(pretrained_ckpt_path)
+        # pruned checkpoints carry the widths of their dense layers
+        model_params['pruned_config'] = init_pretrained.get('pruned_config')
+    model = init_network(model_params)
+
+    if init_pretrained is not None:
         if args.load_as_is:
             model.load_state_dict(init_pretrained['state_dict'])
         else:
@@ -119,6 +163,9 @@ def main():
     if args.all_gpus:
         model = DataParallel(model)
     model.cuda()
+    if args.compile:
+        model = compile_model(model, torch.rand(2, args.in_channels, args.img_size, args.img_size).cuda(), train=True,
+                              mode=args.compile_mode, log=log)
 
     # define loss function (criterion)
     try:
@@ -126,20 +173,20 @@ def main():
     except:
         raise(RuntimeError("Loss {} not available!".format(args.loss)))
 
-    start_epoch = 0
-    best_loss = 1e5
-    best_epoch = 0
-    best_val_pr_auc_score = 0
-
     # define scheduler
     try:
         scheduler = eval(args.scheduler)(scheduler_lr_multiplier=args.scheduler_lr_multiplier,
                                          scheduler_epoch_offset=args.scheduler_epoch_offset)
     except:
         raise (RuntimeError("Scheduler {} not available!".format(args.scheduler)))
-    optimizer = scheduler.schedule(model, start_epoch, args.epochs)[0]
-
+    optimizer = scheduler.schedule(model, 0, args.epochs)[0]
 
+    trainer = Trainer(model, criterion, optimizer, scheduler, model_out_dir, log,
+                      clipnorm=args.clipnorm, agg_steps=args.gradient_accumulation_steps,
+                      compute_loss=compute_loss, batch_metric=multi_class_acc,
+                      epoch_metrics=partial(epoch_metrics, log=log),
+                      score_name='pr_auc', greater_is_better=True, best_score_key='best_map',
+                      profile_window=profile_window)
 
     # Data loading code
     train_transform = train_multi_augment2
@@ -162,29 +209,7 @@ def main():
     val_img_paths = [path for path in val_img_paths if path in available_paths]
     labels_df = pd.read_hdf(args.cell_level_labels_path)
 
-    # modifying minor class labels
-    cherrypicked_mitotic_spindle = pd.read_csv('input/mitotic_cells_selection.csv')
-
-    cherrypicked_mitotic_spindle_img_cell = set(
-        cherrypicked_mitotic_spindle[['ID', 'cell_i']].apply(tuple, axis=1).values)
-
-    cherrypicked_mitotic_spindle_img_cell = {(img, cell_i - 1) for img, cell_i in cherrypicked_mitotic_spindle_img_cell}
-
-    class_names = get_class_names()
-    mitotic_spindle_class_i = class_names.index('Mitotic spindle')
-
-    cherrypicked_mitotic_spindle_based_on_nn = pd.read_csv('input/mitotic_pos_nn_added.csv')
-    cherrypicked_mitotic_spindle_img_cell.update(set(cherrypicked_mitotic_spindle_based_on_nn[['ID', 'cell_i']].apply(tuple, axis=1).values))
-    mitotic_bool_idx = labels_df.index.isin(cherrypicked_mitotic_spindle_img_cell)
-
-    negative_img_ids_cell = labels_df.index[np.logical_not(mitotic_bool_idx)].values
-
-    dfs = []
-    for fold in range(5):
-        dfs.append(pd.read_csv(f'output/mitotic_pred_fold_{fold}.csv'))
-    pred_df = pd.concat(dfs)
-    pred_df.set_index(['ID', 'cell_i'], inplace=True)
-    positive_img_ids_cell = pred_df.index[pred_df['pred'] < 0.6].values
+    positive_img_ids_cell, negative_img_ids_cell = get_mitotic_labels(labels_df)
 
     if args.ignore_negative:
         raise NotImplementedError
@@ -196,13 +221,24 @@ def main():
                                                             transform=train_transform,
                                                       target_raw_img_size=args.target_raw_img_size
     )
+    trainer.hooks.append(ProgressLogger(os.path.join(log_out_dir, 'progress.jsonl'), img_size=args.img_size))
+    if args.auto_batch:
+        plan_batches(args, model, criterion, compute_loss, train_dataset, log, device=trainer.device)
+        trainer.agg_steps = args.gradient_accumulation_steps
+    sampler = MitoticBalancingSubSampler(train_dataset.img_ids_cell, train_dataset.id_cell_2_y)
+    if args.loss_aware_sampling:
+        sampler = add_loss_aware_sampling(trainer, sampler, len(train_dataset), args)
+    if args.step_checkpoint_every > 0 or args.resume_step is not None:
+        sampler = add_step_checkpointing(trainer, sampler, args.batch_size, args.step_checkpoint_every,
+                                         resume_step=args.resume_step)
     train_loader = DataLoader(
         train_dataset,
-        sampler=MitoticBalancingSubSampler(train_dataset.img_ids_cell, train_dataset.id_cell_2_y),
+        sampler=sampler,
         batch_size=args.batch_size,
         drop_last=False,
         num_workers=args.workers,
         pin_memory=True,
+        worker_init_fn=instrumentation.worker_init_fn,
     )
 
     valid_dataset = ProteinMitoticDatasetCellSeparateLoading(val_img_paths,
@@ -211,161 +247,43 @@ def main():
                                             img_size=args.img_size,
                                             in_channels=args.in_channels,
                                                       target_raw_img_size=args.target_raw_img_size)
-    valid_loader = DataLoader(
-        valid_dataset,
-        sampler=SequentialSampler(valid_dataset),
-        batch_size=args.batch_size,
-        drop_last=False,
-        num_workers=args.workers,
-        pin_memory=True
-    )
-
-    log.write('** start training here! **\n')
-    log.write('\n')
-    log.write('epoch    iter      rate     |  train_loss/acc  |    valid_loss/acc/pr_auc/---     |best_epoch/best_pr_auc|  min \n')
-    log.write('-----------------------------------------------------------------------------------------------------------------\n')
-    start_epoch += 1
-
-    if args.eval_at_start:
-        with torch.no_grad():
-            valid_loss, valid_acc, val_pr_auc_score = validate(valid_loader, model, criterion, -1, log)
-        print('\r', end='', flush=True)
-        log.write(
-            '%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %6.4f %6.1f  |    %6.4f  %6.4f   | %3.1f min \n' % \
-            (-1, -1, -1, -1, -1, valid_loss, valid_acc, val_pr_auc_score, -1,
-                   best_epoch, -1, -1))
-
-    for epoch in range(start_epoch, args.epochs + 1):
-        end = time.time()
-
-        # set manual seeds per epoch
-        np.random.seed(epoch)
-        torch.manual_seed(epoch)
-        torch.cuda.manual_seed_all(epoch)
-
-        # adjust learning rate for each epoch
-        lr_list = scheduler.step(model, epoch, args.epochs)
-        lr = lr_list[0]
-
-        # train for one epoch on train set
-        iter, train_loss, train_acc = train(train_loader, model, criterion, optimizer, epoch, clipnorm=args.clipnorm,
-                                            lr=lr, agg_steps=args.gradient_accumulation_steps)
-
-        with torch.no_grad():
-            valid_loss, valid_acc, val_pr_auc_score = validate(valid_loader, model, criterion, epoch, log)
-
-        # remember best loss and save checkpoint
-        is_best = val_pr_auc_score > best_val_pr_auc_score
-        best_loss = min(valid_loss, best_loss)
-        best_epoch = epoch if is_best else best_epoch
-        best_val_pr_auc_score = val_pr_auc_score if is_best else best_val_pr_auc_score
-
-        print('\r', end='', flush=True)
-        log.write('%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  |    %0.4f  %6.4f %6.4f  %6.1f |  %6.4f  %6.4f | %3.1f min \n' % \
-                  (epoch, iter + 1, lr, train_loss, train_acc, valid_loss, valid_acc, val_pr_auc_score, -1,
-                   best_epoch, best_val_pr_auc_score, (time.time() - end) / 60))
-
-        save_model(model, is_best, model_out_dir, optimizer=optimizer, epoch=epoch, best_epoch=best_epoch, best_map=best_val_pr_auc_score)
+    valid_loader, fast_valid_loader = build_valid_loaders(args, valid_dataset, log)
 
+    trainer.fit(train_loader, valid_loader, args.epochs, eval_at_start=args.eval_at_start,
+                metric_names=('pr_auc',),
+                fast_valid_loader=fast_valid_loader, full_val_every=args.full_val_every)
 
-def train(train_loader, model, criterion, optimizer, epoch, clipnorm=1, lr=1e-5, agg_steps=1):
-    batch_time = AverageMeter()
-    data_time = AverageMeter()
-    losses = AverageMeter()
-    accuracy = AverageMeter()
 
-    # switch to train mode
-    model.train()
-
-    num_its = len(train_loader)
-    end = time.time()
-    iter = 0
-    print_freq = 1
-    optimizer.zero_grad()
-    for iter, iter_data in enumerate(train_loader, 0):
-        # measure data loading time
-        data_time.update(time.time() - end)
-
-        images, labels, indices = iter_data
-
-        images = Variable(images.cuda())
-        labels = Variable(labels.cuda())
-
-        logits = model(images)
-
-        probs = F.sigmoid(logits)
-        loss = criterion(probs, labels)
-
-        losses.update(loss.item())
-        loss.backward()
-
-        if iter % agg_steps == 0:
-            torch.nn.utils.clip_grad_norm(model.parameters(), clipnorm)
-            optimizer.step()
-            # zero out gradients so we can accumulate new ones over batches
-            optimizer.zero_grad()
-
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        acc = multi_class_acc(probs, labels)
-        accuracy.update(acc)
-
-        if (iter + 1) % print_freq == 0 or iter == 0 or (iter + 1) == num_its:
-            print('\r%5.1f   %5d    %0.6f   |  %0.4f  %0.4f  | ... ' % \
-                  (epoch - 1 + (iter + 1) / num_its, iter + 1, lr, losses.avg, accuracy.avg),
-                  end='', flush=True)
-
-    return iter, losses.avg, accuracy.avg
-
-
-def validate(valid_loader, model, criterion, epoch, log, loss=BCELoss().cuda()):
-    batch_time = AverageMeter()
-    losses = AverageMeter()
-    accuracy = AverageMeter()
-
-    # switch to evaluate mode
-    model.eval()
-
-    probs_list = []
-    labels_list = []
-    logits_list = []
+def get_mitotic_labels(labels_df):
+    """(img_id, cell_i) of the mitotic spindle positives and negatives among the cells of labels_df,
+    shared with the mitotic head of train_cellwise."""
+    cherrypicked_mitotic_spindle = pd.read_csv('input/mitotic_cells_selection.csv')
 
-    end = time.time()
-    for it, iter_data in enumerate(valid_loader, 0):
-        images, labels, indices = iter_data
-        images = Variable(images.cuda())
-        labels = Variable(labels.cuda())
+    cherrypicked_mitotic_spindle_img_cell = set(
+        cherrypicked_mitotic_spindle[['ID', 'cell_i']].apply(tuple, axis=1).values)
 
-        logits = model(images)
-        probs = F.sigmoid(logits)
-        loss = criterion(probs, labels)
+    cherrypicked_mitotic_spindle_img_cell = {(img, cell_i - 1) for img, cell_i in cherrypicked_mitotic_spindle_img_cell}
 
-        if np.random.rand() < 0.005:
-            for prob, label in zip(probs, labels):
-                if np.random.rand() < 0.001:
-                    print('printing pred vs. label')
-                    for p, l in zip(prob.cpu().detach().numpy(), label.cpu().detach().numpy()):
-                        print(p, l)
-                    print('-' * 30)
+    cherrypicked_mitotic_spindle_based_on_nn = pd.read_csv('input/mitotic_pos_nn_added.csv')
+    cherrypicked_mitotic_spindle_img_cell.update(set(cherrypicked_mitotic_spindle_based_on_nn[['ID', 'cell_i']].apply(tuple, axis=1).values))
+    mitotic_bool_idx = labels_df.index.isin(cherrypicked_mitotic_spindle_img_cell)
 
-        acc = multi_class_acc(probs, labels)
+    negative_img_ids_cell = labels_df.index[np.logical_not(mitotic_bool_idx)].values
 
-        probs_list.append(probs.cpu().detach().numpy())
-        labels_list.append(labels.cpu().detach().numpy())
-        logits_list.append(logits.cpu().detach().numpy())
+    dfs = []
+    for fold in range(5):
+        dfs.append(pd.read_csv(f'output/mitotic_pred_fold_{fold}.csv'))
+    pred_df = pd.concat(dfs)
+    pred_df.set_index(['ID', 'cell_i'], inplace=True)
+    positive_img_ids_cell = pred_df.index[pred_df['pred'] < 0.6].values
+    return positive_img_ids_cell, negative_img_ids_cell
 
-        losses.update(loss.item())
-        accuracy.update(acc)
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+def compute_loss(criterion, logits, labels, epoch):
+    return criterion(torch.sigmoid(logits), labels)
 
-    probs = np.vstack(probs_list)
-    y_true = np.vstack(labels_list)
 
+def epoch_metrics(probs, y_true, logits, log):
     for prob, lab in zip(probs[:50], y_true[:50]):
         print(prob, lab)
 
@@ -373,38 +291,7 @@ def validate(valid_loader, model, criterion, epoch, log, loss=BCELoss().cuda()):
     pr_auc = auc(recall, precision)
     log.write(f'{pr_auc:.2f}\n')
 
-    return losses.avg, accuracy.avg, pr_auc
-
-
-def save_model(model, is_best, model_out_dir, optimizer=None, epoch=None, best_epoch=None, best_map=None):
-    if type(model) == DataParallel:
-        state_dict = model.module.state_dict()
-    else:
-        state_dict = model.state_dict()
-    for key in state_dict.keys():
-        state_dict[key] = state_dict[key].cpu()
-
-    model_fpath = os.path.join(model_out_dir, '%03d.pth' % epoch)
-    torch.save({
-        'save_dir': model_out_dir,
-        'state_dict': state_dict,
-        'best_epoch': best_epoch,
-        'epoch': epoch,
-        'best_map': best_map,
-    }, model_fpath)
-
-    optim_fpath = os.path.join(model_out_dir, '%03d_optim.pth' % epoch)
-    if optimizer is not None:
-        torch.save({
-            'optimizer': optimizer.state_dict(),
-        }, optim_fpath)
-
-    if is_best:
-        best_model_fpath = os.path.join(model_out_dir, 'final.pth')
-        shutil.copyfile(model_fpath, best_model_fpath)
-        if optimizer is not None:
-            best_optim_fpath = os.path.join(model_out_dir, 'final_optim.pth')
-            shutil.copyfile(optim_fpath, best_optim_fpath)
+    return OrderedDict([('pr_auc', pr_auc)])
 
 
 def multi_class_acc(preds, targs):
@@ -414,23 +301,6 @@ def multi_class_acc(preds, targs):
     return (preds == targs).mean()
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0.
-        self.avg = 0.
-        self.sum = 0.
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
 if __name__ == '__main__':
     print('%s: calling main function ... \n' % os.path.basename(__file__))
     main()
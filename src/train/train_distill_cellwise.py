@@ -0,0 +1,215 @@
+# coding: utf-8
+import sys
+sys.path.insert(0, '..')
+import argparse
+from functools import partial
+
+import torch
+import torch.optim
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import RandomSampler
+from torch.backends import cudnn
+
+from ..data.augment_util_bestfitting import train_multi_augment2
+from ..models.layers_bestfitting.loss import *
+from ..models.layers_bestfitting.scheduler import *
+from ..models.networks_bestfitting.imageclsnet import init_network
+from ..data.datasets import ProteinDatasetCellSeparateLoading
+from src.commons.utils import Logger
+from src.commons import instrumentation
+from src.train.engine import Trainer, ProgressLogger
+from src.train.distillation import DistillationLoss, OnlineTeacher
+from src.train.batch_planner import plan_batches
+from src.train.train_cellwise import get_cell_training_data, epoch_metrics, multi_class_acc
+from src.data.val_cache import build_valid_loaders
+import multiprocessing
+
+# Trains a compact cell classifier (by default EfficientNet-B0) on the stored teacher outputs of
+# --cell-level-labels-path and, with --teacher-folds-dir, on the logits of the fold teacher computed online
+# for the same augmented crops. python -m src.benchmarks.student_speed_vs_map compares the students.
+
+loss_names = ['FocalSymmetricHardLogLoss', 'SoftFocalSymmetricHardLogLoss', 'FocalSymmetricLovaszHardLogLoss',
+              'SoftCEHardLogLoss']
+
+parser = argparse.ArgumentParser(description='PyTorch Protein Classification, distillation into a student')
+parser.add_argument('--out_dir', default='efficientnet_b0_distilled', type=str, help='destination where trained network should be saved')
+parser.add_argument('--gpu-id', default='0', type=str, help='gpu id used for training (default: 0)')
+parser.add_argument('--arch', default='class_efficientnet_dropout', type=str,
+                    help='student architecture (default: class_efficientnet_dropout)')
+parser.add_argument('--effnet-encoder', default='efficientnet-b0', type=str)
+parser.add_argument('--teacher-folds-dir', default=None, type=str,
+                    help='fold models of the teacher for online logits (default: None, stored soft labels only)')
+parser.add_argument('--teacher-arch', default='class_densenet121_dropout', type=str)
+parser.add_argument('--kd-alpha', default=0.5, type=float, help='weight of the online teacher term (default: 0.5)')
+parser.add_argument('--kd-temperature', default=2.0, type=float)
+parser.add_argument('--cell-img-size', default=512, type=int,
+                    help='size of the cell crops fed to the online teacher (default: 512)')
+
+parser.add_argument('--num_classes', default=19, type=int, help='number of classes (default: 19)')
+parser.add_argument('--in_channels', default=4, type=int, help='in channels (default: 4)')
+parser.add_argument('--loss', default='SoftCEHardLogLoss', choices=loss_names, type=str,
+                    help='loss function on the stored soft labels: ' + ' | '.join(loss_names) + ' (deafault: SoftCEHardLogLoss)')
+parser.add_argument('--scheduler', default='Adam10WarmUp', type=str, help='scheduler name')
+parser.add_argument('--scheduler-lr-multiplier', default=1.0, type=float, help='scheduler lr multiplier')
+parser.add_argument('--scheduler-epoch-offset', default=0, type=int, help='epoch offset for the scheduler')
+parser.add_argument('--epochs', default=10, type=int, help='number of total epochs to run (default: 10)')
+parser.add_argument('--img_size', default=384, type=int, help='student input size (default: 384)')
+parser.add_argument('--batch_size', default=32, type=int, help='train mini-batch size (default: 32)')
+parser.add_argument('--workers', default=multiprocessing.cpu_count() - 1, type=int, help='number of data loading workers (default: 3)')
+parser.add_argument('--fold', default=0, type=int, help='index of fold (default: 0)')
+parser.add_argument('--clipnorm', default=1, type=int, help='clip grad norm')
+parser.add_argument('--resume', default=None, type=str, help='name of the latest checkpoint (default: None)')
+parser.add_argument('--cell-level-labels-path', default='output/densenet121_pred.h5', type=str)
+parser.add_argument('--eval-at-start', action='store_true')
+parser.add_argument('--ignore-negative', action='store_true')
+parser.add_argument('--gradient-accumulation-steps', default=1, type=int)
+parser.add_argument('--target-raw-img-size', default=None, type=int)
+parser.add_argument('--include-nn-mitotic', action='store_true')
+parser.add_argument('--upsample-minorities', action='store_true')
+parser.add_argument('--label-patches', nargs='+', default=None, type=str,
+                    help="stored label patches applied in this order, 'name' for the latest or 'name:version'")
+parser.add_argument('--instrument', action='store_true',
+                    help='record stage timings and throughput to stages.jsonl in the log directory')
+parser.add_argument('--auto-batch', action='store_true',
+                    help='probe the largest micro-batch that fits and derive the gradient accumulation steps')
+parser.add_argument('--target-effective-batch', default=None, type=int,
+                    help='effective batch size for --auto-batch (default: batch_size * gradient-accumulation-steps)')
+parser.add_argument('--memory-budget-gb', default=None, type=float,
+                    help='memory budget for --auto-batch (default: the whole device memory)')
+parser.add_argument('--max-micro-batch', default=256, type=int)
+parser.add_argument('--val-cache', action='store_true',
+                    help='decode the validation inputs once into a memory-mapped store under output/val_cache')
+parser.add_argument('--fast-val-fraction', default=None, type=float,
+                    help='validate on a fixed stratified subset of this size, except every --full-val-every epochs')
+parser.add_argument('--full-val-every', default=5, type=int)
+
+
+def build_teacher(args):
+    model_params = {}
+    model_params['architecture'] = args.teacher_arch
+    model_params['num_classes'] = args.num_classes
+    model_params['in_channels'] = args.in_channels
+    checkpoint_path = os.path.join(args.teacher_folds_dir, f'fold{args.fold}', 'final.pth')
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    model_params['pruned_config'] = checkpoint.get('pruned_config')
+    teacher = init_network(model_params)
+    teacher.load_state_dict(checkpoint['state_dict'])
+    return teacher
+
+
+def main():
+    args = parser.parse_args()
+
+    log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'fold%d' % args.fold)
+    if not os.path.exists(log_out_dir):
+        os.makedirs(log_out_dir)
+    log = Logger()
+    log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+    if args.instrument:
+        instrumentation.enable(os.path.join(log_out_dir, 'stages.jsonl'))
+
+    model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % args.fold)
+    log.write(">> Creating directory if it does not exist:\n>> '{}'\n".format(model_out_dir))
+    if not os.path.exists(model_out_dir):
+        os.makedirs(model_out_dir)
+
+    # set cuda visible device
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+    cudnn.benchmark = True
+
+    # set random seeds
+    torch.manual_seed(0)
+    torch.cuda.manual_seed_all(0)
+    np.random.seed(0)
+
+    model_params = {}
+    model_params['architecture'] = args.arch
+    model_params['num_classes'] = args.num_classes
+    model_params['in_channels'] = args.in_channels
+    if 'efficientnet' in args.arch:
+        model_params['image_size'] = args.img_size
+        model_params['encoder'] = args.effnet_encoder
+    model = init_network(model_params)
+    model.cuda()
+
+    teacher = None
+    if args.teacher_folds_dir is not None:
+        teacher = build_teacher(args).cuda()
+    # without an online teacher the crops are loaded at the student size right away
+    crop_size = args.cell_img_size if teacher is not None else args.img_size
+    online_teacher = OnlineTeacher(teacher, student_img_size=args.img_size)
+    online_teacher.attach(model)
+
+    # define loss function (criterion)
+    try:
+        base_loss = eval(args.loss)()
+    except:
+        raise(RuntimeError("Loss {} not available!".format(args.loss)))
+    criterion = DistillationLoss(base_loss, alpha=args.kd_alpha if teacher is not None else 0.0,
+                                 temperature=args.kd_temperature).cuda()
+
+    # define scheduler
+    try:
+        scheduler = eval(args.scheduler)(scheduler_lr_multiplier=args.scheduler_lr_multiplier,
+                                         scheduler_epoch_offset=args.scheduler_epoch_offset)
+    except:
+        raise (RuntimeError("Scheduler {} not available!".format(args.scheduler)))
+    optimizer = scheduler.schedule(model, 0, args.epochs)[0]
+
+    trainer = Trainer(model, criterion, optimizer, scheduler, model_out_dir, log,
+                      clipnorm=args.clipnorm, agg_steps=args.gradient_accumulation_steps,
+                      compute_loss=online_teacher.compute_loss, batch_metric=multi_class_acc,
+                      epoch_metrics=partial(epoch_metrics, log=log),
+                      score_name='focal', greater_is_better=False, best_score_key='best_map')
+
+    # optionally resume from a checkpoint
+    if args.resume:
+        trainer.resume(os.path.join(model_out_dir, args.resume))
+
+    # the student is trained on the same corrected soft labels as train_cellwise
+    trn_img_paths, val_img_paths, basepath_2_ohe_vector, labels_df, cells_to_upsample = get_cell_training_data(args)
+    train_dataset = ProteinDatasetCellSeparateLoading(trn_img_paths,
+                                                      labels_df=labels_df,
+                                                      cells_to_upsample=cells_to_upsample,
+                                                      img_size=args.img_size,
+                                                      in_channels=args.in_channels,
+                                                      transform=train_multi_augment2,
+                                                      basepath_2_ohe=basepath_2_ohe_vector,
+                                                      target_raw_img_size=args.target_raw_img_size)
+    train_dataset.set_img_size(crop_size)
+    trainer.hooks.append(ProgressLogger(os.path.join(log_out_dir, 'progress.jsonl'), img_size=args.img_size))
+    if args.auto_batch:
+        plan_batches(args, model, criterion, online_teacher.compute_loss, train_dataset, log,
+                     device=trainer.device)
+        trainer.agg_steps = args.gradient_accumulation_steps
+    train_loader = DataLoader(
+        train_dataset,
+        sampler=RandomSampler(train_dataset),
+        batch_size=args.batch_size,
+        drop_last=False,
+        num_workers=args.workers,
+        pin_memory=True,
+        worker_init_fn=instrumentation.worker_init_fn,
+    )
+
+    valid_dataset = ProteinDatasetCellSeparateLoading(val_img_paths,
+                                                      labels_df=labels_df,
+                                                      img_size=args.img_size,
+                                                      in_channels=args.in_channels,
+                                                      basepath_2_ohe=basepath_2_ohe_vector,
+                                                      target_raw_img_size=args.target_raw_img_size)
+    valid_dataset.set_img_size(crop_size)
+    valid_loader, fast_valid_loader = build_valid_loaders(args, valid_dataset, log)
+
+    log.write('>> Student %s at %dpx, %s\n' % (args.arch, args.img_size,
+                                                'online teacher %s' % args.teacher_arch if teacher is not None
+                                                else 'stored teacher outputs only'))
+    trainer.fit(train_loader, valid_loader, args.epochs, eval_at_start=args.eval_at_start,
+                metric_names=('map', 'focal'),
+                fast_valid_loader=fast_valid_loader, full_val_every=args.full_val_every)
+
+
+if __name__ == '__main__':
+    print('%s: calling main function ... \n' % os.path.basename(__file__))
+    main()
+    print('\nsuccess!')
@@ -0,0 +1,172 @@
+# coding: utf-8
+import sys
+sys.path.insert(0, '..')
+import argparse
+from functools import partial
+
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import RandomSampler, SequentialSampler
+import pandas as pd
+from torch.nn import BCELoss
+
+from ..models.layers_bestfitting.loss import *
+from ..models.layers_bestfitting.scheduler import *
+from ..models.networks_bestfitting.densenet import DensenetHead
+from ..data.feature_store import FeatureStore, CachedFeatureDataset
+from ..data.utils import get_class_names
+from src.commons.utils import Logger
+from src.train.engine import Trainer, ProgressLogger, default_compute_loss
+from src.train import train_cellwise, train_cellwise_mitotic_bin
+import time
+
+# Trains only the head (bn1/fc1/bn2/logit) of a DenseNet cell classifier, or a new binary head on top of its
+# fc1 layer, from features cached by src.predict.extract_cell_features. The backbone is never run, so an
+# experiment takes minutes on the CPU. final.pth holds the head weights only, final_full.pth the backbone
+# checkpoint of the store with the best head merged in, loadable like any other model of the repo.
+
+loss_names = ['SoftCEHardLogLoss', 'FocalSymmetricHardLogLoss', 'SoftFocalSymmetricHardLogLoss', 'FocalLoss']
+
+parser = argparse.ArgumentParser(description='Head-only training from cached backbone features')
+parser.add_argument('--feature-store-dir', required=True, type=str, help='directory written by extract_cell_features')
+parser.add_argument('--out_dir', default='densenet121_head_from_features', type=str,
+                    help='destination where trained heads should be saved')
+parser.add_argument('--binary-class', default=None, type=str,
+                    help="train a new single-logit head for this class, e.g. 'Mitotic spindle' (default: None)")
+parser.add_argument('--reset-head', action='store_true', help='do not start from the head of the checkpoint')
+parser.add_argument('--loss', default='SoftCEHardLogLoss', choices=loss_names, type=str,
+                    help='loss function of multi-label heads: ' + ' | '.join(loss_names))
+parser.add_argument('--scheduler', default='Adam10WarmUp', type=str, help='scheduler name')
+parser.add_argument('--scheduler-lr-multiplier', default=1.0, type=float, help='scheduler lr multiplier')
+parser.add_argument('--scheduler-epoch-offset', default=0, type=int, help='epoch offset for the scheduler')
+parser.add_argument('--epochs', default=10, type=int, help='number of total epochs to run (default: 10)')
+parser.add_argument('--batch_size', default=256, type=int, help='train mini-batch size (default: 256)')
+parser.add_argument('--workers', default=0, type=int, help='number of data loading workers (default: 0)')
+parser.add_argument('--valid-view', default=0, type=int,
+                    help='TTA view of the store used for validation (default: 0, the unaugmented cell)')
+parser.add_argument('--cell-level-labels-path', default=None, type=str,
+                    help='soft cell labels (default: the labels the store was extracted with)')
+parser.add_argument('--eval-at-start', action='store_true')
+parser.add_argument('--device', default='cpu', type=str)
+
+
+def get_cell_labels(labels_path, index_df):
+    labels_df = pd.read_hdf(labels_path)
+
+    # same minor class correction as in train_cellwise
+    cherrypicked_mitotic_spindle = pd.read_csv('input/mitotic_cells_selection.csv')
+    cherrypicked_mitotic_spindle_img_cell = {(img, cell_i - 1) for img, cell_i in
+                                             cherrypicked_mitotic_spindle[['ID', 'cell_i']].apply(tuple, axis=1).values}
+    mitotic_spindle_class_i = get_class_names().index('Mitotic spindle')
+
+    labels = np.stack(labels_df.loc[list(zip(index_df['ID'], index_df['cell_i'])), 'image_level_pred'].values)
+    labels = labels.astype(np.float32)
+    mitotic_bool_idx = np.array([x in cherrypicked_mitotic_spindle_img_cell
+                                 for x in zip(index_df['ID'], index_df['cell_i'])])
+    labels[mitotic_bool_idx, mitotic_spindle_class_i] = 1
+    return labels
+
+
+def main():
+    args = parser.parse_args()
+
+    store = FeatureStore(args.feature_store_dir)
+    meta = store.load_meta()
+    index_df = store.load_index()
+
+    log_out_dir = os.path.join(RESULT_DIR, 'logs', args.out_dir, 'fold%d' % meta['fold'])
+    if not os.path.exists(log_out_dir):
+        os.makedirs(log_out_dir)
+    log = Logger()
+    log.open(os.path.join(log_out_dir, 'log.train.txt'), mode='a')
+
+    model_out_dir = os.path.join(RESULT_DIR, 'models', args.out_dir, 'fold%d' % meta['fold'])
+    log.write(">> Creating directory if it does not exist:\n>> '{}'\n".format(model_out_dir))
+    if not os.path.exists(model_out_dir):
+        os.makedirs(model_out_dir)
+
+    # set random seeds
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    backbone_checkpoint = torch.load(meta['checkpoint'], map_location='cpu')
+    network_state_dict = backbone_checkpoint['state_dict']
+    dropout = 'fc1.weight' in network_state_dict
+    num_features = network_state_dict['logit.weight'].shape[1]
+    num_classes = 1 if args.binary_class is not None else meta['num_classes']
+    model = DensenetHead(num_features=num_features, num_classes=num_classes, dropout=dropout)
+    if not args.reset_head:
+        model.load_from_network_state_dict(network_state_dict, skip_logit=args.binary_class is not None)
+    model.to(args.device)
+
+    labels = get_cell_labels(args.cell_level_labels_path or meta['cell_level_labels_path'], index_df)
+    if args.binary_class is not None:
+        class_i = get_class_names().index(args.binary_class)
+        labels = (labels[:, [class_i]] > 0.5).astype(np.float32)
+        criterion = BCELoss()
+        compute_loss = train_cellwise_mitotic_bin.compute_loss
+        batch_metric = train_cellwise_mitotic_bin.multi_class_acc
+        epoch_metrics = partial(train_cellwise_mitotic_bin.epoch_metrics, log=log)
+        metric_names, score_name, greater_is_better = ('pr_auc',), 'pr_auc', True
+    else:
+        try:
+            criterion = eval(args.loss)()
+        except:
+            raise(RuntimeError("Loss {} not available!".format(args.loss)))
+        compute_loss = default_compute_loss
+        batch_metric = train_cellwise.multi_class_acc
+        epoch_metrics = partial(train_cellwise.epoch_metrics, log=log)
+        metric_names, score_name, greater_is_better = ('map', 'focal'), 'focal', False
+    criterion = criterion.to(args.device)
+
+    # define scheduler
+    try:
+        scheduler = eval(args.scheduler)(scheduler_lr_multiplier=args.scheduler_lr_multiplier,
+                                         scheduler_epoch_offset=args.scheduler_epoch_offset)
+    except:
+        raise (RuntimeError("Scheduler {} not available!".format(args.scheduler)))
+    optimizer = scheduler.schedule(model, 0, args.epochs)[0]
+
+    trainer = Trainer(model, criterion, optimizer, scheduler, model_out_dir, log, device=args.device,
+                      agg_steps=1, compute_loss=compute_loss, batch_metric=batch_metric,
+                      epoch_metrics=epoch_metrics, score_name=score_name, greater_is_better=greater_is_better,
+                      best_score_key='best_score', prefetch=False)
+    trainer.hooks.append(ProgressLogger(os.path.join(log_out_dir, 'progress.jsonl')))
+
+    trn_rows = np.where(~index_df['is_valid'].values)[0]
+    val_rows = np.where(index_df['is_valid'].values)[0]
+    log.write('>> Head training on %d cells, validation on %d cells, %d cached views, %d features\n' %
+              (len(trn_rows), len(val_rows), len(meta['views']), meta['num_features']))
+    train_dataset = CachedFeatureDataset(store.features_fpath, labels, trn_rows)
+    valid_dataset = CachedFeatureDataset(store.features_fpath, labels, val_rows, view=args.valid_view)
+    train_loader = DataLoader(train_dataset, sampler=RandomSampler(train_dataset), batch_size=args.batch_size,
+                              drop_last=True, num_workers=args.workers)
+    valid_loader = DataLoader(valid_dataset, sampler=SequentialSampler(valid_dataset), batch_size=args.batch_size,
+                              drop_last=False, num_workers=args.workers)
+
+    start = time.time()
+    trainer.fit(train_loader, valid_loader, args.epochs, eval_at_start=args.eval_at_start,
+                metric_names=metric_names)
+    log.write('>> Head training took %.1f min\n' % ((time.time() - start) / 60))
+
+    final_fpath = os.path.join(model_out_dir, 'final.pth')
+    if os.path.exists(final_fpath):
+        head_checkpoint = torch.load(final_fpath, map_location='cpu')
+        network_state_dict = {key: value for key, value in network_state_dict.items()
+                              if not key.startswith('logit.') or args.binary_class is None}
+        network_state_dict.update(head_checkpoint['state_dict'])
+        torch.save({
+            'state_dict': network_state_dict,
+            'epoch': head_checkpoint['epoch'],
+            'best_score': head_checkpoint['best_score'],
+            'backbone_checkpoint': meta['checkpoint'],
+            'pruned_config': backbone_checkpoint.get('pruned_config'),
+        }, os.path.join(model_out_dir, 'final_full.pth'))
+        log.write(">> Merged head of epoch {} into '{}'\n".format(head_checkpoint['epoch'],
+                                                                 os.path.join(model_out_dir, 'final_full.pth')))
+
+
+if __name__ == '__main__':
+    print('%s: calling main function ... \n' % os.path.basename(__file__))
+    main()
+    print('\nsuccess!')